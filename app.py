@@ -1,10 +1,38 @@
-from shared import fullchains
-from utils.data_utils import filter_chains
-from utils.map_utils import build_chloro, state_outline, fill_gradients, build_flow_data, make_geom_chloro, make_geom_flow
-import plotnine as p9
+import os
+from pathlib import Path
 import pandas as pd
+from matplotlib.figure import Figure
+from starlette.routing import Route
+from map_render import (map_state, map_level, map_key, render_async, reduction_choices,
+                        interactive_mode, web_pack_async, web_pack_route, render_executor)
+from utils.web_map import geometry_route, geometry_url
+from utils.bin_utils import bin_schemes
+from utils.emissions import chloro_choices, county_table
+import shared
+from utils.reactive_utils import debounce
+from utils import trace_utils
+from utils.filter_utils import county_filters, combine_ops, read_fips
 from shiny import App, Inputs, Outputs, Session, reactive, ui, render
 
+# seconds the inputs must stay unchanged before a new map is requested
+input_delay = float(os.environ.get("F3_INPUT_DELAY", 0.3))
+# collapsed panel under the map with per-stage render timings: F3_DEBUG_PANEL=1
+debug_panel = os.environ.get("F3_DEBUG_PANEL", "0") == "1"
+# reload chain files a new model run drops into Chains/<crop> without a restart: F3_HOT_RELOAD=1,
+# checked every F3_RELOAD_INTERVAL seconds; reloads show up as "reload" traces in the debug panel
+if os.environ.get("F3_HOT_RELOAD", "0") == "1":
+    shared.start_hot_reload(float(os.environ.get("F3_RELOAD_INTERVAL", 5)))
+
+debug_ui = []
+if debug_panel:
+    debug_ui.append(ui.accordion(
+        ui.accordion_panel("Render timings",
+            ui.output_data_frame("debug_spans"),
+            ui.output_data_frame("debug_stages"),
+            ui.output_plot("debug_histogram", height = "300px"),
+            ui.input_action_button("profile_next", "Profile next render")),
+        open = False))
+
 # Define UI
 app_ui = ui.page_fluid(
     ui.layout_sidebar(
@@ -19,10 +47,31 @@ app_ui = ui.page_fluid(
             ui.input_checkbox_group(id = "arcs", label = "Flow arcs to display", 
                 choices = { 0:"Stage 1", 1:"Stage 2"}),
             ui.input_switch("arcsize", "Scale flow arcs by flow volume", value = True),
-            ui.input_select(id = "filter", label = "Select source counties to fileter",
-                choices = {"none":"No filter", "fs_counties":"Upper Mississippi Foodscape"}, selected = "none"),
+            ui.input_checkbox_group(id = "points", label = "County flow totals to display",
+                choices = {0:"Source counties", 1:"Stage 1 destinations"}),
+            ui.input_select(id = "reduction", label = "Flow arcs shown",
+                choices = reduction_choices, selected = "quantile:0.1"),
+            ui.input_select(id = "chloro_column", label = "Choropleth values",
+                choices = chloro_choices(1), selected = "flow_kg_0"),
+            ui.input_select(id = "bins", label = "Choropleth color classes",
+                choices = bin_schemes, selected = "quantile"),
+            ui.input_selectize(id = "filter", label = "Select source counties to filter",
+                choices = {name: county_filters.labels[name] for name in county_filters.names()},
+                multiple = True, options = {"placeholder": "No filter"}),
+            ui.input_radio_buttons(id = "filter_combine", label = "Combine county filters",
+                choices = {op: how.capitalize() for op, how in combine_ops.items()}, selected = "+", inline = True),
+            ui.input_file("filter_upload", "Add a county list (CSV of FIPS codes)", accept = [".csv", ".txt"]),
+            ui.input_radio_buttons(id = "render_mode", label = "Map rendering",
+                choices = {"plotnine":"Standard", "fast":"Fast", interactive_mode:"Interactive"}, selected = "plotnine"),
+            ui.download_button("emissions_table", "Download county emissions (CSV)"),
         ),
-        ui.output_plot("chloro")
+        ui.panel_conditional(f"input.render_mode !== '{interactive_mode}'",
+            ui.output_image("chloro", height = "600px")),
+        # drawn in the browser by www/webmap.js: scroll to zoom, drag to pan
+        ui.panel_conditional(f"input.render_mode === '{interactive_mode}'",
+            ui.div(id = "webmap", style = "width: 1000px; height: 600px;")),
+        ui.include_js(Path(__file__).parent / "www" / "webmap.js"),
+        *debug_ui
     )
         )
         
@@ -31,56 +80,129 @@ def server(input: Inputs, output: Outputs, session: Session):
     @reactive.effect
     def _():
         x = input.crop()
+        with reactive.isolate():
+            chloro = input.chloro_column()
+        choices = chloro_choices(shared.chain_steps[x])
+        ui.update_select("chloro_column", choices = choices, selected = chloro if chloro in choices else "flow_kg_0")
         if x == "corn_direct":
             ui.update_checkbox_group("arcs", choices={0:"Stage 1"})
+            ui.update_checkbox_group("points", choices={0:"Source counties", 1:"Stage 1 destinations"})
             ui.update_checkbox_group("com", choices = {"hog":"Hogs","broiler":"Broiler chickens", "cattle":"Cattle on feed", "ddgs":"Ethanol"} )
         else:
             ui.update_checkbox_group("com", choices = {"hog":"Hogs","broiler":"Broiler chickens", "cattle":"Cattle on feed"} )
             ui.update_checkbox_group("arcs", choices={0:"Stage 1", 1:"Stage 2"})
-    @render.plot    
+            ui.update_checkbox_group("points", choices={0:"Source counties", 1:"Stage 1 destinations", 2:"Stage 2 destinations"})
+
+    # county lists uploaded in this session: labels and FIPS codes by filter name
+    uploads = reactive.value({})
+    upload_fips = {}
+
+    @reactive.effect
+    @reactive.event(input.filter_upload)
+    def _():
+        upload = input.filter_upload()[0]
+        fips = read_fips(upload["datapath"])
+        name = county_filters.add(fips)
+        upload_fips[name] = fips
+        uploads.set({**uploads(), name: upload["name"]})
+        with reactive.isolate():
+            selected = [*input.filter(), name]
+        ui.update_selectize("filter", selected = selected,
+            choices = {**{n: county_filters.labels[n] for n in county_filters.names()}, **uploads()})
+
+    # a burst of clicks settles into one map request
+    @debounce(input_delay)
+    @reactive.calc
+    def state():
+        # the registry keeps a bounded number of uploads: add this session's again, in case they were dropped
+        for name in input.filter():
+            if name in upload_fips:
+                county_filters.add(upload_fips[name])
+        filter_name = county_filters.combine(input.filter(), input.filter_combine())
+        return map_state(input.crop(), input.com(), input.arcs(), input.arcsize(), 
+                         filter_name, input.render_mode(), map_level(), input.reduction(), input.points(),
+                         input.bins(), input.chloro_column())
+
+    # flows and maps are built on a render thread (see map_render.render_async), so the
+    # event loop keeps serving other sessions; cached maps come straight from the image cache
+    @reactive.extended_task
+    async def render_task(state):
+        return await render_async(state)
+
+    # interactive maps are sent as a small pack the browser fetches from this session's route;
+    # the county geometry comes once from geometry_url and stays in the browser's cache
+    pack_url = session.dynamic_route("webmap", web_pack_route)
+
+    @reactive.extended_task
+    async def web_task(state):
+        key, _ = await web_pack_async(state)
+        return key
+
+    @reactive.effect
+    def _():
+        s = state()
+        task = web_task if s["mode"] == interactive_mode else render_task
+        # a newer map supersedes the one in flight: drop it if it hasn't started yet
+        task.cancel()
+        task.invoke(s)
+
+    @reactive.effect
+    async def _():
+        key = web_task.result()
+        await session.send_custom_message("webmap", {"id": "webmap", "geometry": geometry_url(),
+                                                     "data": f"{pack_url}&key={key}"})
+
+    # flows, emissions and intensities of the selected commodities per source county,
+    # straight from the choropleth cube of the crop
+    @render.download(filename = lambda: f"{input.crop()}_emissions_counties.csv")
+    def emissions_table():
+        s = state()
+        table = county_table(shared.chloro_cubes[s["crop"]], shared.chain_steps[s["crop"]],
+                             s["com"] or None, county_filters.mask(s["filter"]))
+        yield table.to_csv(index = False)
+
+    @render.image(delete_file = False)
     def chloro():
-        if input.filter() == "none":
-            chain_data = fullchains
-        else:
-            counties = pd.read_csv('data/'+input.filter()+'.csv')['FIPS'].tolist()
-            chain_data = filter_chains(fullchains, counties, "source_FIPS_0")
-        flowarcs = []
-        if len(input.arcs())>0:
-            if input.crop() == "corn_direct":
-                steps = 1
-            else: steps = 2
-            if input.arcsize():
-                arc_size = "scaled"
-                flowarcs.append(p9.scale_size_continuous(range = [0,1]))
-            else: arc_size = "fixed"
-            flows_to = list(input.com())
-            flows = build_flow_data(chain_data[input.crop()], flows_to, steps)
-            stages = list(map(int,input.arcs()))
-            if len(input.arcs()) ==1:
-                for com in input.com():
-                    flowarcs.append(make_geom_flow(flows['flowarcs'], com, stages[0], size = arc_size))
-            elif len(input.arcs()) ==2:
-                for com in input.com():
-                    flowarcs.append(make_geom_flow(flows['flowarcs'], com, 1, size = arc_size))
-                    flowarcs.append(make_geom_flow(flows['flowarcs'], com, 0, color = "#2c2c2c", size = arc_size))       
-        if input.com():
-            mapdata = build_chloro(chain_data, input.crop(), "flow_kg_0",input.com())
-            basemap = make_geom_chloro(mapdata, input.com())
-        else: 
-            basemap = 0
-        if input.crop() == "soy":
-            colorval = "soy"
-        else: colorval = "corn"
-        chloromap = (p9.ggplot()
-            + basemap
-            + state_outline
-            + flowarcs
-            + p9.scale_fill_manual(values = fill_gradients[colorval])
-            + p9.theme_void()
-            + p9.theme(figure_size=(10,6), 
-                        panel_background=p9.element_rect(fill="white"),
-                        legend_position="none"))
-        return chloromap
-
-
-app = App(app_ui, server)
\ No newline at end of file
+        return {"src": render_task.result(), "width": "1000px", "height": "600px"}
+
+    if debug_panel:
+        # spans of the trace that produced the map on screen
+        @render.data_frame
+        def debug_spans():
+            render_task.result()
+            record = trace_utils.last(key = map_key(state()))
+            if record is None:
+                return pd.DataFrame()
+            return pd.DataFrame([{"stage": s["name"], "start_s": s["start"], "seconds": s["seconds"],
+                                  **s["attrs"]} for s in record["spans"]]
+                                + [{"stage": "total", "seconds": record["seconds"], **record["attrs"]}])
+
+        @render.data_frame
+        def debug_stages():
+            render_task.result()
+            return pd.DataFrame(trace_utils.summary())
+
+        @render.plot
+        def debug_histogram():
+            render_task.result()
+            counts, edges = trace_utils.histograms()
+            # a bare Figure: pyplot's global state belongs to the render threads
+            fig = Figure()
+            ax = fig.subplots()
+            for stage, c in counts.items():
+                ax.stairs(c, edges, label = stage)
+            ax.set_xscale("log")
+            ax.set_xlabel("seconds")
+            ax.set_ylabel("renders")
+            ax.legend(fontsize = "small")
+            return fig
+
+        @reactive.effect
+        @reactive.event(input.profile_next)
+        def _():
+            trace_utils.profile_next(trace_utils.profile_mode or "cprofile")
+
+app = App(app_ui, server)
+# outside the sessions, so every session and browser tab shares one cached copy
+app.starlette_app.router.routes.insert(0, Route("/webmap/geometry/{version}/{level:int}",
+                                                     geometry_route(render_executor)))
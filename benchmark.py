@@ -0,0 +1,256 @@
+import argparse
+import datetime
+import gc
+import glob
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from utils import ref_data
+from utils.data_utils import get_chains, chain_columns, chain_store_path
+from utils.synth_chains import synth_chains
+from utils.od_utils import add_positions, od_matrices
+from utils.chloro_cube import ChloroCube
+from utils.flow_utils import build_flow, build_arcs, assign_bins
+from utils.map_utils import build_chloro, build_flow_data, flow_cache, bin_cache
+from utils.render_utils import arc_layers
+from map_render import draw_map, map_level, map_state, map_inputs
+
+# offline benchmarks of the data, flow and render hot paths on synthetic chain files
+# shaped like Chains/ (see utils.synth_chains), at several multiples of the real row count.
+#
+#   python benchmark.py --scales 1 10 --output bench.json
+#   python benchmark.py --scales 1 10 --compare bench.json --threshold 0.25
+#
+# each stage is timed (best of --repeat runs) and its peak Python/numpy allocation is
+# measured with tracemalloc in one extra run. results go to JSON; --compare flags stages
+# that got slower (or bigger) than the baseline by more than the threshold.
+#
+# the stages above call the library functions directly. the "server" rows time a few maps of
+# the real chains the way a session's request builds them (map_render.map_inputs, then
+# draw_map), cold and with the flow and color class caches warm; the image cache is left
+# out, and so is what Shiny adds around a request (reactive updates, websocket, HTTP).
+
+bench_dir = "data/cache/bench/"
+default_chains = ["Chains/corn:1", "Chains/ddgs:2"]
+
+
+def measure(fn, repeat=3):
+    """(best wall time over repeat runs, peak traced memory in MB of one more run, result)"""
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        t = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - t)
+    del result
+    gc.collect()
+    tracemalloc.start()
+    result = fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(times), peak / 2**20, result
+
+
+def chain_stages(folder, nsteps, repeat=3):
+    """
+    The hot paths for one chain folder, in the order the app runs them.
+
+    Returns
+    -------
+    list of dict
+        {"stage", "seconds", "peak_mb"} per stage
+    """
+    crop = os.path.basename(folder.rstrip("/"))
+    rows = []
+
+    def record(stage, fn, n=repeat):
+        seconds, peak, result = measure(fn, n)
+        rows.append({"stage": stage, "seconds": round(seconds, 4), "peak_mb": round(peak, 1)})
+        return result
+
+    def cold_load():
+        path = chain_store_path(folder, nsteps)
+        if os.path.exists(path):
+            os.remove(path)
+        return get_chains(folder, nsteps, columns=chain_columns(nsteps))
+
+    record("get_chains_csv", cold_load, 1)
+    chains = record("get_chains_parquet", lambda: get_chains(folder, nsteps, columns=chain_columns(nsteps)))
+    chains = record("add_positions", lambda: add_positions(chains.copy()))
+    od = record("od_matrices", lambda: od_matrices(chains, nsteps))
+    cube = record("chloro_cube", lambda: ChloroCube(chains, ["flow_kg_0"]))
+    com = sorted(chains["dest_final"].unique())
+    level = map_level()
+    mapdata = record("build_chloro", lambda: build_chloro({crop: cube}, crop, "flow_kg_0", com, None, level))
+    record("assign_bins", lambda: assign_bins(mapdata["flow_kg_0"], max_bins=4))
+
+    fips_points = ref_data.arcdicts["FIPS"]
+    stage0 = chains[["source_FIPS_0", "destination_FIPS_0", "flow_kg_0"]]
+    grouped = stage0.groupby(["source_FIPS_0", "destination_FIPS_0"]).sum().reset_index()
+    record("build_arcs", lambda: build_arcs(grouped, fips_points, fips_points))
+    record("build_flow", lambda: build_flow(chains, "source_FIPS_0", "destination_FIPS_0", "flow_kg_0",
+                                            fips_points, fips_points))
+
+    def flows():
+        flow_cache.clear()
+        return build_flow_data(chains, com, nsteps, od=od)["flowarcs"]
+
+    flowarcs = record("build_flow_data", flows)
+    layers = arc_layers(com, list(range(nsteps)))
+    path = tempfile.NamedTemporaryFile(suffix=".png", delete=False).name
+    for mode in ["plotnine", "fast"]:
+        record(f"render_{mode}", lambda: draw_map(path, mapdata, flowarcs, layers, "corn", "scaled", mode, level))
+    os.remove(path)
+    for row in rows:
+        row["rows"] = len(chains)
+    return rows
+
+
+# maps the server stages request, as map_state arguments
+server_maps = [("corn_direct", ["hog", "cattle"], [0], True, "none"),
+               ("corn_ddgs", ["cattle"], [0, 1], True, "none"),
+               ("soy", ["hog", "broiler"], [0, 1], False, "fs_counties")]
+
+
+def server_stages(repeat=3):
+    """
+    server_maps through the server's own path on the data shared loaded: map_inputs with
+    empty flow and class caches, map_inputs again with them warm, and map_inputs plus
+    draw_map in each render mode. Times are summed over the maps.
+
+    Returns
+    -------
+    list of dict
+        {"stage", "seconds", "peak_mb", "rows"} per stage
+    """
+    import shared
+    level = map_level()
+    states = [map_state(*args, level=level) for args in server_maps]
+    rows = []
+
+    def record(stage, fn, n=repeat):
+        seconds, peak, _ = measure(fn, n)
+        rows.append({"stage": stage, "seconds": round(seconds, 4), "peak_mb": round(peak, 1)})
+
+    def cold():
+        flow_cache.clear()
+        bin_cache.clear()
+        return [map_inputs(state) for state in states]
+
+    record("map_inputs_cold", cold)
+    record("map_inputs_warm", lambda: [map_inputs(state) for state in states])
+    path = tempfile.NamedTemporaryFile(suffix=".png", delete=False).name
+    for mode in ["plotnine", "fast"]:
+        record(f"request_{mode}", lambda: [draw_map(path, **{**map_inputs(state), "mode": mode})
+                                           for state in states])
+    os.remove(path)
+    for row in rows:
+        row["rows"] = sum(len(shared.crops[state["crop"]]["chains"]) for state in states)
+    return rows
+
+
+def run(chains=default_chains, scales=(1, 10), repeat=3, seed=0, server=True):
+    """benchmark every chain folder ("path:nsteps") at every scale, and the server's path (see server_stages)"""
+    results = []
+    for spec in chains:
+        template, nsteps = spec.rsplit(":", 1)
+        nsteps = int(nsteps)
+        for scale in scales:
+            folder = os.path.join(bench_dir, f"{os.path.basename(template.rstrip('/'))}_{scale}x")
+            if not glob.glob(os.path.join(folder, "*_full.csv")):
+                synth_chains(template, folder, scale, seed)
+            print(f"{folder} ...", flush=True)
+            rows = chain_stages(folder, nsteps, repeat)
+            for row in rows:
+                results.append({"chains": spec, "scale": scale, **row})
+                print(f"  {row['stage']:<20} {row['seconds']:>9.4f}s {row['peak_mb']:>9.1f} MB", flush=True)
+            seconds = {row["stage"]: row["seconds"] for row in rows}
+            print(f"  fast render: {seconds['render_plotnine'] / seconds['render_fast']:.1f}x plotnine's speed"
+                  + ("" if seconds["render_fast"] < seconds["render_plotnine"] else "  SLOWER THAN PLOTNINE"),
+                  flush=True)
+    if server:
+        print("server ...", flush=True)
+        for row in server_stages(repeat):
+            results.append({"chains": "server", "scale": 1, **row})
+            print(f"  {row['stage']:<20} {row['seconds']:>9.4f}s {row['peak_mb']:>9.1f} MB", flush=True)
+    return results
+
+
+def max_rss_mb():
+    """peak resident memory of this process in MB, None where resource isn't available (Windows)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is in KB on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def metadata():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    return {"time": datetime.datetime.now().isoformat(timespec="seconds"),
+            "commit": commit,
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "max_rss_mb": max_rss_mb()}
+
+
+def compare(results, baseline, threshold=0.25, mem_threshold=0.5, min_seconds=0.005):
+    """
+    Stages that got slower than the baseline by more than threshold (a fraction), or whose
+    peak memory grew by more than mem_threshold. Stages faster than min_seconds in the
+    baseline are too noisy to time and only checked for memory.
+
+    Returns
+    -------
+    list of str
+        one line per regression
+    """
+    old = {(r["chains"], r["scale"], r["stage"]): r for r in baseline["results"]}
+    regressions = []
+    for r in results:
+        b = old.get((r["chains"], r["scale"], r["stage"]))
+        if b is None:
+            continue
+        name = f"{r['chains']} {r['scale']}x {r['stage']}"
+        if b["seconds"] >= min_seconds and r["seconds"] > b["seconds"] * (1 + threshold):
+            regressions.append(f"{name}: {b['seconds']:.4f}s -> {r['seconds']:.4f}s")
+        if b["peak_mb"] >= 1 and r["peak_mb"] > b["peak_mb"] * (1 + mem_threshold):
+            regressions.append(f"{name}: {b['peak_mb']:.1f} MB -> {r['peak_mb']:.1f} MB")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark the data, flow and render hot paths")
+    parser.add_argument("--chains", nargs="+", default=default_chains, metavar="PATH:NSTEPS",
+                        help="template chain folders and their number of stages")
+    parser.add_argument("--scales", nargs="+", type=int, default=[1, 10], help="row multiples, e.g. 1 10 100")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-server", action="store_true", help="skip the server path stages")
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--compare", metavar="BASELINE", help="JSON results of an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed slowdown, as a fraction")
+    parser.add_argument("--mem-threshold", type=float, default=0.5, help="allowed peak memory growth, as a fraction")
+    args = parser.parse_args()
+
+    results = run(args.chains, args.scales, args.repeat, args.seed, not args.no_server)
+    report = {"meta": metadata(), "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold, args.mem_threshold)
+        for line in regressions:
+            print("REGRESSION", line)
+        print(f"{len(regressions)} regressions against {args.compare}")
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,287 @@
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from map_render import map_state, map_level, map_inputs, draw_map, crop_choices, chain_steps
+from utils.emissions import chloro_choices
+from utils.map_utils import flow_cache
+from utils.parallel_utils import mp_context
+
+try:
+    import yaml
+    has_yaml = True
+except ImportError:
+    has_yaml = False
+
+# headless batch export of report figures from a YAML or JSON spec.
+#
+#   python export_maps.py figures.yaml [--workers 8] [--progress jsonl]
+#
+# a spec lists figures; a list value of crop, filter, arcsize, reduction, bins, chloro or mode (and a
+# list of lists for com, arcs or points) expands to one figure per combination. chloro picks the
+# choropleth values, flow_kg_0 or an emissions column (see emissions.chloro_choices):
+#
+#   output: figures/
+#   formats: [png, pdf]
+#   dpi: 300
+#   defaults: {arcsize: true, filter: none}
+#   figures:
+#     - crop: corn_ddgs
+#       com: [cattle]
+#       arcs: [0, 1]
+#     - crop: [corn_ddgs, soy]
+#       com: [[hog], [hog, broiler]]
+#       arcs: [[], [0], [0, 1]]
+#       name: "{crop}_{com}_{arcs}"
+#
+# the flows every figure needs are computed once per (crop, filter, reduction) before the
+# process pool starts and handed to each worker when it starts; workers only build
+# choropleths and draw. the default name of a figure includes its mode when it isn't
+# plotnine, or when the entry lists more than one mode.
+
+spec_defaults = {"output": "figures/", "formats": ["png"], "dpi": 300, "name": None}
+figure_defaults = {"com": [], "arcs": [], "arcsize": True, "filter": "none", "mode": "plotnine",
+                   "reduction": "quantile:0.1", "points": [], "bins": "quantile", "chloro": "flow_kg_0"}
+# fields taking a list of values as a single value; a list of lists gives alternatives
+list_fields = ["com", "arcs", "points"]
+export_formats = ["png", "svg", "pdf"]
+
+
+def read_spec(path):
+    """the export spec in a .json, .yaml or .yml file"""
+    with open(path) as f:
+        if path.endswith((".yaml", ".yml")):
+            if not has_yaml:
+                raise ImportError("reading a YAML spec needs PyYAML (pip install pyyaml); or write it as JSON")
+            spec = yaml.safe_load(f)
+        else:
+            spec = json.load(f)
+    return {**spec_defaults, **spec}
+
+
+def _alternatives(field, value):
+    if field in list_fields:
+        value = [] if value is None else value
+        if value and all(isinstance(v, (list, tuple)) for v in value):
+            return [list(v) for v in value]
+        return [value if isinstance(value, (list, tuple)) else [value]]
+    return list(value) if isinstance(value, (list, tuple)) else [value]
+
+
+def figure_name(state, template=None, show_mode=False):
+    """file name (without extension) of a figure; the default name shows the mode with show_mode"""
+    fields = {"crop": state["crop"],
+              "com": "-".join(state["com"]) or "nocom",
+              "arcs": "arcs" + "".join(str(a) for a in state["arcs"]) if state["arcs"] else "noarcs",
+              "arcsize": "scaled" if state["arcsize"] else "fixed",
+              "filter": state["filter"].replace("+", "_or_").replace("&", "_and_"),
+              "reduction": (state["reduction"] or "").replace(":", ""),
+              "points": "pts" + "".join(str(p) for p in state["points"]) if state["points"] else "",
+              "mode": state["mode"],
+              "bins": state["bins"],
+              "chloro": state["chloro"]}
+    if template is None:
+        parts = [fields["crop"], fields["com"], fields["arcs"]]
+        if state["arcs"]:
+            parts += [fields["arcsize"], fields["reduction"]]
+        parts += [fields["points"], fields["filter"] if state["filter"] != "none" else "",
+                  fields["bins"] if state["bins"] != "quantile" else "",
+                  fields["chloro"] if state["chloro"] != "flow_kg_0" else "",
+                  fields["mode"] if show_mode or state["mode"] != figure_defaults["mode"] else ""]
+        return "_".join(p for p in parts if p)
+    return template.format(**fields)
+
+
+def expand(spec):
+    """
+    The figures of a spec.
+
+    Returns
+    -------
+    list of (str, dict)
+        (name, map_state) per figure, without duplicate maps
+    """
+    defaults = {**figure_defaults, **spec.get("defaults", {})}
+    level = map_level()
+    figures, seen = [], {}
+    for entry in spec["figures"]:
+        entry = {**defaults, **entry}
+        fields = [f for f in figure_defaults if f != "crop"]
+        show_mode = len(_alternatives("mode", entry["mode"])) > 1
+        for crop in _alternatives("crop", entry["crop"]):
+            if crop not in crop_choices:
+                raise ValueError(f"unknown crop {crop!r}, expected one of {list(crop_choices)}")
+            for values in itertools.product(*[_alternatives(f, entry[f]) for f in fields]):
+                fig = dict(zip(fields, values))
+                choices = chloro_choices(chain_steps(crop))
+                if fig["chloro"] not in choices:
+                    raise ValueError(f"unknown chloro {fig['chloro']!r} for {crop}, expected one of {list(choices)}")
+                state = map_state(crop, fig["com"], fig["arcs"], fig["arcsize"], fig["filter"], fig["mode"],
+                                  level, fig["reduction"], fig["points"], fig["bins"], fig["chloro"])
+                name = figure_name(state, entry.get("name", spec["name"]), show_mode)
+                if name in seen:
+                    if seen[name] != state:
+                        raise ValueError(f"two different figures are both named {name!r}")
+                    continue
+                seen[name] = state
+                figures.append((name, state))
+    return figures
+
+
+def precompute(states):
+    """
+    Build the flows and node points of every figure into map_utils.flow_cache, once per
+    (crop, filter, reduction) and commodity.
+
+    Returns
+    -------
+    int
+        number of (crop, filter) groups
+    """
+    arcs, points = {}, {}
+    for state in states:
+        key = (state["crop"], state["filter"])
+        if state["arcs"]:
+            group = arcs.setdefault((*key, state["reduction"]), {"com": set(), "arcs": set()})
+            group["com"].update(state["com"])
+            group["arcs"].update(state["arcs"])
+        if state["points"]:
+            group = points.setdefault(key, {"com": set(), "points": set()})
+            group["com"].update(state["com"])
+            group["points"].update(state["points"])
+    # room for the arcs and points of every commodity of every group
+    needed = sum(len(g["com"]) for g in [*arcs.values(), *points.values()])
+    flow_cache.maxsize = max(flow_cache.maxsize, 2 * needed)
+    level = map_level()
+    for (crop, filter_name, reduction), group in arcs.items():
+        map_inputs(map_state(crop, group["com"], group["arcs"], True, filter_name, level=level,
+                             reduction=reduction))
+    for (crop, filter_name), group in points.items():
+        map_inputs(map_state(crop, group["com"], [], True, filter_name, level=level, points=group["points"]))
+    return len({key[:2] for key in arcs} | set(points))
+
+
+def _seed_worker(entries, maxsize):
+    """start a worker's flow_cache with the flows precompute built in the parent"""
+    flow_cache.maxsize = maxsize
+    for key, value in entries:
+        flow_cache.put(key, value)
+
+
+def export_figure(name, state, folder, formats, dpi):
+    """
+    Render one figure to folder in every format. Vector formats are always drawn with
+    plotnine; the fast renderer is only used for a png when the figure asks for it.
+
+    Returns
+    -------
+    dict
+        name, files written and seconds taken
+    """
+    t = time.perf_counter()
+    inputs = map_inputs(state)
+    files = []
+    for fmt in formats:
+        path = os.path.join(folder, f"{name}.{fmt}")
+        mode = state["mode"] if fmt == "png" else "plotnine"
+        draw_map(path, **{**inputs, "mode": mode}, dpi=dpi)
+        files.append(path)
+    return {"name": name, "files": files, "seconds": round(time.perf_counter() - t, 3)}
+
+
+def _progress_line(done, total, t0, result, fmt):
+    elapsed = time.perf_counter() - t0
+    eta = elapsed / done * (total - done)
+    if fmt == "jsonl":
+        return json.dumps({"done": done, "total": total, "elapsed_s": round(elapsed, 1), "eta_s": round(eta, 1),
+                           **result})
+    status = f"FAILED {result['error']}" if "error" in result else f"{result['seconds']:.2f}s"
+    return (f"[{done:>{len(str(total))}}/{total}] {elapsed:6.1f}s eta {eta:6.1f}s  "
+            f"{result['name']}  {status}")
+
+
+def export(spec, workers=None, progress="text", skip_existing=False):
+    """
+    Render every figure of a spec (see read_spec) in a process pool, printing a progress
+    line as each one finishes, and write a manifest.json of the run to the output folder.
+
+    Returns
+    -------
+    list of dict
+        one result per figure; failed figures have an "error" instead of "files"
+    """
+    folder = spec["output"]
+    formats = spec["formats"] if isinstance(spec["formats"], list) else [spec["formats"]]
+    unknown = set(formats) - set(export_formats)
+    if unknown:
+        raise ValueError(f"unsupported formats {sorted(unknown)}, expected some of {export_formats}")
+    os.makedirs(folder, exist_ok=True)
+    figures = expand(spec)
+    if skip_existing:
+        figures = [(name, state) for name, state in figures
+                   if not all(os.path.exists(os.path.join(folder, f"{name}.{fmt}")) for fmt in formats)]
+    t0 = time.perf_counter()
+    groups = precompute([state for _, state in figures])
+    print(f"{len(figures)} figures, flows for {groups} crop/filter groups in {time.perf_counter() - t0:.1f}s",
+          file=sys.stderr, flush=True)
+
+    results = []
+
+    def report(result):
+        results.append(result)
+        print(_progress_line(len(results), len(figures), t0, result, progress), flush=True)
+
+    workers = workers or os.cpu_count()
+    if workers <= 1:
+        for name, state in figures:
+            try:
+                report(export_figure(name, state, folder, formats, spec["dpi"]))
+            except Exception as e:
+                report({"name": name, "error": repr(e)})
+    else:
+        # workers start from a forkserver like the app's pools (see parallel_utils), with a
+        # copy of the flows precompute left in flow_cache
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context(), initializer=_seed_worker,
+                                 initargs=(flow_cache.items(), flow_cache.maxsize)) as pool:
+            futures = {pool.submit(export_figure, name, state, folder, formats, spec["dpi"]): name
+                       for name, state in figures}
+            for f in as_completed(futures):
+                if f.exception() is not None:
+                    report({"name": futures[f], "error": repr(f.exception())})
+                else:
+                    report(f.result())
+
+    states = dict(figures)
+    manifest = {"formats": formats,
+                "dpi": spec["dpi"],
+                "seconds": round(time.perf_counter() - t0, 1),
+                "figures": [{**r, "state": states[r["name"]]} for r in sorted(results, key=lambda r: r["name"])]}
+    with open(os.path.join(folder, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=1)
+    failed = sum("error" in r for r in results)
+    print(f"exported {len(results) - failed} figures to {folder} in {manifest['seconds']}s"
+          + (f", {failed} failed" if failed else ""), file=sys.stderr)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="render report figures from a YAML/JSON spec")
+    parser.add_argument("spec", help="figure spec (.yaml, .yml or .json)")
+    parser.add_argument("--workers", type=int, default=None, help="render processes (default: all cores)")
+    parser.add_argument("--output", help="output folder, overriding the spec's")
+    parser.add_argument("--formats", nargs="+", choices=export_formats, help="overrides the spec's formats")
+    parser.add_argument("--dpi", type=int, help="overrides the spec's dpi")
+    parser.add_argument("--progress", choices=["text", "jsonl"], default="text",
+                        help="one line per finished figure, as text or JSON")
+    parser.add_argument("--skip-existing", action="store_true", help="keep figures already exported")
+    args = parser.parse_args()
+
+    spec = read_spec(args.spec)
+    for field in ["output", "formats", "dpi"]:
+        if getattr(args, field) is not None:
+            spec[field] = getattr(args, field)
+    results = export(spec, args.workers, args.progress, args.skip_existing)
+    sys.exit(1 if any("error" in r for r in results) else 0)
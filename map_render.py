@@ -0,0 +1,437 @@
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+import shared
+from utils.filter_utils import county_filters
+from utils.map_utils import (build_chloro, build_flow_data, build_point_data, chloro_map, fill_gradients,
+                             flow_cache, bin_cache)
+from utils.flow_utils import bubbles
+from utils.render_utils import get_renderer, arc_layers, point_layers
+from utils.image_cache import ImageCache
+from utils.fingerprint import data_fingerprint
+from utils import ref_data
+from utils.od_utils import parse_reduction
+from utils.emissions import is_emission
+from utils.trace_utils import trace, span
+from utils.cache_utils import LRUCache
+from utils.web_map import map_pack, gzip_response
+from starlette.responses import Response
+
+# destination commodities and arc stages the app offers for each crop
+crop_choices = {
+    "corn_direct": {"com": ["hog", "broiler", "cattle", "ddgs"], "arcs": [0]},
+    "corn_ddgs": {"com": ["hog", "broiler", "cattle"], "arcs": [0, 1]},
+    "soy": {"com": ["hog", "broiler", "cattle"], "arcs": [0, 1]},
+}
+filter_choices = ["none"] + county_filters.names()
+# arc reductions offered in the app (see od_utils.reduction_modes)
+reduction_choices = {
+    "quantile:0.1": "Drop smallest 10% of flows",
+    "share:0.95": "Arcs carrying 95% of flow",
+    "share:0.8": "Arcs carrying 80% of flow",
+    "topk:200": "Largest 200 flows",
+    "grid:2": "Bundle into 2\u00b0 grid cells",
+    "state": "Bundle state to state",
+}
+render_modes = ["plotnine", "fast"]
+# the app's third mode: maps drawn in the browser from web_map packs instead of images
+interactive_mode = "interactive"
+# maps are drawn 10 x 6 inches at 100 dpi
+map_width_px = 1000
+
+# files every rendered map depends on; the chain files are versioned per crop and destination
+# commodity in map_key instead, so a new model run only retires the maps of what it changed
+data_files = ["data/*.gpkg", "data/*_counties.csv"]
+
+image_cache = ImageCache(
+    os.environ.get("F3_IMAGE_CACHE_DIR", "data/cache/images"),
+    data_fingerprint(data_files),
+    max_bytes = int(float(os.environ.get("F3_IMAGE_CACHE_MB", 200)) * 2**20),
+    purge_stale = os.environ.get("F3_IMAGE_CACHE_PURGE", "1") == "1")
+
+
+# maps are computed and drawn on these threads so the app's event loop stays free.
+# plotnine draws through pyplot, which isn't thread-safe, so plotnine renders take turns
+render_executor = ThreadPoolExecutor(max_workers = int(os.environ.get("F3_RENDER_THREADS", 4)),
+                                     thread_name_prefix = "render")
+_plot_lock = threading.Lock()
+
+# interactive map packs (see utils.web_map) by map_key; a few kB each
+web_packs = LRUCache(maxsize = int(os.environ.get("F3_WEBMAP_CACHE_SIZE", 256)))
+
+
+def map_level():
+    """geometry simplification level for maps map_width_px wide"""
+    return ref_data.pick_level(map_width_px)
+
+
+def map_state(crop, com, arcs, arcsize, filter_name, mode = "plotnine", level = 0, reduction = "quantile:0.1",
+              points = (), bins = "quantile", chloro = "flow_kg_0"):
+    """
+    Canonical description of a map: the same map always gives the same dict,
+    whatever order the inputs were selected in.
+    """
+    arcs = sorted(int(a) for a in arcs)
+    return {"crop": crop,
+            "com": sorted(com),
+            "arcs": arcs,
+            "arcsize": bool(arcsize) and len(arcs) > 0,
+            "filter": filter_name,
+            "mode": mode,
+            "level": level,
+            "reduction": reduction if len(arcs) > 0 else None,
+            "points": sorted(int(p) for p in points),
+            "bins": bins,
+            "chloro": chloro}
+
+
+def map_key(state, view = None):
+    """
+    image cache key of a map_state: a hash of the state and the data version of each of its
+    commodities (of all of the crop's, for "fixed" color classes), from view (shared.crops[crop]; the crop's current data by default)
+    """
+    view = shared.crops[state["crop"]] if view is None else view
+    # "fixed" color classes come from every commodity of the crop
+    com = sorted(view["versions"]) if state["bins"] == "fixed" else state["com"]
+    return ImageCache.key({**state, "data": [view["versions"].get(c) for c in com]})
+
+
+def forget_crop(crop, dests, generation):
+    """
+    Drop what was built from a crop's chain data before a reload (see shared.reload_crop):
+    flows and points of the reloaded commodities, color classes that include them or come
+    from the whole crop, and filter rows of the old table. Images and interactive packs of
+    the old data are no longer reachable under map_key and age out of their caches.
+    """
+    flow_cache.discard(lambda key: key[0] == crop and key[2] in dests)
+    bin_cache.discard(lambda key: key[1] == crop if key[0] == "fixed" else
+                      key[0] == crop and (key[-2] == "fixed" or not dests.isdisjoint(key[-3])))
+    county_filters.forget((crop, generation - 1))
+
+
+shared.reload_hooks.append(forget_crop)
+
+
+def chain_steps(crop):
+    return shared.chain_steps[crop]
+
+
+def source_counties(filter_name):
+    """FIPS codes of a county filter (see filter_utils), None for "none" """
+    return county_filters.counties(filter_name)
+
+
+def point_bubbles(flowpoints, points):
+    """(bubbles GeoDataFrame, color) layers for (commodity, node, color) point layers"""
+    circles = bubbles([flowpoints[com][node] for com, node, _ in points]) if points else []
+    return [(b, color) for b, (_, _, color) in zip(circles, points)]
+
+
+def draw_map(path, mapdata, flowarcs, layers, colorval, arc_size = "fixed", mode = "plotnine", level = 0,
+             flowpoints = None, points = (), dpi = 100):
+    """
+    Render a map to path with either the plotnine or the fast matplotlib backend.
+    See map_utils.chloro_map for the arguments; flowpoints are the node points per commodity
+    (map_utils.build_point_data) and points the (commodity, node, color) layers drawn from them
+    as bubbles (render_utils.point_layers). The plotnine backend writes any format plotnine
+    saves to (from the extension of path) at dpi; the fast one always draws at 100 dpi.
+    """
+    bubble_layers = point_bubbles(flowpoints, points)
+    if mode == "fast":
+        with span("draw", mode = mode):
+            get_renderer(level).render(path, mapdata, fill_gradients[colorval],
+                                  [(flowarcs[com][stage], color, arc_size) for com, stage, color in layers],
+                                  bubble_layers)
+    else:
+        with span("assemble_plot", layers = len(layers) + len(bubble_layers)):
+            plot = chloro_map(mapdata, flowarcs, layers, colorval, arc_size, level, bubble_layers)
+        with span("draw", mode = mode):
+            with _plot_lock:
+                plot.save(path, dpi = dpi, verbose = False)
+    return path
+
+
+def map_inputs(state, view = None):
+    """
+    Compute the flows and choropleth for a map_state, from view (shared.crops[crop];
+    the crop's current data by default).
+
+    Returns
+    -------
+    dict
+        the draw_map arguments after path
+    """
+    crop, com = state["crop"], state["com"]
+    view = shared.crops[crop] if view is None else view
+    versions = view["versions"]
+    with span("filter_mask", filter = state["filter"]) as attrs:
+        mask = county_filters.mask(state["filter"])
+        attrs["counties"] = None if mask is None else int(mask.sum())
+    colorval = "soy" if crop == "soy" else "corn"
+    layers = arc_layers(com, state["arcs"]) if state["arcs"] else []
+    points = point_layers(com, state["points"], chain_steps(crop), colorval)
+    flowarcs, flowpoints = {}, {}
+    if layers or points:
+        chain_data = view["chains"]
+        od = view["od"]
+        rows = len(chain_data)
+        if mask is not None:
+            # the stage OD matrices of the filter's rows, straight from the chain graph
+            with span("filter_chains") as attrs:
+                positions = county_filters.rows(state["filter"], (crop, view["generation"]), chain_data)
+                od = {c: view["graph"].od(c, positions) for c in com}
+                rows = attrs["rows"] = len(positions)
+        if layers:
+            with span("build_flow_data", rows = rows, com = len(com)) as attrs:
+                flowarcs = build_flow_data(chain_data, com, chain_steps(crop),
+                                           cache_key = (crop, state["filter"]), od = od, versions = versions,
+                                           reduction = parse_reduction(state["reduction"]))["flowarcs"]
+                attrs["arcs"] = sum(len(a) for arcs in flowarcs.values() for a in arcs)
+        if points:
+            with span("build_point_data", rows = rows) as attrs:
+                flowpoints = build_point_data(chain_data, com, chain_steps(crop),
+                                              cache_key = (crop, state["filter"]), od = od, versions = versions)
+                attrs["points"] = sum(len(p) for pts in flowpoints.values() for p in pts)
+    mapdata = None
+    if com:
+        with span("build_chloro") as attrs:
+            mapdata = build_chloro({crop: view["cube"]}, crop, state["chloro"], com, level = state["level"],
+                                   source_mask = mask, scheme = state["bins"],
+                                   cache_key = (crop, state["filter"], *(versions.get(c) for c in com)),
+                                   data_version = tuple(sorted(versions.items())))
+            attrs["counties"] = len(mapdata)
+    return {"mapdata": mapdata,
+            "flowarcs": flowarcs,
+            "layers": layers,
+            "colorval": "ghg" if is_emission(state["chloro"]) else colorval,
+            "arc_size": "scaled" if state["arcsize"] else "fixed",
+            "mode": state["mode"],
+            "level": state["level"],
+            "flowpoints": flowpoints,
+            "points": points}
+
+
+def render_state(state, path, view = None):
+    """compute the flows and choropleth for a map_state and render it to path"""
+    return draw_map(path, **map_inputs(state, view))
+
+
+def cached_image(state, cache = None):
+    """path of the cached image for a map_state, rendering it first if needed"""
+    cache = image_cache if cache is None else cache
+    # the key and the map come from the same data, even if the crop is reloaded meanwhile
+    view = shared.crops[state["crop"]]
+    key = map_key(state, view)
+    with trace("map", key = key, crop = state["crop"], mode = state["mode"]) as t:
+        path = cache.get(key)
+        t.attrs["cache_hit"] = path is not None
+        if path is None:
+            tmp = tempfile.NamedTemporaryFile(suffix = ".png", delete = False).name
+            path = render_state(state, tmp, view)
+            with span("cache_put"):
+                path = cache.put(key, path)
+    return path
+
+
+def web_pack(state):
+    """
+    The interactive map pack of a map_state, built on first request and then kept in web_packs.
+
+    Returns
+    -------
+    tuple
+        (map_key of the state, gzipped pack)
+    """
+    view = shared.crops[state["crop"]]
+    key = map_key(state, view)
+    with trace("webmap", key = key, crop = state["crop"], mode = state["mode"]) as t:
+        body = web_packs.get(key)
+        t.attrs["cache_hit"] = body is not None
+        if body is None:
+            inputs = map_inputs(state, view)
+            with span("pack") as attrs:
+                body = map_pack(inputs["mapdata"], inputs["flowarcs"], inputs["layers"],
+                                fill_gradients[inputs["colorval"]], inputs["arc_size"],
+                                point_bubbles(inputs["flowpoints"], inputs["points"]))
+                attrs["bytes"] = len(body)
+            web_packs.put(key, body)
+    return key, body
+
+
+async def web_pack_async(state):
+    """web_pack on a render thread, cancelled like render_async"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(render_executor, web_pack, state)
+
+
+async def web_pack_route(request):
+    """session route the browser fetches packs from, by key (see app.py)"""
+    body = web_packs.get(request.query_params.get("key", ""))
+    if body is None:
+        return Response(status_code = 404)
+    return gzip_response(body, "private, max-age=3600")
+
+
+async def render_async(state, cache = None):
+    """
+    cached_image on a render thread. Cancelling the await drops the job if it hasn't
+    started yet; a job that has started runs to the end and still fills the cache.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(render_executor, cached_image, state, cache)
+
+
+def all_states(modes = ("plotnine",)):
+    """every distinct map the app can show without point layers"""
+    level = map_level()
+    states = {}
+    for crop, choices in crop_choices.items():
+        for n in range(len(choices["com"]) + 1):
+            for com in itertools.combinations(choices["com"], n):
+                for k in range(len(choices["arcs"]) + 1):
+                    for arcs in itertools.combinations(choices["arcs"], k):
+                        for arcsize, filter_name, mode in itertools.product([True, False], filter_choices, modes):
+                            state = map_state(crop, com, arcs, arcsize, filter_name, mode, level)
+                            states[image_cache.key(state)] = state
+    return list(states.values())
+
+
+def warm_cache(modes = ("plotnine",), workers = None):
+    """render every reachable map into the image cache using a process pool"""
+    states = all_states(modes)
+    failed = []
+    t = time.perf_counter()
+    with ProcessPoolExecutor(max_workers = workers) as pool:
+        futures = {pool.submit(cached_image, state): state for state in states}
+        for i, f in enumerate(as_completed(futures), 1):
+            if f.exception() is not None:
+                failed.append((futures[f], f.exception()))
+            print(f"\r{i}/{len(states)} maps", end = "", flush = True)
+    print(f"\nwarmed {len(states) - len(failed)} maps in {time.perf_counter() - t:.1f}s, "
+          f"cache size {image_cache.size() / 2**20:.1f} MB")
+    for state, e in failed:
+        print(f"WARNING: could not render {state}: {e!r}")
+
+
+async def _load_session(states, rng, requests, cache, latencies, counts):
+    """one simulated user: requests maps, sometimes clicking through a few inputs in a row"""
+    for _ in range(requests):
+        burst = rng.sample(states, rng.choice([1, 1, 3]))
+        task = None
+        for state in burst:
+            if task is not None:
+                # superseded before it finished, as the app does on a new input
+                task.cancel()
+                counts["superseded"] += 1
+                await asyncio.sleep(0.02)
+            t = time.perf_counter()
+            task = asyncio.ensure_future(render_async(state, cache))
+        try:
+            await task
+        except Exception:
+            counts["failed"] += 1
+            continue
+        latencies.append(time.perf_counter() - t)
+
+
+async def _heartbeat(stop, lags, interval = 0.01):
+    """how late the event loop wakes up from short sleeps while maps render"""
+    while not stop.is_set():
+        t = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - t - interval)
+
+
+def load_test(sessions = 8, requests = 5, modes = ("plotnine",), seed = 0):
+    """
+    Simulate concurrent app sessions rendering random maps into an empty image cache.
+
+    Returns
+    -------
+    dict
+        render latency percentiles (seconds, from the last request of a burst to its image),
+        event loop lag percentiles and the number of superseded requests
+    """
+    states = all_states(modes)
+    rng = random.Random(seed)
+    latencies, lags, counts = [], [], {"superseded": 0, "failed": 0}
+    with tempfile.TemporaryDirectory() as folder:
+        cache = ImageCache(folder, image_cache.fingerprint, purge_stale = False)
+
+        async def run():
+            stop = asyncio.Event()
+            beat = asyncio.ensure_future(_heartbeat(stop, lags))
+            await asyncio.gather(*[_load_session(states, random.Random(rng.random()), requests, cache,
+                                                 latencies, counts) for _ in range(sessions)])
+            stop.set()
+            await beat
+
+        t = time.perf_counter()
+        asyncio.run(run())
+        total = time.perf_counter() - t
+    return {"sessions": sessions,
+            "renders": len(latencies),
+            "superseded": counts["superseded"],
+            "failed": counts["failed"],
+            "p50_s": round(float(np.percentile(latencies, 50)), 3),
+            "p95_s": round(float(np.percentile(latencies, 95)), 3),
+            "loop_lag_p95_ms": round(float(np.percentile(lags, 95)) * 1000, 1),
+            "loop_lag_max_ms": round(float(np.max(lags)) * 1000, 1),
+            "total_s": round(total, 1)}
+
+
+def reduction_report(crop = "corn_ddgs", com = ("cattle",), mode = "plotnine"):
+    """
+    Arc count, share of the total flow kept and render time for each arc reduction,
+    for all arc stages of one crop and commodity selection.
+    """
+    rows = []
+    stages = crop_choices[crop]["arcs"]
+    for reduction in reduction_choices:
+        view = shared.crops[crop]
+        flowarcs = build_flow_data(view["chains"], list(com), chain_steps(crop), od = view["od"],
+                                   reduction = parse_reduction(reduction))["flowarcs"]
+        arcs = [flowarcs[c][s] for c in com for s in stages]
+        state = map_state(crop, com, stages, True, "none", mode, map_level(), reduction)
+        path = tempfile.NamedTemporaryFile(suffix = ".png", delete = False).name
+        t = time.perf_counter()
+        render_state(state, path)
+        os.remove(path)
+        rows.append({"reduction": reduction,
+                     "arcs": sum(len(a) for a in arcs),
+                     "flow_share": round(sum(a["flowsize"].sum() for a in arcs) / 
+                                         sum(a["flowsize"].sum() / a.attrs["flow_share"] for a in arcs), 3),
+                     "render_s": round(time.perf_counter() - t, 3)})
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    # python map_render.py --warm [--mode plotnine --mode fast] [--workers N]
+    parser = argparse.ArgumentParser(description = "manage the rendered map image cache")
+    parser.add_argument("--warm", action = "store_true", help = "render every reachable map")
+    parser.add_argument("--clear", action = "store_true", help = "delete all cached maps first")
+    parser.add_argument("--mode", action = "append", choices = render_modes)
+    parser.add_argument("--workers", type = int, default = None)
+    parser.add_argument("--reduction-report", metavar = "CROP", help = "benchmark the arc reductions for a crop")
+    parser.add_argument("--load-test", metavar = "SESSIONS", type = int,
+                        help = "render latency with this many simulated concurrent sessions")
+    parser.add_argument("--requests", type = int, default = 5, help = "maps requested per simulated session")
+    args = parser.parse_args()
+    if args.load_test:
+        print(load_test(args.load_test, args.requests, tuple(args.mode or ["plotnine"])))
+    if args.reduction_report:
+        crop = args.reduction_report
+        com = [c for c in crop_choices[crop]["com"] if c in set(shared.fullchains[crop]["dest_final"])][:1]
+        print(reduction_report(crop, com).to_string(index = False))
+    if args.clear:
+        image_cache.clear()
+    if args.warm:
+        warm_cache(tuple(args.mode or ["plotnine"]), args.workers)
@@ -1,13 +1,157 @@
+import glob
+import os
+import threading
+import time
 from pathlib import Path
 import pandas as pd
-from utils.data_utils import get_chains
+from utils.data_utils import (get_chains, chain_columns, chain_dtypes, chain_file_coms, read_chain_csv,
+                              stream_chain_csv)
+from utils.chloro_cube import ChloroCube
+from utils.od_utils import add_positions
+from utils.chain_graph import ChainGraph
+from utils.emissions import cube_columns, intensity_ratios
+from utils.snapshot import snapshot_mode, fingerprint, load_snapshot, write_snapshot, timed
+from utils.fingerprint import data_fingerprint
+from utils.reload_utils import FileWatcher, watch, newest_mtime
+from utils.trace_utils import trace, span
 #import json
 
 chains_dir = "Chains/"
-corn_single = get_chains(chains_dir + "corn", nsteps=1)
-corn_double = get_chains(chains_dir + "ddgs", nsteps=2)
-soy = get_chains(chains_dir + "soy", nsteps = 2)
-fullchains = {'corn_direct':corn_single, 'corn_ddgs':corn_double, 'soy': soy}
+flow_dtype = os.environ.get("F3_FLOW_DTYPE", "float64")
+# load county path sums instead of every chain row, for chain files too large to hold in memory
+aggregate = os.environ.get("F3_AGGREGATE_CHAINS", "0") == "1"
+chain_steps = {'corn_direct':1, 'corn_ddgs':2, 'soy': 2}
+chain_folders = {'corn_direct':"corn", 'corn_ddgs':"ddgs", 'soy':"soy"}
+
+
+def build_state():
+    """
+    Load the chains and prepare what the map-building functions work on: county positions,
+    the chain graphs (stage OD matrices, path tracing) and the choropleth cubes.
+    """
+    with timed("chains"):
+        fullchains = {crop: get_chains(chains_dir + folder, nsteps=chain_steps[crop],
+                                       columns=chain_columns(chain_steps[crop]),
+                                       flow_dtype=flow_dtype, aggregate=aggregate)
+                      for crop, folder in chain_folders.items()}
+    with timed("positions"):
+        fullchains = {crop: add_positions(df) for crop, df in fullchains.items()}
+    with timed("graphs"):
+        chain_graphs = {crop: ChainGraph(df, chain_steps[crop]) for crop, df in fullchains.items()}
+    with timed("od_matrices"):
+        chain_od = {crop: graph.od_matrices() for crop, graph in chain_graphs.items()}
+    # flows, emissions and emission intensities per source county and commodity, for the choropleths
+    with timed("cubes"):
+        chloro_cubes = {crop: ChloroCube(df, cube_columns(chain_steps[crop]), chain_graphs[crop],
+                                         intensity_ratios(chain_steps[crop]))
+                        for crop, df in fullchains.items()}
+    return {"fullchains": fullchains, "chain_graphs": chain_graphs, "chain_od": chain_od,
+            "chloro_cubes": chloro_cubes}
+
+
+# with F3_SNAPSHOT=1 the prepared state comes from a startup snapshot (see utils.snapshot)
+snapshot_key = fingerprint([chains_dir + "*/*_full.csv"], {"flow_dtype": flow_dtype, "aggregate": aggregate})
+state = load_snapshot(snapshot_key) if snapshot_mode else None
+if state is None:
+    state = build_state()
+    if snapshot_mode:
+        with timed("snapshot_write"):
+            write_snapshot(state, snapshot_key)
+fullchains = state["fullchains"]
+chain_graphs = state["chain_graphs"]
+chain_od = state["chain_od"]
+chloro_cubes = state["chloro_cubes"]
+
+
+def chain_files(crop):
+    return sorted(glob.glob(os.path.join(chains_dir, chain_folders[crop], "*_full.csv")))
+
+
+def dest_versions(crop, dests=None):
+    """
+    {dest_final: version} of a crop's chain files, the version changing with any of the files
+    that end in that commodity; only the commodities in dests when given
+    """
+    files = {}
+    for path in chain_files(crop):
+        dest = chain_file_coms(path)[chain_steps[crop]]
+        if dests is None or dest in dests:
+            files.setdefault(dest, []).append(path)
+    return {dest: data_fingerprint(paths) for dest, paths in files.items()}
+
+
+# what the maps of a crop are built from, replaced as a whole when its chain files change
+# (see reload_crop): a render takes crops[crop] once and works on that. "versions" identify
+# the data of each destination commodity, for cache keys; "generation" counts the reloads.
+crops = {crop: {"chains": fullchains[crop], "graph": chain_graphs[crop], "od": chain_od[crop],
+                "cube": chloro_cubes[crop], "versions": dest_versions(crop), "generation": 0}
+         for crop in chain_steps}
+# called as hook(crop, dests, generation) after a crop's data was replaced
+reload_hooks = []
+_reload_lock = threading.Lock()
+
+
+def reload_crop(crop, dests):
+    """
+    Re-read the chain files of a crop that end in the destination commodities dests, keep
+    the rows of its other commodities as they are, rebuild the crop's chain graph, OD
+    matrices and choropleth cube and swap them in. Sessions keep serving the old data
+    until the swap; reload_hooks are then called to drop what was derived from it.
+    """
+    nsteps = chain_steps[crop]
+    dests = set(dests)
+    with _reload_lock:
+        old = crops[crop]
+        with span("read_chains") as attrs:
+            files = [f for f in chain_files(crop) if chain_file_coms(f)[nsteps] in dests]
+            columns = chain_columns(nsteps)
+            parts = [stream_chain_csv(f, nsteps) if aggregate else
+                     read_chain_csv(f, nsteps, usecols=set(columns).__contains__) for f in files]
+            parts = [add_positions(df.astype(chain_dtypes(df, flow_dtype))) for df in parts]
+            attrs["files"] = len(files)
+            attrs["rows"] = sum(len(df) for df in parts)
+        with span("merge_chains"):
+            kept = old["chains"][~old["chains"]["dest_final"].isin(dests)]
+            chains = pd.concat([kept, *parts], ignore_index=True)[kept.columns]
+            # concatenating categoricals with different categories leaves them as objects
+            chains = chains.astype({col: "category" for col in chains.columns
+                                    if col.endswith("_com") or col == "dest_final"})
+        with span("graph"):
+            graph = ChainGraph(chains, nsteps)
+            od = graph.od_matrices()
+        with span("cube"):
+            cube = ChloroCube(chains, cube_columns(nsteps), graph, intensity_ratios(nsteps))
+        versions = {d: v for d, v in old["versions"].items() if d not in dests}
+        versions.update(dest_versions(crop, dests))
+        generation = old["generation"] + 1
+        crops[crop] = {"chains": chains, "graph": graph, "od": od, "cube": cube,
+                       "versions": versions, "generation": generation}
+        fullchains[crop], chain_graphs[crop], chain_od[crop], chloro_cubes[crop] = chains, graph, od, cube
+        with span("invalidate"):
+            for hook in reload_hooks:
+                hook(crop, dests, generation)
+
+
+def reload_files(changed, removed):
+    """reload the crops and destination commodities of changed and removed chain files"""
+    folders = {os.path.normpath(os.path.join(chains_dir, folder)): crop for crop, folder in chain_folders.items()}
+    affected = {}
+    for path in [*changed, *removed]:
+        crop = folders.get(os.path.normpath(os.path.dirname(path)))
+        if crop is not None:
+            affected.setdefault(crop, set()).add(chain_file_coms(path)[chain_steps[crop]])
+    for crop, dests in affected.items():
+        # reload lag: from the last write of the files to the new data being served
+        written = newest_mtime(changed)
+        with trace("reload", crop=crop, com=sorted(dests)) as t:
+            reload_crop(crop, dests)
+            t.attrs["lag_s"] = round(time.time() - written, 3)
+
+
+def start_hot_reload(interval=5.0):
+    """watch the chain files and reload what changes every interval seconds (see utils.reload_utils)"""
+    watcher = FileWatcher([os.path.join(chains_dir, folder, "*_full.csv") for folder in chain_folders.values()])
+    return watch(watcher, reload_files, interval)
 
 #fs_counties = pd.read_csv("data/fs_counties.csv")['FIPS'].tolist()
 
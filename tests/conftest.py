@@ -0,0 +1,34 @@
+import glob
+import os
+import sys
+import pytest
+
+# the app runs from the repository root, which holds Chains/ and data/
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+os.chdir(root)
+
+
+# county geometry and chain files the app loads; the larger ones aren't in every checkout
+geometry_files = ["data/ConUS_county_5070.gpkg", "data/ConUS_state_5070.gpkg"]
+chain_folders = ["Chains/corn", "Chains/ddgs", "Chains/soy"]
+
+
+def _missing(paths, pattern=""):
+    return [p for p in paths if not (glob.glob(os.path.join(p, pattern)) if pattern else os.path.exists(p))]
+
+
+@pytest.fixture(scope="session")
+def geometry():
+    """skips a test when the county and state geometry aren't in data/"""
+    missing = _missing(geometry_files)
+    if missing:
+        pytest.skip(f"needs {', '.join(missing)}")
+
+
+@pytest.fixture(scope="session")
+def app_data(geometry):
+    """skips a test when a crop's chain files aren't in Chains/, as importing shared loads them all"""
+    missing = _missing(chain_folders, "*_full.csv")
+    if missing:
+        pytest.skip(f"needs chain files in {', '.join(missing)}")
@@ -0,0 +1,33 @@
+import numpy as np
+from utils.arc_cache import ArcStore, pair_keys
+from utils.flow_utils import arc_vertices
+
+
+def test_lookup_mixes_stored_and_computed_arcs(tmp_path):
+    rng = np.random.default_rng(0)
+    centroids = rng.uniform([-125, 25], [-67, 49], (50, 2))
+    centroids[7] = np.nan
+    codes = np.arange(50)
+    stored = pair_keys(codes[:20], codes[20:40])
+    ArcStore.build(centroids, np.sort(stored)).save(str(tmp_path))
+    store = ArcStore.load(folder=str(tmp_path))
+    # county 7 has no centroid: its pair isn't stored
+    assert len(store) == 19
+
+    # stored pairs, pairs outside the store, and stored pairs again, in one lookup
+    source = np.concatenate([codes[:20], codes[40:50], codes[5:10]])
+    dest = np.concatenate([codes[20:40], codes[30:40], codes[25:30]])
+    source, dest = source[source != 7], dest[source != 7]
+    p1, p2 = centroids[source], centroids[dest]
+    verts = store.lookup(source, dest, p1, p2)
+    assert verts.shape == (33, 25, 2)
+    # the store keeps float32 vertices
+    np.testing.assert_allclose(verts, arc_vertices(p1, p2), rtol=0, atol=1e-4)
+    np.testing.assert_array_equal(verts[19:29], arc_vertices(p1[19:29], p2[19:29]))
+
+
+def test_build_skips_unknown_and_coincident_points():
+    centroids = np.array([[-90.0, 40.0], [np.nan, np.nan], [-85.0, 42.0]])
+    keys = pair_keys([0, 0, 0, 2, 5], [1, 0, 2, 0, 0])
+    store = ArcStore.build(centroids, np.sort(keys))
+    assert sorted(store.keys.tolist()) == sorted(pair_keys([0, 2], [2, 0]).tolist())
@@ -0,0 +1,86 @@
+import itertools
+import numpy as np
+import pytest
+from utils.bin_utils import bin_edges, classify, jenks_edges, log_edges, round_edges
+
+
+def test_classify_is_right_closed():
+    edges = np.array([1.0, 10.0, 100.0, 1000.0])
+    values = [1.0, 5.0, 10.0, 10.5, 100.0, 1000.0]
+    assert classify(values, edges).tolist() == [0, 0, 0, 1, 1, 2]
+
+
+def test_classify_clips_to_the_first_and_last_class():
+    # the minimum on a round first edge and values past the rounded top edge used to be left
+    # unbinned by pd.cut and put in class 2; they now go in the first and last class
+    edges = np.array([100.0, 200.0, 300.0, 400.0, 500.0])
+    assert classify([100.0, 50.0, 500.0, 501.0, 1e9], edges).tolist() == [0, 0, 3, 3, 3]
+    assert classify([1.0, 2.0], np.array([1.0])).tolist() == [0, 0]
+
+
+def test_round_edges():
+    np.testing.assert_allclose(round_edges([312.0, 0.027, 9.99, 0.0, -4.5]), [300.0, 0.02, 9.0, 0.0, -4.5])
+
+
+def test_quantile_edges_keep_the_data_range():
+    values = np.arange(1.0, 1001.0)
+    edges = bin_edges(values, 4)
+    assert edges.tolist() == [1.0, 200.0, 500.0, 700.0, 1000.0]
+    # the top value is in the last class and the bottom one in the first
+    codes = classify(values, edges)
+    assert codes[0] == 0 and codes[-1] == 3
+    assert np.bincount(codes).tolist() == [200, 300, 200, 300]
+
+
+def test_bin_edges_edge_cases():
+    assert bin_edges([], 4).tolist() == [0.0]
+    assert bin_edges([np.nan, 3.0, np.inf], 4).tolist() == [3.0]
+    assert bin_edges([5.0, 5.0, 5.0], 4).tolist() == [5.0]
+    np.testing.assert_allclose(bin_edges([1.0, 2.0], 4, "fixed", reference=np.arange(1.0, 1001.0)),
+                               [1.0, 200.0, 500.0, 700.0, 1000.0])
+    with pytest.raises(ValueError):
+        bin_edges([1.0, 2.0], 4, "fixed")
+    with pytest.raises(ValueError):
+        bin_edges([1.0, 2.0], 4, "equal")
+
+
+def test_log_edges():
+    np.testing.assert_allclose(log_edges(np.array([0.0, 1.0, 10.0, 1e4]), 4), [0.0, 10.0, 100.0, 1e3, 1e4])
+
+
+def test_jenks_finds_clusters():
+    values = np.array([1.0, 2.0, 3.0, 10.0, 11.0, 12.0, 100.0, 101.0, 1000.0])
+    assert jenks_edges(values, 4).tolist() == [1.0, 3.0, 12.0, 101.0, 1000.0]
+
+
+def sse(values, edges):
+    """squared deviation from the class means of values classed by upper class edges"""
+    codes = np.searchsorted(edges[1:-1], values, side="left")
+    return sum(((values[codes == c] - values[codes == c].mean())**2).sum() for c in np.unique(codes))
+
+
+def brute_force_sse(values, k):
+    distinct = np.unique(values)
+    best = np.inf
+    for cuts in itertools.combinations(range(len(distinct) - 1), k - 1):
+        edges = np.concatenate([[distinct[0]], distinct[list(cuts)], [distinct[-1]]])
+        best = min(best, sse(values, edges))
+    return best
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_jenks_matches_brute_force(seed):
+    rng = np.random.default_rng(seed)
+    values = np.round(rng.lognormal(2, 1, rng.integers(6, 12)), 1)
+    k = rng.integers(2, 5)
+    edges = jenks_edges(values, k)
+    assert len(edges) == min(k, len(np.unique(values))) + 1
+    assert sse(values, edges) == pytest.approx(brute_force_sse(values, k))
+
+
+def test_jenks_on_many_values_uses_data_values():
+    values = np.random.default_rng(0).lognormal(5, 2, 100_000)
+    edges = jenks_edges(values, 4)
+    assert len(edges) == 5 and np.all(np.diff(edges) > 0)
+    assert np.isin(edges, values).all()
+    assert np.bincount(classify(values, bin_edges(values, 4, "jenks"))).min() > 0
@@ -0,0 +1,55 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+from utils import ref_data
+from utils.bin_utils import bin_edges, classify
+from utils.chloro_cube import ChloroCube
+from utils.map_utils import build_chloro
+
+columns = ["flow_kg_0", "emission_0", "flow_kg_1", "emission_1", "emission_total"]
+ratios = {"intensity_0": ("emission_0", "flow_kg_0"), "intensity_total": ("emission_total", "flow_kg_0")}
+
+
+@pytest.fixture(scope="module")
+def chains(geometry):
+    """chain rows from 300 counties to three commodities, with some unknown source counties"""
+    rng = np.random.default_rng(0)
+    n = 5000
+    sources = np.append(rng.choice(ref_data.county_fips, 300, replace=False), [99998, 99999])
+    df = pd.DataFrame({"source_FIPS_0": rng.choice(sources, n).astype("int32"),
+                       "dest_final": pd.Categorical(rng.choice(["hog", "broiler", "cattle"], n))})
+    for col in columns:
+        df[col] = rng.lognormal(5, 1, n)
+    return df
+
+
+def dataframe_chloro(df, column, com, source_counties=None):
+    """the groupby and merge on the chain table that the cube replaces"""
+    rows = df[df["dest_final"].isin(com)]
+    if source_counties is not None:
+        rows = rows[rows["source_FIPS_0"].isin(source_counties)]
+    sums = rows.groupby("source_FIPS_0")[columns].sum()
+    if column in ratios:
+        num, den = ratios[column]
+        sums[column] = sums[num] / sums[den]
+    sums = sums[[column]].reset_index()
+    return gpd.GeoDataFrame(pd.merge(sums, ref_data.county_poly, left_on="source_FIPS_0", right_on="GEOID",
+                                     how="inner"))
+
+
+@pytest.mark.parametrize("column", ["flow_kg_0", "emission_total", "intensity_0", "intensity_total"])
+@pytest.mark.parametrize("filtered", [False, True])
+def test_cube_matches_dataframe(chains, column, filtered):
+    cubes = {"soy": ChloroCube(chains, columns, ratios=ratios)}
+    com = ["hog", "cattle"]
+    counties = np.unique(chains["source_FIPS_0"])[::3] if filtered else None
+    expected = dataframe_chloro(chains, column, com, counties).sort_values("source_FIPS_0")
+    map_data = build_chloro(cubes, "soy", column, com, source_counties=counties).sort_values("source_FIPS_0")
+    assert map_data["source_FIPS_0"].tolist() == expected["source_FIPS_0"].tolist()
+    np.testing.assert_allclose(map_data[column], expected[column], rtol=1e-12)
+    assert map_data.geometry.geom_equals(expected.geometry.set_axis(map_data.index)).all()
+    # sums are taken in a different order, so the outer edges (the extreme values) may differ in the last digit
+    edges = bin_edges(expected[column], 4)
+    np.testing.assert_allclose(map_data.attrs["bin_edges"], edges, rtol=1e-12)
+    np.testing.assert_array_equal(map_data["colorbin"].cat.codes, classify(expected[column], edges))
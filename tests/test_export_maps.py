@@ -0,0 +1,24 @@
+import pytest
+
+
+@pytest.fixture(scope="module")
+def export_maps(app_data):
+    import export_maps
+    return export_maps
+
+
+def test_modes_expand_to_distinct_names(export_maps):
+    spec = {**export_maps.spec_defaults,
+            "figures": [{"crop": "corn_ddgs", "com": ["cattle"], "arcs": [0], "mode": ["plotnine", "fast"]}]}
+    figures = export_maps.expand(spec)
+    names = [name for name, _ in figures]
+    assert len(names) == len(set(names)) == 2
+    assert sorted(state["mode"] for _, state in figures) == ["fast", "plotnine"]
+    assert all(name.endswith("_" + state["mode"]) for name, state in figures)
+
+
+def test_default_mode_keeps_its_name(export_maps):
+    spec = {**export_maps.spec_defaults, "figures": [{"crop": "corn_ddgs", "com": ["cattle"], "arcs": [0]},
+                                                     {"crop": "corn_ddgs", "com": ["hog"], "mode": "fast"}]}
+    assert [name for name, _ in export_maps.expand(spec)] == \
+           ["corn_ddgs_cattle_arcs0_scaled_quantile0.1", "corn_ddgs_hog_noarcs_fast"]
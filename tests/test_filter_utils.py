@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+import pytest
+from utils import ref_data
+from utils.filter_utils import FilterRegistry
+
+
+def test_combine_names_are_canonical():
+    assert FilterRegistry.combine(["b", "a"]) == FilterRegistry.combine(["a", "b", "a"]) == "a+b"
+    assert FilterRegistry.combine(["b", "a"], "&") == "a&b"
+    assert FilterRegistry.combine(["none", "a"]) == "a"
+    assert FilterRegistry.combine(["none"]) == FilterRegistry.combine([]) == "none"
+
+
+@pytest.fixture
+def registry(tmp_path, geometry):
+    """a registry with two overlapping filter files"""
+    fips = ref_data.county_fips
+    pd.DataFrame({"FIPS": fips[:30]}).to_csv(tmp_path / "a_counties.csv", index=False)
+    pd.DataFrame({"FIPS": fips[20:50]}).to_csv(tmp_path / "b_counties.csv", index=False)
+    return FilterRegistry(str(tmp_path), max_uploads=2)
+
+
+def test_union_and_intersection_masks(registry):
+    fips = ref_data.county_fips
+    assert registry.names() == ["a_counties", "b_counties"]
+    assert registry.mask("none") is None
+    assert registry.counties("a_counties+b_counties").tolist() == fips[:50].tolist()
+    assert registry.counties("a_counties&b_counties").tolist() == fips[20:30].tolist()
+    with pytest.raises(KeyError):
+        registry.mask("c_counties")
+
+
+def test_rows_and_apply(registry):
+    pos = np.array([0, 25, 40, 60, -1, 25], dtype=np.int32)
+    chains = pd.DataFrame({"source_pos_0": pos, "flow_kg_0": np.arange(6.0)})
+    assert registry.rows("a_counties&b_counties", "corn", chains).tolist() == [1, 5]
+    assert registry.apply("a_counties", "corn", chains)["flow_kg_0"].tolist() == [0.0, 1.0, 5.0]
+    assert registry.apply("none", "corn", chains) is chains
+
+
+def test_uploads_are_named_by_content_and_bounded(registry):
+    fips = ref_data.county_fips
+    first = registry.add([fips[5], fips[3], fips[5]])
+    assert registry.add([fips[3], fips[5]]) == first
+    assert registry.counties(first).tolist() == [fips[3], fips[5]]
+    assert registry.counties(f"a_counties&{first}").tolist() == [fips[3], fips[5]]
+    assert first not in registry.names()
+    second = registry.add(fips[100:110])
+    registry.add([fips[3], fips[5]])  # marks first as recently used
+    third = registry.add(fips[200:210])
+    # max_uploads is 2: the least recently used list is dropped, the filter files stay
+    with pytest.raises(KeyError):
+        registry.mask(second)
+    assert registry.counties(first).tolist() == [fips[3], fips[5]]
+    assert len(registry.counties(third)) == 10
+    assert registry.mask("a_counties") is not None
+    # adding it again brings it back
+    assert registry.counties(registry.add(fips[100:110])).tolist() == fips[100:110].tolist()
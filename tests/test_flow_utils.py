@@ -0,0 +1,91 @@
+import math
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+from shapely.geometry import Point
+from utils.flow_utils import Pt, arc, arc_vertices, build_arcs
+
+
+def scalar_arcs(p1, p2, theta=np.pi/3, n=25):
+    """arc() for each pair, shape (n_arcs, n, 2)"""
+    return np.array([np.column_stack(arc(Pt(*a), Pt(*b), theta, n)) for a, b in zip(p1, p2)])
+
+
+# pairs in every direction, including the ones arc() swaps (right and down) and
+# vertical/horizontal pairs where angle() takes its dx == 0 and dy == 0 branches
+pairs = [
+    ((-90.0, 40.0), (-85.0, 42.0)),   # right and up
+    ((-90.0, 42.0), (-85.0, 40.0)),   # right and down: swapped
+    ((-85.0, 40.0), (-90.0, 42.0)),   # left and up
+    ((-85.0, 42.0), (-90.0, 40.0)),   # left and down
+    ((-90.0, 40.0), (-90.0, 45.0)),   # straight up
+    ((-90.0, 45.0), (-90.0, 40.0)),   # straight down
+    ((-95.0, 40.0), (-80.0, 40.0)),   # straight right
+    ((-80.0, 40.0), (-95.0, 40.0)),   # straight left
+    ((-120.5, 47.3), (-71.1, 42.4)),  # across the country, right and down
+]
+
+
+@pytest.mark.parametrize("theta, n", [(np.pi/3, 25), (np.pi/2, 10), (np.pi/6, 40)])
+def test_arc_vertices_match_scalar_arc(theta, n):
+    p1 = np.array([a for a, _ in pairs])
+    p2 = np.array([b for _, b in pairs])
+    np.testing.assert_allclose(arc_vertices(p1, p2, theta, n), scalar_arcs(p1, p2, theta, n),
+                               rtol=0, atol=1e-9)
+
+
+def test_arc_vertices_random_pairs():
+    rng = np.random.default_rng(0)
+    p1 = rng.uniform([-125, 25], [-67, 49], (500, 2))
+    p2 = rng.uniform([-125, 25], [-67, 49], (500, 2))
+    np.testing.assert_allclose(arc_vertices(p1, p2), scalar_arcs(p1, p2), rtol=0, atol=1e-9)
+
+
+def test_swapped_pair_runs_from_p2():
+    # right and down is drawn from the end point back to the start point, as arc() does
+    verts = arc_vertices([(-90.0, 42.0)], [(-85.0, 40.0)])[0]
+    np.testing.assert_allclose(verts[0], (-85.0, 40.0), atol=1e-9)
+    np.testing.assert_allclose(verts[-1], (-90.0, 42.0), atol=1e-9)
+
+
+def test_coincident_points_raise():
+    with pytest.raises(ValueError):
+        arc_vertices([(-90.0, 40.0)], [(-90.0, 40.0)])
+
+
+def scalar_build_arcs(flow_data, source_point_dict, dest_point_dict):
+    """the per-row build_arcs loop that arc_vertices replaced"""
+    rows = []
+    for source, dest, flow_size in flow_data.itertuples(index=False):
+        if source == dest or source not in source_point_dict or dest not in dest_point_dict:
+            continue
+        sloc, dloc = source_point_dict[source], dest_point_dict[dest]
+        x, y = arc(Pt(sloc.x, sloc.y), Pt(dloc.x, dloc.y))
+        rows.append((source, dest, flow_size, np.column_stack([x, y])))
+    return rows
+
+
+def test_build_arcs_matches_scalar_loop():
+    points = {1001: Point(-86.6, 32.5), 1003: Point(-87.7, 30.7), 19153: Point(-93.6, 41.7),
+              17031: Point(-87.7, 41.8), 48201: Point(-95.4, 29.8)}
+    flow_data = pd.DataFrame({"source": [1001, 1001, 19153, 17031, 48201, 19153, 99999],
+                              "dest":   [1003, 1001, 17031, 48201, 19153, 1003, 1001],
+                              "flow":   [5.0, 9.0, 3.0, 2.0, 7.0, 1.0, 4.0]})
+    arcs = build_arcs(flow_data, points, points)
+    expected = scalar_build_arcs(flow_data, points, points)
+    # the source == dest row and the row with an unknown county are skipped
+    assert len(arcs) == len(expected) == 5
+    assert arcs["source"].tolist() == [e[0] for e in expected]
+    assert arcs["dest"].tolist() == [e[1] for e in expected]
+    assert arcs["flowsize"].tolist() == [e[2] for e in expected]
+    for geom, (_, _, _, verts) in zip(arcs.geometry, expected):
+        np.testing.assert_allclose(shapely.get_coordinates(geom), verts, rtol=0, atol=1e-9)
+
+
+def test_build_arcs_warns_about_missing_points():
+    points = {1001: Point(-86.6, 32.5), 1003: Point(), 19153: Point(-93.6, 41.7)}
+    flow_data = pd.DataFrame({"source": [1001, 1003, 19153], "dest": [19153, 1001, 1001], "flow": [1.0, 2.0, 3.0]})
+    with pytest.warns(UserWarning, match=r"FIPS \[1003\]"):
+        arcs = build_arcs(flow_data, points, points)
+    assert arcs["source"].tolist() == [1001, 19153]
@@ -0,0 +1,108 @@
+import numpy as np
+import pytest
+import scipy.sparse as sp
+from utils import ref_data
+from utils.od_utils import flow_od_selection, parse_reduction, select_flows
+
+
+def test_parse_reduction():
+    assert parse_reduction("quantile:0.1") == ("quantile", 0.1)
+    assert parse_reduction("topk:25") == ("topk", 25)
+    assert isinstance(parse_reduction("topk:25")[1], int)
+    assert parse_reduction("share:0.95") == ("share", 0.95)
+    assert parse_reduction("state") == ("state", None)
+    assert parse_reduction("grid:2") == ("grid", 2.0)
+    with pytest.raises(ValueError):
+        parse_reduction("largest:5")
+
+
+flows = np.array([5.0, 1.0, 8.0, 2.0, 8.0, 3.0, 0.5, 12.0])
+
+
+def test_select_topk_keeps_the_largest():
+    assert np.flatnonzero(select_flows(flows, "topk", 3)).tolist() == [2, 4, 7]
+    assert select_flows(flows, "topk", 100).all()
+
+
+def test_select_share_keeps_the_flows_that_reach_it():
+    # 12 + 8 + 8 = 28 of 39.5 is below 0.75; the 5 that crosses it is kept, nothing smaller
+    keep = select_flows(flows, "share", 0.75)
+    assert np.flatnonzero(keep).tolist() == [0, 2, 4, 7]
+    assert flows[keep].sum() >= 0.75 * flows.sum() > flows[keep].sum() - flows[keep].min()
+    assert select_flows(flows, "share", 1.0).all()
+
+
+def test_select_quantile_drops_the_bottom():
+    keep = select_flows(flows, "quantile", 0.25)
+    assert (flows[keep] > np.quantile(flows, 0.25)).all()
+    assert keep.sum() == 6
+
+
+@pytest.fixture(scope="module")
+def od(geometry):
+    """county flows between 60 counties, including flows within a county"""
+    rng = np.random.default_rng(1)
+    n = len(ref_data.county_fips)
+    pos = rng.choice(n, 60, replace=False)
+    s, d = rng.choice(pos, 400), rng.choice(pos, 400)
+    s[:20] = d[:20]
+    return sp.coo_matrix((rng.lognormal(3, 1, 400), (s, d)), shape=(n, n)).tocsr()
+
+
+def between(od, group):
+    """flow between different groups of county positions, {(source group, dest group): flow}"""
+    od = od.tocoo()
+    out = {}
+    for i, j, f in zip(group[od.row], group[od.col], od.data):
+        if i != j:
+            out[(i, j)] = out.get((i, j), 0.0) + f
+    return out
+
+
+def inter_county_total(od):
+    od = od.tocoo()
+    return od.data[od.row != od.col].sum()
+
+
+def test_topk_selection(od):
+    sel = flow_od_selection(od, reduction=("topk", 25))
+    assert len(sel["source"]) == 25
+    assert (sel["source"] != sel["dest"]).all()
+    inter = od.tocoo().data[od.tocoo().row != od.tocoo().col]
+    np.testing.assert_allclose(np.sort(sel["flowsize"]), np.sort(inter)[-25:])
+    assert sel["flow_share"] == pytest.approx(sel["flowsize"].sum() / inter_county_total(od))
+
+
+def test_share_selection(od):
+    sel = flow_od_selection(od, reduction=("share", 0.8))
+    total = inter_county_total(od)
+    assert sel["flow_share"] >= 0.8
+    assert sel["flowsize"].sum() - sel["flowsize"].min() < 0.8 * total
+
+
+def test_quantile_selection(od):
+    sel = flow_od_selection(od, 0.25)
+    assert sel["counties"]
+    assert (sel["source"] != sel["dest"]).all()
+    assert (sel["flowsize"] > np.quantile(od.tocoo().data, 0.25)).all()
+    assert flow_od_selection(od, reduction=("quantile", 0.25))["flowsize"].tolist() == sel["flowsize"].tolist()
+
+
+def test_state_selection(od):
+    sel = flow_od_selection(od, reduction=("state", None))
+    states = ref_data.county_fips // 1000
+    expected = between(od, states)
+    assert not sel["counties"]
+    assert dict(zip(zip(sel["source"].tolist(), sel["dest"].tolist()), sel["flowsize"])) == pytest.approx(expected)
+    np.testing.assert_allclose(sel["p1"], ref_data.state_centroids[sel["source"]])
+    assert sel["flow_share"] == pytest.approx(sum(expected.values()) / inter_county_total(od))
+
+
+def test_grid_selection(od):
+    sel = flow_od_selection(od, reduction=("grid", 2.0))
+    xy = ref_data.county_centroids[ref_data.county_fips]
+    cells = np.floor(xy / 2.0).astype(np.int64)
+    expected = between(od, cells[:, 0] * 100000 + cells[:, 1])
+    assert len(sel["source"]) == len(expected)
+    assert sel["flowsize"].sum() == pytest.approx(sum(expected.values()))
+    assert sorted(sel["flowsize"]) == pytest.approx(sorted(expected.values()))
@@ -0,0 +1,40 @@
+import pandas as pd
+import pytest
+from geopandas.testing import assert_geodataframe_equal
+from utils.chain_graph import ChainGraph
+from utils.data_utils import chain_dtypes, read_chain_csvs
+from utils.map_utils import build_flow_data
+from utils.od_utils import add_positions
+from utils.parallel_utils import pool_map
+
+corn = "Chains/corn"
+
+
+def test_pool_map_keeps_order():
+    assert pool_map(abs, range(-20, 0), 2) == pool_map(abs, range(-20, 0), 0) == list(range(20, 0, -1))
+
+
+def test_read_chain_csvs_parallel_matches_serial():
+    pd.testing.assert_frame_equal(read_chain_csvs(corn, 1, workers=2), read_chain_csvs(corn, 1, workers=0))
+
+
+@pytest.fixture(scope="module")
+def corn_chains(geometry):
+    df = read_chain_csvs(corn, 1, workers=0)
+    df = add_positions(df.astype(chain_dtypes(df)))
+    return df, ChainGraph(df, 1).od_matrices()
+
+
+@pytest.mark.parametrize("reduction", [("quantile", 0.1), ("topk", 50), ("share", 0.9), ("state", None),
+                                       ("grid", 2.0)])
+def test_flow_data_parallel_matches_serial(corn_chains, reduction):
+    df, od = corn_chains
+    com = ["hog", "cattle", "ddgs"]
+    serial = build_flow_data(df, com, steps=1, od=od, reduction=reduction, workers=0)["flowarcs"]
+    parallel = build_flow_data(df, com, steps=1, od=od, reduction=reduction, workers=2)["flowarcs"]
+    assert list(parallel) == list(serial) == com
+    for c in com:
+        for p, s in zip(parallel[c], serial[c], strict=True):
+            assert len(s) > 0
+            assert_geodataframe_equal(p, s)
+            assert p.attrs == s.attrs
@@ -0,0 +1,111 @@
+import glob
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# rows kept of each chain file in the test's copy
+sample_rows = 400
+
+
+def write_chains(folder):
+    """
+    A small Chains/ folder: the first rows of the repository's corn and DDGS chain files, and
+    soy files made from the DDGS ones (two-stage chains too), so the test needs no soy data
+    """
+    for path in glob.glob(os.path.join(repo, "Chains", "corn", "*_full.csv")) + \
+            glob.glob(os.path.join(repo, "Chains", "ddgs", "*_full.csv")):
+        out = folder / os.path.basename(os.path.dirname(path))
+        out.mkdir(parents=True, exist_ok=True)
+        pd.read_csv(path, nrows=sample_rows).to_csv(out / os.path.basename(path), index=False)
+    ddgs = pd.read_csv(glob.glob(os.path.join(repo, "Chains", "ddgs", "*_full.csv"))[0], nrows=2 * sample_rows)
+    (folder / "soy").mkdir()
+    ddgs.iloc[:sample_rows].to_csv(folder / "soy" / "soy-meal-hog_full.csv", index=False)
+    ddgs.iloc[sample_rows:].to_csv(folder / "soy" / "soy-meal-broiler_full.csv", index=False)
+
+
+@pytest.fixture
+def shared(tmp_path, monkeypatch, geometry):
+    """shared, imported fresh on a small copy of the chain files, with the repository's data/ linked in"""
+    write_chains(tmp_path / "Chains")
+    os.symlink(os.path.join(repo, "data"), tmp_path / "data")
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("F3_SNAPSHOT", "0")
+    monkeypatch.delitem(sys.modules, "shared", raising=False)
+    import shared
+    yield shared
+    sys.modules.pop("shared", None)
+
+
+def sorted_chains(df):
+    df = df.astype({col: str for col in df.columns if df[col].dtype.name == "category"})
+    return df.sort_values(list(df.columns)).reset_index(drop=True)
+
+
+def assert_same_crop(view, state, crop):
+    """a reloaded crop view holds what building the state from the files gives"""
+    pd.testing.assert_frame_equal(sorted_chains(view["chains"]), sorted_chains(state["fullchains"][crop]),
+                                  check_like=True)
+    fresh_od = state["chain_od"][crop]
+    assert sorted(view["od"]) == sorted(fresh_od)
+    for com, stages in fresh_od.items():
+        for reloaded, fresh in zip(view["od"][com], stages):
+            np.testing.assert_allclose(reloaded.toarray(), fresh.toarray())
+    cube, fresh_cube = view["cube"], state["chloro_cubes"][crop]
+    assert cube.dest_final == fresh_cube.dest_final
+    np.testing.assert_array_equal(cube.rows, fresh_cube.rows)
+    for col, sums in fresh_cube.sums.items():
+        np.testing.assert_allclose(cube.sums[col], sums)
+
+
+def test_reload_rewritten_and_removed_files(shared):
+    hog = os.path.join("Chains", "soy", "soy-meal-hog_full.csv")
+    broiler = os.path.join("Chains", "soy", "soy-meal-broiler_full.csv")
+    before = shared.crops["soy"]
+    calls = []
+    shared.reload_hooks.append(lambda crop, dests, generation: calls.append((crop, dests, generation)))
+
+    # a new model run: fewer hog chains with more flow, and no broiler chains at all
+    df = pd.read_csv(hog)
+    df = df.iloc[::2].assign(flow_kg_0=lambda d: d["flow_kg_0"] * 2)
+    df.to_csv(hog, index=False)
+    os.remove(broiler)
+    shared.reload_files([hog], [broiler])
+
+    view = shared.crops["soy"]
+    assert view is not before
+    assert view["generation"] == before["generation"] + 1
+    assert calls == [("soy", {"hog", "broiler"}, view["generation"])]
+    assert set(view["versions"]) == {"hog"}
+    assert view["versions"]["hog"] != before["versions"]["hog"]
+    assert "broiler" not in set(view["chains"]["dest_final"])
+    # the module-level dicts follow the swap
+    assert shared.fullchains["soy"] is view["chains"]
+    assert shared.chain_od["soy"] is view["od"]
+    assert shared.chloro_cubes["soy"] is view["cube"]
+    # the other crops are left as they were
+    assert shared.crops["corn_direct"]["generation"] == 0
+
+    # reload latency is recorded with the reload's trace
+    from utils import trace_utils
+    record = trace_utils.last(crop="soy")
+    assert record["name"] == "reload" and record["attrs"]["lag_s"] >= 0
+    assert [s["name"] for s in record["spans"]] == ["read_chains", "merge_chains", "graph", "cube", "invalidate"]
+
+    assert_same_crop(view, shared.build_state(), "soy")
+
+
+def test_reload_one_commodity_keeps_the_others(shared):
+    cattle = os.path.join("Chains", "corn", "corn-cattle_feed_full.csv")
+    before = shared.crops["corn_direct"]
+    df = pd.read_csv(cattle)
+    df.iloc[:-10].to_csv(cattle, index=False)
+    shared.reload_files([cattle], [])
+
+    view = shared.crops["corn_direct"]
+    assert view["versions"]["cattle"] != before["versions"]["cattle"]
+    assert {c: v for c, v in view["versions"].items() if c != "cattle"} == \
+           {c: v for c, v in before["versions"].items() if c != "cattle"}
+    assert_same_crop(view, shared.build_state(), "corn_direct")
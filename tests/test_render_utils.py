@@ -0,0 +1,76 @@
+import matplotlib.image as mimage
+import numpy as np
+import pandas as pd
+import pytest
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import PathCollection
+from matplotlib.figure import Figure
+from shapely.geometry import MultiPolygon, Polygon
+from utils import ref_data
+from utils.flow_utils import arcs_frame
+from utils.map_utils import chloro_map, fill_gradients
+from utils.render_utils import FastRenderer, polygon_paths
+
+
+@pytest.fixture(scope="module")
+def fixture_map(geometry):
+    """every county in one of four classes, with 200 random county to county arcs"""
+    level = ref_data.pick_level(1000)
+    counties = ref_data.poly_level("county", level)
+    mapdata = counties.assign(source_FIPS_0=counties["GEOID"],
+                              colorbin=pd.Categorical.from_codes(counties["GEOID"].to_numpy() % 4,
+                                                                 categories=range(4)))
+    fips = ref_data.county_fips
+    xy = ref_data.county_centroids[fips]
+    rng = np.random.default_rng(0)
+    i, j = rng.choice(len(fips), 200), rng.choice(len(fips), 200)
+    keep = i != j
+    arcs = arcs_frame(fips[i[keep]], fips[j[keep]], rng.uniform(1, 10, keep.sum()), xy[i[keep]], xy[j[keep]])
+    return level, mapdata, arcs
+
+
+def render_both(tmp_path, level, mapdata, arcs, arc_size):
+    """(plotnine image, fast image); how long each takes is in benchmark.py's render stages"""
+    p9, fast = str(tmp_path / "plotnine.png"), str(tmp_path / "fast.png")
+    chloro_map(mapdata, {"hog": [arcs]}, [("hog", 0, "#a36978")], "corn", arc_size, level).save(
+        p9, dpi=100, verbose=False)
+    FastRenderer(level=level).render(fast, mapdata, fill_gradients["corn"], [(arcs, "#a36978", arc_size)])
+    return mimage.imread(p9)[..., :3], mimage.imread(fast)[..., :3]
+
+
+@pytest.mark.parametrize("arc_size", ["fixed", "scaled"])
+def test_fast_render_matches_plotnine(tmp_path, fixture_map, arc_size):
+    a, b = render_both(tmp_path, *fixture_map, arc_size)
+    assert a.shape == b.shape
+    diff = np.abs(a - b)
+    # anti-aliasing and line joins differ a little; a shifted panel or a missing layer doesn't pass
+    assert diff.mean() < 0.02
+    assert (diff.max(axis=-1) > 0.25).mean() < 0.02
+
+
+def test_fast_render_panel_fits_arcs(tmp_path, fixture_map):
+    level, mapdata, arcs = fixture_map
+    renderer = FastRenderer(level=level)
+    renderer.render(str(tmp_path / "map.png"), mapdata, fill_gradients["corn"], [(arcs, "#a36978", "fixed")])
+    ymax = renderer.ax.get_ylim()[1]
+    assert ymax > arcs.total_bounds[3]
+    # and back to the map's own extent without arcs
+    renderer.render(str(tmp_path / "map.png"), mapdata, fill_gradients["corn"])
+    assert renderer.ax.get_ylim()[1] < ymax
+
+
+def test_polygon_paths_leave_holes_open():
+    shapes = [Polygon([(0, 0), (4, 0), (4, 4), (0, 4)], [[(1, 1), (1, 3), (3, 3), (3, 1)]]),
+              MultiPolygon([Polygon([(5, 0), (6, 0), (6, 1)]), Polygon([(7, 0), (8, 0), (8, 1)])])]
+    paths, owner = polygon_paths(shapes)
+    assert owner.tolist() == [0, 1, 1]
+    fig = Figure(figsize=(1, 1), dpi=40)
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.set_xlim(0, 4)
+    ax.set_ylim(0, 4)
+    ax.add_collection(PathCollection(paths[:1], facecolors="red", linewidths=0))
+    canvas.draw()
+    image = np.asarray(canvas.buffer_rgba())
+    assert tuple(image[20, 20, :3]) == (255, 255, 255)  # the hole
+    assert tuple(image[2, 2, :3]) == (255, 0, 0)        # the polygon
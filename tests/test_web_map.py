@@ -0,0 +1,13 @@
+import numpy as np
+from shapely.geometry import MultiPolygon, Polygon
+from utils.web_map import _rings, quantum
+
+
+def test_rings_keep_holes():
+    shapes = [Polygon([(0, 0), (4, 0), (4, 4), (0, 4)], [[(1, 1), (1, 3), (3, 3), (3, 1)]]),
+              MultiPolygon([Polygon([(5, 0), (6, 0), (6, 1)]), Polygon([(7, 0), (8, 0), (8, 1)])])]
+    xy, offsets, owner = _rings(shapes)
+    # the square and its hole belong to the first shape, both triangles to the second
+    assert owner.tolist() == [0, 0, 1, 1]
+    assert offsets.tolist() == [0, 5, 10, 14, 18]
+    np.testing.assert_array_equal(xy[5:10] * quantum, [(1, 1), (1, 3), (3, 3), (3, 1), (1, 1)])
@@ -0,0 +1,164 @@
+import glob
+import os
+import threading
+import time
+import numpy as np
+import pandas as pd
+from utils.flow_utils import arc_vertices
+from utils.trace_utils import span
+
+# precomputed flow arcs between county centroids, keyed by (source FIPS, dest FIPS, theta, n)
+# the store is rebuilt whenever the county geometry it was computed from changes
+
+cache_dir = "data/cache/"
+chains_dir = "Chains/"
+county_file = "data/ConUS_county_5070.gpkg"
+
+
+def pair_keys(source, dest):
+    """pack (source, dest) code pairs into single int64 keys"""
+    return (np.asarray(source, dtype=np.int64) << 32) | np.asarray(dest, dtype=np.int64)
+
+
+def chain_pairs(folderpath=chains_dir):
+    """
+    Collect every FIPS-to-FIPS origin/destination pair drawn by flow_components
+    from all "*_full.csv" chain files below folderpath.
+
+    Returns
+    -------
+    np.ndarray
+        sorted unique int64 pair keys (see pair_keys)
+    """
+    keys = []
+    for name in glob.glob(os.path.join(folderpath, "*", "*_full.csv")):
+        df = pd.read_csv(name, usecols=lambda c: c.startswith(("source_FIPS_0", "destination_FIPS_")))
+        nodes = ["source_FIPS_0"] + sorted(c for c in df.columns if c.startswith("destination_FIPS_"))
+        for s, d in zip(nodes[:-1], nodes[1:]):
+            keys.append(pair_keys(df[s], df[d]))
+    if not keys:
+        return np.empty(0, dtype=np.int64)
+    return np.unique(np.concatenate(keys))
+
+
+class ArcStore:
+    """
+    Precomputed arc vertices for a fixed theta and n, looked up by (source, dest) pair.
+
+    Vertices of the precomputed pairs live in one float32 array of shape (n_pairs, n, 2),
+    memory-mapped from disk, indexed by the sorted pair keys. Pairs outside the store
+    (e.g. ones that only show up after filtering) are computed on demand, all of a
+    lookup's in one arc_vertices batch.
+    """
+
+    def __init__(self, keys, verts, theta=np.pi/3, n=25):
+        self.keys = keys
+        self.verts = verts
+        self.theta = theta
+        self.n = n
+
+    def __len__(self):
+        return len(self.keys)
+
+    @classmethod
+    def build(cls, centroids, keys, theta=np.pi/3, n=25):
+        """
+        compute the arcs for all pair keys whose end points are known: centroids is an
+        array of (x, y) indexed by code, NaN for unknown codes (see ref_data.county_centroids)
+        """
+        source, dest = keys >> 32, keys & 0xFFFFFFFF
+        inside = (source < len(centroids)) & (dest < len(centroids))
+        keys, source, dest = keys[inside], source[inside], dest[inside]
+        p1, p2 = centroids[source], centroids[dest]
+        found = (source != dest) & ~np.isnan(p1).any(axis=1) & ~np.isnan(p2).any(axis=1)
+        verts = arc_vertices(p1[found], p2[found], theta, n).astype(np.float32)
+        return cls(keys[found], verts, theta, n)
+
+    @staticmethod
+    def paths(theta, n, folder=cache_dir):
+        stem = os.path.join(folder, f"arcs_theta{theta:.6f}_n{n}")
+        return stem + "_verts.npy", stem + "_index.npz"
+
+    def save(self, folder=cache_dir, source_mtime=0.0):
+        """
+        Write the store to folder. Each file is written under a temporary name and moved into
+        place, the index last, so workers saving at the same time or reading a mapped store
+        never see a partly written file.
+        """
+        os.makedirs(folder, exist_ok=True)
+        verts_path, index_path = self.paths(self.theta, self.n, folder)
+        suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(verts_path + suffix, "wb") as f:
+            np.save(f, self.verts)
+        os.replace(verts_path + suffix, verts_path)
+        with open(index_path + suffix, "wb") as f:
+            np.savez(f, keys=self.keys, source_mtime=source_mtime)
+        os.replace(index_path + suffix, index_path)
+
+    @classmethod
+    def load(cls, theta=np.pi/3, n=25, folder=cache_dir, source_mtime=None):
+        """
+        Memory-map a saved store. Returns None if it doesn't exist or is older than
+        source_mtime (the modification time of the geometry it was built from).
+        """
+        verts_path, index_path = cls.paths(theta, n, folder)
+        if not (os.path.exists(verts_path) and os.path.exists(index_path)):
+            return None
+        with np.load(index_path) as index:
+            if source_mtime is not None and float(index["source_mtime"]) != source_mtime:
+                return None
+            keys = index["keys"]
+        return cls(keys, np.load(verts_path, mmap_mode="r"), theta, n)
+
+    def lookup(self, source, dest, p1, p2):
+        """
+        Arc vertices for each (source, dest) pair, shape (len(source), n, 2).
+
+        p1 and p2 are the (n_arcs, 2) point coordinates, used only for pairs
+        that are not in the store yet.
+        """
+        keys = pair_keys(source, dest)
+        out = np.empty((len(keys), self.n, 2))
+        pos = np.searchsorted(self.keys, keys)
+        pos[pos == len(self.keys)] = 0
+        hit = (self.keys[pos] == keys) if len(self.keys) else np.zeros(len(keys), dtype=bool)
+        out[hit] = self.verts[pos[hit]]
+        miss = ~hit
+        if miss.any():
+            out[miss] = arc_vertices(np.asarray(p1)[miss], np.asarray(p2)[miss], self.theta, self.n)
+        return out
+
+
+_stores = {}
+_lock = threading.Lock()
+
+def get_arc_store(theta=np.pi/3, n=25):
+    """
+    Return the arc store for theta and n, loading it from cache_dir or building it
+    from the chain files on first use. Rebuilds when the county geometry has changed.
+    Loading shows up as an "arc_store" span of the trace it happens in (see trace_utils).
+    """
+    key = (theta, n)
+    with _lock:
+        if key not in _stores:
+            with span("arc_store") as attrs:
+                mtime = os.path.getmtime(county_file)
+                store = ArcStore.load(theta, n, source_mtime=mtime)
+                attrs["start"] = "warm" if store is not None else "cold"
+                if store is None:
+                    from utils import ref_data
+                    store = ArcStore.build(ref_data.county_centroids, chain_pairs(), theta, n)
+                    store.save(source_mtime=mtime)
+                    store = ArcStore.load(theta, n, source_mtime=mtime)
+                attrs["arcs"] = len(store)
+            _stores[key] = store
+        return _stores[key]
+
+
+if __name__ == "__main__":
+    # rebuild the store from scratch: python -m utils.arc_cache
+    for path in ArcStore.paths(np.pi/3, 25):
+        if os.path.exists(path):
+            os.remove(path)
+    t = time.perf_counter()
+    print(f"arc store: built {len(get_arc_store())} arcs in {time.perf_counter() - t:.3f}s")
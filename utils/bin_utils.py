@@ -0,0 +1,120 @@
+import numpy as np
+
+# color classes for the choropleth. a scheme turns the county values of a map into at most
+# max_bins + 1 class edges; classify then bins the values against the edges in one
+# searchsorted. classes are right-closed like pd.cut, with the lowest value in the first
+# class and values past the last edge in the last one.
+#
+#   quantile  equal-count classes (what assign_bins always did)
+#   jenks     natural breaks: the classes with the least within-class variance
+#   log       equal steps of log10(value)
+#   fixed     quantile edges of a reference set of values (e.g. every commodity of a crop),
+#             so maps of different selections share one color scale
+#
+# inner edges are rounded down to their first digit, the outer ones are the data range.
+
+bin_schemes = {"quantile": "Quantiles",
+               "jenks": "Natural breaks",
+               "log": "Log scale",
+               "fixed": "Fixed (same scale for every selection)"}
+# groups of sorted values natural breaks are computed over, keeping jenks_edges O(n log n)
+jenks_groups = 256
+
+
+def round_edges(edges):
+    """positive edges rounded down to their first digit (312 -> 300, 0.027 -> 0.02); others unchanged"""
+    edges = np.asarray(edges, dtype=float)
+    pos = edges > 0
+    mag = 10.0 ** np.floor(np.log10(np.where(pos, edges, 1.0)))
+    return np.where(pos, np.floor(edges / mag) * mag, edges)
+
+
+def quantile_edges(values, max_bins=4):
+    return np.quantile(values, np.linspace(0, 1, max_bins + 1))
+
+
+def log_edges(values, max_bins=4):
+    """edges evenly spaced in log10 between the smallest positive value and the largest"""
+    positive = values[values > 0]
+    if not len(positive):
+        return np.array([values.min(), values.max()])
+    edges = np.logspace(np.log10(positive.min()), np.log10(positive.max()), max_bins + 1)
+    edges[0] = values.min()
+    return edges
+
+
+def jenks_edges(values, max_bins=4):
+    """
+    Natural breaks: the max_bins classes of sorted values with the least total squared
+    deviation from their class means (Fisher's exact 1-d optimization).
+
+    Values are sorted and merged into at most jenks_groups groups of consecutive values with
+    about equal counts, and the optimization runs over the groups with their exact counts,
+    sums and sums of squares; with fewer distinct values than that the breaks are exact.
+    """
+    values = np.sort(values)
+    top = np.abs(values).max() or 1.0
+    # edges are taken from the values themselves, so each break value stays in its class
+    originals, counts = np.unique(values, return_counts=True)
+    if len(originals) <= max_bins:
+        return originals
+    distinct = originals / top
+    # group boundaries on the distinct values, about equal counts per group
+    cum = np.cumsum(counts)
+    m = min(jenks_groups, len(distinct))
+    ends = np.unique(np.searchsorted(cum, np.linspace(0, cum[-1], m + 1)[1:], side="left"))
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    w = np.add.reduceat(counts, starts).astype(float)
+    s = np.add.reduceat(distinct * counts, starts)
+    q = np.add.reduceat(distinct**2 * counts, starts)
+    W, S, Q = (np.concatenate([[0.0], np.cumsum(a)]) for a in (w, s, q))
+    m = len(w)
+    # sse[i, j]: squared deviation of groups i..j-1 as one class
+    i, j = np.triu_indices(m + 1, 1)
+    sse = np.full((m + 1, m + 1), np.inf)
+    sse[i, j] = np.maximum(Q[j] - Q[i] - (S[j] - S[i])**2 / (W[j] - W[i]), 0)
+    k = min(max_bins, m)
+    cost = sse[0]
+    back = np.zeros((k, m + 1), dtype=int)
+    for c in range(1, k):
+        total = cost[:, None] + sse
+        back[c] = np.argmin(total, axis=0)
+        cost = total[back[c], np.arange(m + 1)]
+    # walk back from the last group to find where each class starts
+    breaks, j = [], m
+    for c in range(k - 1, 0, -1):
+        j = back[c, j]
+        breaks.append(j)
+    upper = originals[ends[np.array(sorted(breaks)) - 1]]
+    return np.concatenate([[values[0]], upper, [values[-1]]])
+
+
+_edge_functions = {"quantile": quantile_edges, "jenks": jenks_edges, "log": log_edges, "fixed": quantile_edges}
+
+
+def bin_edges(values, max_bins=4, scheme="quantile", reference=None):
+    """
+    Class edges of a scheme (see bin_schemes), increasing and without duplicates.
+    The "fixed" scheme takes its edges from reference instead of values.
+    """
+    if scheme not in _edge_functions:
+        raise ValueError(f"unknown bin scheme {scheme!r}, expected one of {list(bin_schemes)}")
+    if scheme == "fixed":
+        if reference is None:
+            raise ValueError("the fixed bin scheme needs reference values")
+        values = reference
+    values = np.asarray(values, dtype=float)
+    values = values[np.isfinite(values)]
+    if not len(values):
+        return np.array([0.0])
+    edges = _edge_functions[scheme](values, max_bins)
+    edges[1:-1] = round_edges(edges[1:-1])
+    return np.unique(edges)
+
+
+def classify(values, edges):
+    """class of each value: i for values in (edges[i], edges[i+1]], clipped to the first and last class"""
+    if len(edges) < 2:
+        return np.zeros(len(values), dtype=np.int8)
+    codes = np.searchsorted(edges, np.asarray(values, dtype=float), side="left") - 1
+    return np.clip(codes, 0, len(edges) - 2).astype(np.int8)
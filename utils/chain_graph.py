@@ -0,0 +1,297 @@
+import argparse
+import time
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from utils import ref_data
+from utils.ref_data import county_positions
+from utils.cache_utils import LRUCache
+
+# a chain of N stages as a layered graph: layer 0 holds the source nodes, layer l the
+# destination nodes of stage l-1. a layer's nodes are either counties ("FIPS", indexed by
+# their position in ref_data.county_fips like the OD matrices of od_utils) or facilities
+# ("facility", indexed by their sorted facility codes; code 0 means the row has no facility).
+#
+# every chain row is one path through the layers. with P_l the (rows x nodes) incidence
+# matrix of layer l and W a diagonal of row flows, the flow between any two layers is
+# P_a^T W P_b: for consecutive layers that is a stage's OD matrix, for layers further apart
+# it answers "where does the flow leaving these nodes end up" for the actual chain paths,
+# which a product of stage matrices can't (it would mix paths through shared middle nodes).
+# each such matrix is built in one pass over the row index arrays and cached, so a trace is
+# a row or column slice of it.
+
+
+def node_column(layer, node_type="FIPS"):
+    """chain column holding the nodes of a layer"""
+    return f"source_{node_type}_0" if layer == 0 else f"destination_{node_type}_{layer-1}"
+
+
+def node_codes(chain_data, layer, node_type, steps):
+    """
+    Node codes of a layer. A middle layer's node is both the destination of one stage and
+    the source of the next, and chain files fill in the facility of only one of the two
+    (e.g. the ethanol plant of a DDGS chain is source_facility_1), so both are read.
+    """
+    codes = chain_data[node_column(layer, node_type)].to_numpy()
+    source = f"source_{node_type}_{layer}"
+    if 0 < layer < steps and source in chain_data:
+        codes = np.where(codes > 0, codes, chain_data[source].to_numpy())
+    return codes
+
+
+class ChainGraph:
+    """
+    Layered graph of one chain dataframe.
+
+    Parameters
+    ----------
+    chain_data : pd.DataFrame
+        chain dataframe as returned by get_chains, with the node columns of every layer
+        (and, for facility layers, the FIPS column of the same layer to place facilities)
+    steps : int
+        number of stages
+    node_types : list of str, optional
+        "FIPS" or "facility" for each of the steps+1 layers (default: all "FIPS");
+        the source layer is always counties
+    flow_unit : str or list of str
+        flow columns are flow_{flow_unit}_{stage}; a list gives the unit of each stage
+    """
+
+    def __init__(self, chain_data, steps, node_types=None, flow_unit="kg"):
+        node_types = list(node_types) if node_types is not None else ["FIPS"] * (steps + 1)
+        if len(node_types) != steps + 1 or node_types[0] != "FIPS":
+            raise ValueError("node_types needs one type per layer, starting with FIPS")
+        self.steps = steps
+        self.node_types = node_types
+        self.flow_unit = flow_unit
+        self.rows = len(chain_data)
+        # factorizing the categorical column only looks at its codes
+        com, commodities = pd.factorize(chain_data["dest_final"], sort=True)
+        self.commodities = [str(c) for c in commodities]
+        self.com_code = com.astype(np.int32)
+        self._com_index = {c: i for i, c in enumerate(self.commodities)}
+        units = [flow_unit] * steps if isinstance(flow_unit, str) else list(flow_unit)
+        self.flows = [chain_data[f"flow_{units[i]}_{i}"].to_numpy(dtype=float) for i in range(steps)]
+        # per layer: node of every row (-1 if unknown), node codes, county position of every node
+        self.index, self.codes, self.county = [], [], []
+        for layer, node_type in enumerate(node_types):
+            fips_col = node_column(layer)
+            pos_col = fips_col.replace("_FIPS_", "_pos_")
+            pos = (chain_data[pos_col].to_numpy() if pos_col in chain_data
+                   else county_positions(chain_data[fips_col])).astype(np.int32)
+            if node_type == "FIPS":
+                self.index.append(pos)
+                self.codes.append(ref_data.county_fips)
+                self.county.append(np.arange(len(ref_data.county_fips), dtype=np.int32))
+                continue
+            if node_type != "facility":
+                raise ValueError(f"unknown node type {node_type!r}")
+            code = node_codes(chain_data, layer, node_type, steps)
+            has = code > 0
+            codes, idx = np.unique(code[has], return_inverse=True)
+            index = np.full(self.rows, -1, dtype=np.int32)
+            index[has] = idx
+            # a facility sits in the county of the first row that names it
+            first = np.full(len(codes), -1, dtype=np.int32)
+            rows = np.flatnonzero(has)
+            first[idx[::-1]] = pos[rows[::-1]]
+            self.index.append(index)
+            self.codes.append(codes)
+            self.county.append(first)
+        self._paths = LRUCache(maxsize=64)
+        self._stages = self._stage_edges()
+
+    def size(self, layer):
+        """number of nodes in a layer"""
+        return len(self.codes[layer])
+
+    def node_index(self, layer, codes):
+        """node indices of FIPS or facility codes in a layer, -1 for codes not in it"""
+        codes = np.atleast_1d(np.asarray(codes, dtype=np.int64))
+        if self.node_types[layer] == "FIPS":
+            return county_positions(codes)
+        known = self.codes[layer]
+        if not len(known):
+            return np.full(len(codes), -1)
+        idx = np.minimum(np.searchsorted(known, codes), len(known) - 1)
+        return np.where(known[idx] == codes, idx, -1)
+
+    def _com_rows(self, com):
+        """row mask of the chains ending in com (a commodity or list of them), None for all"""
+        if com is None:
+            return None
+        com = [com] if isinstance(com, str) else list(com)
+        keep = np.zeros(len(self.commodities), dtype=bool)
+        keep[[self._com_index[c] for c in com if c in self._com_index]] = True
+        return keep[self.com_code]
+
+    def _stage_edges(self):
+        """
+        Edges of every stage for every commodity, in one pass over each stage's columns:
+        a CSR matrix whose block of rows c * n_src .. (c + 1) * n_src is commodity c's OD matrix.
+        """
+        stages = []
+        n_com = len(self.commodities)
+        for i in range(self.steps):
+            s, d = self.index[i], self.index[i + 1]
+            known = (s >= 0) & (d >= 0)
+            n_s, n_d = self.size(i), self.size(i + 1)
+            row = self.com_code[known].astype(np.int64) * n_s + s[known]
+            stages.append(sp.coo_matrix((self.flows[i][known], (row, d[known])),
+                                        shape=(n_com * n_s, n_d)).tocsr())
+        return stages
+
+    def edges(self, stage, com=None, rows=None):
+        """
+        Flow between the nodes of layers stage and stage + 1 (the stage's OD matrix).
+
+        Parameters
+        ----------
+        stage : int
+        com : str or list of str, optional
+            final destination commodities to include (default: all)
+        rows : np.ndarray of int, optional
+            positions of the chain rows to include, e.g. a source county filter's
+            (see filter_utils.FilterRegistry.rows); built from those rows instead of the
+            precomputed edges
+
+        Returns
+        -------
+        scipy.sparse.csr_matrix
+            (nodes in layer stage, nodes in layer stage + 1)
+        """
+        n_s, n_d = self.size(stage), self.size(stage + 1)
+        if rows is not None:
+            keep = self._com_rows(com)
+            if keep is not None:
+                rows = rows[keep[rows]]
+            s, d = self.index[stage][rows], self.index[stage + 1][rows]
+            known = (s >= 0) & (d >= 0)
+            return sp.coo_matrix((self.flows[stage][rows][known], (s[known], d[known])), shape=(n_s, n_d)).tocsr()
+        com = self.commodities if com is None else [com] if isinstance(com, str) else list(com)
+        blocks = [self._stages[stage][self._com_index[c] * n_s:(self._com_index[c] + 1) * n_s]
+                  for c in com if c in self._com_index]
+        return sum(blocks[1:], blocks[0]) if blocks else sp.csr_matrix((n_s, n_d))
+
+    def county_edges(self, stage, com=None, rows=None):
+        """edges of a stage between counties: facility nodes are merged into the county they are in"""
+        e = self.edges(stage, com, rows)
+        types = self.node_types[stage], self.node_types[stage + 1]
+        if types == ("FIPS", "FIPS"):
+            return e
+        n = len(ref_data.county_fips)
+        e = e.tocoo()
+        s, d = self.county[stage][e.row], self.county[stage + 1][e.col]
+        known = (s >= 0) & (d >= 0)
+        return sp.coo_matrix((e.data[known], (s[known], d[known])), shape=(n, n)).tocsr()
+
+    def od(self, com=None, rows=None):
+        """county OD matrix of every stage, as od_utils.od_matrices gives for one commodity"""
+        return [self.county_edges(i, com, rows) for i in range(self.steps)]
+
+    def od_matrices(self):
+        """{dest_final: [county OD matrix per stage]}, the layout of od_utils.od_matrices"""
+        return {com: self.od(com) for com in self.commodities}
+
+    def path_matrix(self, upper, lower, com=None, flow_stage=None):
+        """
+        Flow along the chain paths from the nodes of layer upper to those of layer lower
+        (upper < lower), P_upper^T W P_lower, cached per (layers, commodities, flow stage).
+
+        flow_stage picks the flow column weighting each path: by default the stage leaving
+        upper, i.e. how much of what its nodes send ends up at each node of lower.
+        """
+        if not 0 <= upper < lower <= self.steps:
+            raise ValueError(f"need layers 0 <= upper < lower <= {self.steps}, got {upper}, {lower}")
+        flow_stage = upper if flow_stage is None else flow_stage
+        com_key = None if com is None else (com,) if isinstance(com, str) else tuple(sorted(com))
+        key = (upper, lower, com_key, flow_stage)
+        m = self._paths.get(key)
+        if m is None:
+            a, b, w = self.index[upper], self.index[lower], self.flows[flow_stage]
+            known = (a >= 0) & (b >= 0)
+            keep = self._com_rows(com_key)
+            if keep is not None:
+                known &= keep
+            m = sp.coo_matrix((w[known], (a[known], b[known])), shape=(self.size(upper), self.size(lower))).tocsr()
+            self._paths.put(key, m)
+        return m
+
+    def trace(self, layer, nodes, to_layer, com=None, flow_stage=None):
+        """
+        Nodes of to_layer connected to the given nodes of layer along the chain paths,
+        downstream when to_layer > layer and upstream when it is < layer.
+
+        Parameters
+        ----------
+        layer, to_layer : int
+        nodes : int or list of int
+            FIPS or facility codes of nodes in layer
+        com : str or list of str, optional
+            final destination commodities to include (default: all)
+        flow_stage : int, optional
+            flow column weighting the paths, see path_matrix
+
+        Returns
+        -------
+        pd.DataFrame
+            code (FIPS or facility) and flow of the connected nodes, largest flow first
+        """
+        if layer == to_layer:
+            raise ValueError("trace needs two different layers")
+        idx = self.node_index(layer, nodes)
+        idx = idx[idx >= 0]
+        if layer < to_layer:
+            totals = self.path_matrix(layer, to_layer, com, flow_stage)[idx].sum(axis=0)
+        else:
+            totals = self.path_matrix(to_layer, layer, com, flow_stage)[:, idx].sum(axis=1)
+        totals = np.asarray(totals).ravel()
+        found = np.flatnonzero(totals)
+        order = found[np.argsort(-totals[found], kind="stable")]
+        return pd.DataFrame({"code": self.codes[to_layer][order], "flow": totals[order]})
+
+    def node_totals(self, layer, com=None, rows=None):
+        """
+        Flow through every node of a layer: the outflow of stage 0 for the source layer,
+        the inflow of stage layer-1 otherwise (as od_utils.node_totals).
+        """
+        e = self.edges(max(layer - 1, 0), com, rows)
+        return np.asarray(e.sum(axis=1 if layer == 0 else 0)).ravel()
+
+    def county_totals(self, layer, com=None, rows=None):
+        """node_totals summed per county, aligned with ref_data.county_fips"""
+        totals = self.node_totals(layer, com, rows)
+        if self.node_types[layer] == "FIPS":
+            return totals
+        county = self.county[layer]
+        known = county >= 0
+        return np.bincount(county[known], weights=totals[known], minlength=len(ref_data.county_fips))
+
+
+if __name__ == "__main__":
+    # python -m utils.chain_graph Chains/ddgs 2 --types FIPS facility FIPS --layer 1 --node 402075 --to 0
+    from utils.data_utils import get_chains
+    parser = argparse.ArgumentParser(description="trace chain flows between the layers of a chain graph")
+    parser.add_argument("folder", help="chain folder, as for get_chains")
+    parser.add_argument("steps", type=int)
+    parser.add_argument("--types", nargs="+", help="node type of every layer (default: all FIPS)")
+    parser.add_argument("--layer", type=int, required=True, help="layer of the traced nodes")
+    parser.add_argument("--node", type=int, nargs="+", required=True, help="FIPS or facility codes")
+    parser.add_argument("--to", type=int, required=True, help="layer to trace to")
+    parser.add_argument("--com", nargs="+", help="final destination commodities (default: all)")
+    parser.add_argument("--top", type=int, default=20)
+    args = parser.parse_args()
+
+    chains = get_chains(args.folder, nsteps=args.steps)
+    t = time.perf_counter()
+    graph = ChainGraph(chains, args.steps, args.types)
+    built = time.perf_counter() - t
+    t = time.perf_counter()
+    result = graph.trace(args.layer, args.node, args.to, args.com)
+    first = time.perf_counter() - t
+    t = time.perf_counter()
+    graph.trace(args.layer, args.node, args.to, args.com)
+    cached = time.perf_counter() - t
+    print(result.head(args.top).to_string(index=False))
+    print(f"{len(result)} nodes; graph of {graph.rows} rows built in {built*1000:.0f} ms, "
+          f"trace {first*1000:.1f} ms ({cached*1000:.2f} ms cached)")
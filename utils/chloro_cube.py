@@ -0,0 +1,104 @@
+import numpy as np
+import geopandas as gpd
+from utils import ref_data
+from utils.ref_data import county_positions
+
+
+class ChloroCube:
+    """
+    Pre-aggregated choropleth values for one chain dataframe.
+
+    Holds the per-(dest_final, source county) sums of each value column as dense
+    (n_dest_final, n_counties) arrays, with counties at their row position in
+    county_poly. A choropleth for any set of destination commodities is then a sum
+    over a few rows instead of a groupby and merge on the raw chain table.
+
+    Parameters
+    ----------
+    chain_data : pd.DataFrame
+        chain dataframe as returned by get_chains
+    columns : list of str
+        value columns to aggregate (e.g. "flow_kg_0")
+    graph : ChainGraph, optional
+        graph of chain_data (see chain_graph.ChainGraph), whose source counties and
+        commodity codes are used instead of working them out again
+    ratios : dict, optional
+        {name: (numerator, denominator)} of aggregated columns, values taken as the ratio
+        of the two sums (e.g. emissions per kg, see emissions.intensity_ratios)
+    """
+
+    def __init__(self, chain_data, columns=("flow_kg_0",), graph=None, ratios=None):
+        if graph is not None:
+            pos = graph.index[0]
+        elif "source_pos_0" in chain_data:
+            pos = chain_data["source_pos_0"].to_numpy()
+        else:
+            pos = county_positions(chain_data["source_FIPS_0"])
+        known = pos >= 0
+        if graph is not None:
+            dest, codes = graph.commodities, graph.com_code[known]
+        else:
+            dest, codes = np.unique(chain_data["dest_final"].astype(str).to_numpy()[known], return_inverse=True)
+        n = len(ref_data.county_fips)
+        cell = codes * n + pos[known]
+        self.dest_final = {d: i for i, d in enumerate(dest)}
+        # chain rows per cell: counties with any row show up on the map even if their flow sums to 0
+        self.rows = np.bincount(cell, minlength=len(dest)*n).reshape(len(dest), n)
+        self.sums = {col: np.bincount(cell, weights=chain_data[col].to_numpy()[known],
+                                      minlength=len(dest)*n).reshape(len(dest), n)
+                     for col in columns}
+        self.ratios = dict(ratios or {})
+
+    @property
+    def columns(self):
+        """aggregated and ratio columns"""
+        return [*self.sums, *self.ratios]
+
+    def _summed(self, column, idx):
+        if column in self.ratios:
+            num, den = (self.sums[c][idx].sum(axis=0) for c in self.ratios[column])
+            return np.divide(num, den, out=np.zeros_like(num), where=den > 0)
+        return self.sums[column][idx].sum(axis=0)
+
+    def values(self, chloro_column, com, source_mask=None):
+        """
+        Summed values and row counts per county for the destination commodities in com.
+
+        Parameters
+        ----------
+        chloro_column : str
+            aggregated value column or ratio
+        com : list of str
+            destination commodities to include
+        source_mask : np.ndarray of bool, optional
+            source counties to keep, aligned with county_poly rows
+
+        Returns
+        -------
+        tuple of np.ndarray
+            (values, rows), both aligned with county_poly rows
+        """
+        idx = [self.dest_final[c] for c in com if c in self.dest_final]
+        values = self._summed(chloro_column, idx)
+        rows = self.rows[idx].sum(axis=0)
+        if source_mask is not None:
+            rows = np.where(source_mask, rows, 0)
+        return values, rows
+
+    def map_data(self, chloro_column, com, source_mask=None, level=0):
+        """
+        County polygons with the summed chloro_column for the counties that have chain rows,
+        in the same layout as the groupby/merge in build_chloro used to produce.
+        level picks the simplified county geometry (see ref_data.poly_level).
+        """
+        values, rows = self.values(chloro_column, com, source_mask)
+        idx = np.flatnonzero(rows)
+        map_data = gpd.GeoDataFrame(ref_data.poly_level("county", level).iloc[idx].reset_index(drop=True))
+        map_data.insert(0, "source_FIPS_0", ref_data.county_fips[idx])
+        map_data.insert(1, chloro_column, values[idx])
+        return map_data
+
+
+def county_mask(counties):
+    """boolean mask over county_poly rows for a list of FIPS codes"""
+    return np.isin(ref_data.county_fips, np.asarray(counties, dtype=np.int64))
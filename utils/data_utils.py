@@ -1,37 +1,219 @@
+import argparse
 import glob
 import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import pandas as pd
 from pathlib import Path
+from utils.parallel_utils import pool_map
+from utils.fingerprint import data_fingerprint
 
-def get_chains(folderpath,nsteps=1):
+try:
+    import pyarrow as pa  # parquet engine for the columnar chain store
+    import pyarrow.parquet as pq
+    has_parquet = True
+except ImportError:
+    has_parquet = False
+
+
+def chain_columns(nsteps=1):
+    """
+    Columns of a chain dataframe that the app reads: the source county, the destination
+    county, flow and emissions of every stage, the chain's total emissions, and the
+    commodity columns added by get_chains.
+    """
+    cols = ["source_FIPS_0", "source_0_com", "dest_final"]
+    for i in range(nsteps):
+        cols += [f"destination_FIPS_{i}", f"flow_kg_{i}", f"emission_{i}", f"flow_{i}_com"]
+    return cols + ["emission_total"]
+
+
+def chain_dtypes(df, flow_dtype="float64"):
+    """
+    Compact dtypes for a chain dataframe: FIPS/facility/node codes as int32, flows
+    and emissions as flow_dtype, commodity names as categoricals.
+    """
+    dtypes = {}
+    for col in df.columns:
+        if col.endswith("_com") or col == "dest_final":
+            dtypes[col] = "category"
+        elif col.startswith(("flow_", "emission_")):
+            dtypes[col] = flow_dtype
+        else:
+            dtypes[col] = "int32"
+    return dtypes
+
+
+def read_chain_csvs(folderpath, nsteps=1, usecols=None, workers=None):
     """
     Reads all files in a folderpath that end with "_full.csv", reads them in as pandas dataframes,
     and adds columns to each dataframe for the commodity names in the source and destination
     of the commodity flow. Concatenates all dataframes into one and returns the result.
+    Files are read by a pool of worker processes when workers > 1 (default: parallel_utils.workers).
+    """
+    all_files = glob.glob(os.path.join(folderpath, "*_full.csv"))
+    li = pool_map(partial(read_chain_csv, nsteps=nsteps, usecols=usecols), all_files, workers)
+    return pd.concat(li, ignore_index=True)
+
+
+def read_chain_csv(name, nsteps=1, usecols=None):
+    df = pd.read_csv(name,  index_col=None, usecols=usecols)
+    return add_chain_coms(df, name, nsteps)
+
+
+def chain_file_coms(name):
+    """commodities named by a chain file, source first (e.g. corn-ddgs-cattle_feed_full.csv)"""
+    # can output files make com name 1 word (no spaces) eg cattlefeed, cowsmilk
+    return Path(name).stem.split('_')[0].split('-')
+
+
+def add_chain_coms(df, name, nsteps=1):
+    """add the commodity columns named by a chain file (e.g. corn-ddgs-cattle_feed_full.csv)"""
+    coms = chain_file_coms(name)
+    df["source_0_com"] = coms[0]
+    for i in range(nsteps):
+        df[f"flow_{i}_com"] = coms[i]
+    df[f"dest_final"] = coms[nsteps]
+    return df
+
+
+def stream_chain_csvs(folderpath, nsteps=1, chunksize=100_000, workers=None):
+    """
+    Read the "_full.csv" files in folderpath in row chunks, keeping only the columns in
+    chain_columns(nsteps) and summing the stage flows and emissions of rows that follow the
+    same county path (source_FIPS_0, destination_FIPS_0, ..., destination_FIPS_nsteps-1) as it goes.
+
+    The result has the same columns as a chain dataframe and gives the same stage flows,
+    emissions, choropleth sums and source-county filters, but one row per distinct path, so memory is
+    bounded by the number of paths plus one chunk rather than by the file size.
+    """
+    all_files = glob.glob(os.path.join(folderpath, "*_full.csv"))
+    li = pool_map(partial(stream_chain_csv, nsteps=nsteps, chunksize=chunksize), all_files, workers)
+    return pd.concat(li, ignore_index=True)
+
+
+def stream_chain_csv(name, nsteps=1, chunksize=100_000):
+    keys = ["source_FIPS_0"] + [f"destination_FIPS_{i}" for i in range(nsteps)]
+    flows = [f"flow_kg_{i}" for i in range(nsteps)] + [f"emission_{i}" for i in range(nsteps)] + ["emission_total"]
+    paths = None
+    for chunk in pd.read_csv(name, usecols=keys + flows, chunksize=chunksize,
+                             dtype=dict.fromkeys(keys, "int32")):
+        part = chunk.groupby(keys, sort=False).sum()
+        paths = part if paths is None else pd.concat([paths, part]).groupby(level=keys, sort=False).sum()
+    return add_chain_coms(paths.reset_index(), name, nsteps)
+
+
+def chain_store_path(folderpath, nsteps=1, flow_dtype="float64", aggregate=False):
+    suffix = "_agg" if aggregate else ""
+    return os.path.join(folderpath, f"chains_{nsteps}step_{flow_dtype}{suffix}.parquet")
+
+
+def source_fingerprint(folderpath):
+    """data_fingerprint of the chain CSVs in folderpath"""
+    return data_fingerprint([os.path.join(folderpath, "*_full.csv")])
+
+
+def ingest_chains(folderpath, nsteps=1, flow_dtype="float64", aggregate=False):
+    """
+    Convert the "_full.csv" files in folderpath into one typed parquet file
+    (see chain_dtypes) stored next to them, and return its path.
+    With aggregate, the files are streamed and stored as path sums (see stream_chain_csvs).
+    The fingerprint of the CSVs it was built from is kept in the file's metadata.
+    """
+    fingerprint = source_fingerprint(folderpath)
+    if aggregate:
+        df = stream_chain_csvs(folderpath, nsteps)
+    else:
+        df = read_chain_csvs(folderpath, nsteps)
+    df = df.astype(chain_dtypes(df, flow_dtype))
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), b"f3_source": fingerprint.encode()})
+    path = chain_store_path(folderpath, nsteps, flow_dtype, aggregate)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    pq.write_table(table, tmp)
+    os.replace(tmp, path)
+    return path
+
+
+def chain_store_is_fresh(folderpath, nsteps=1, flow_dtype="float64", aggregate=False):
+    """
+    True if the parquet store exists and was built from the chain CSVs now in folderpath
+    (same files, sizes and modification times; see source_fingerprint). An aggregated store
+    also needs every column of chain_columns(nsteps), which may have grown since it was written.
+    """
+    path = chain_store_path(folderpath, nsteps, flow_dtype, aggregate)
+    if not os.path.exists(path):
+        return False
+    schema = pq.read_schema(path)
+    if aggregate and not set(chain_columns(nsteps)) <= set(schema.names):
+        return False
+    stored = (schema.metadata or {}).get(b"f3_source", b"").decode()
+    return stored == source_fingerprint(folderpath)
+
+
+def get_chains(folderpath, nsteps=1, columns=None, flow_dtype="float64", aggregate=False):
+    """
+    Load the commodity chains in folderpath as one dataframe.
+
+    Chains are read from the typed parquet store written by ingest_chains, which is
+    (re)built first if it is missing or wasn't built from the "_full.csv" files now in
+    folderpath: the fingerprint of their names, sizes and modification times kept in the
+    store's metadata must match (see chain_store_is_fresh). Without pyarrow the CSVs are
+    read directly.
 
     Parameters
     ----------
     folderpath : str
         path to folder containing files to be read in
+    nsteps : int
+        number of stages in the chains
+    columns : list of str, optional
+        columns to load (e.g. chain_columns(nsteps)); all columns by default
+    flow_dtype : str
+        dtype for flow and emission columns, "float64" or "float32"
+    aggregate : bool
+        load one row per county path with summed flows instead of every chain row
+        (see stream_chain_csvs); only the chain_columns(nsteps) columns are available
 
     Returns
     -------
     pd.DataFrame
         concatenated dataframes from all files in folderpath
     """
-    all_files = glob.glob(os.path.join(folderpath, "*_full.csv"))
-    # can output files make com name 1 word (no spaces) eg cattlefeed, cowsmilk
-    li = []
-    for name in all_files:
-        df = pd.read_csv(name,  index_col=None)
-        df["source_0_com"] = Path(name).stem.split('_')[0].split('-')[0]
-        for i in range(nsteps):
-            com = Path(name).stem.split('_')[0].split('-')[i]
-            df[f"flow_{i}_com"] = com
-        df[f"dest_final"] = Path(name).stem.split('_')[0].split('-')[i+1]
-        li.append(df)
-    return pd.concat(li, ignore_index=True)
+    if not has_parquet:
+        if aggregate:
+            df = stream_chain_csvs(folderpath, nsteps)
+        else:
+            df = read_chain_csvs(folderpath, nsteps,
+                    usecols=None if columns is None else set(columns).__contains__)
+        return df.astype(chain_dtypes(df, flow_dtype))
+    if not chain_store_is_fresh(folderpath, nsteps, flow_dtype, aggregate):
+        ingest_chains(folderpath, nsteps, flow_dtype, aggregate)
+    return pd.read_parquet(chain_store_path(folderpath, nsteps, flow_dtype, aggregate), columns=columns)
+
 
+def _peak_rss(loader, folderpath, nsteps):
+    import resource  # Unix only, like memory_report
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    df = loader(folderpath, nsteps)
+    return len(df), before, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def memory_report(folderpath, nsteps=1):
+    """
+    Peak resident memory (MB) of reading the chain CSVs in folderpath whole versus
+    streaming them, each measured in a fresh process. Unix only.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    report = {}
+    for label, loader in [("read_chain_csvs", read_chain_csvs), ("stream_chain_csvs", stream_chain_csvs)]:
+        with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+            rows, before, after = pool.submit(_peak_rss, loader, folderpath, nsteps).result()
+        # ru_maxrss is in KB on Linux
+        report[label] = {"rows": rows, "peak_rss_mb": round(after / 1024, 1),
+                         "load_peak_mb": round((after - before) / 1024, 1)}
+    return report
 
 
 def filter_chains(fullchains, filterlist, column_in_chain):
@@ -56,4 +238,20 @@ def filter_chains(fullchains, filterlist, column_in_chain):
     filtered = {}
     for chain, df in fullchains.items():
         filtered[chain] = df[df[column_in_chain].isin(filterlist)]
-    return filtered
\ No newline at end of file
+    return filtered
+
+
+if __name__ == "__main__":
+    # one-shot ingest, e.g. python -m utils.data_utils Chains/corn:1 Chains/ddgs:2 Chains/soy:2
+    parser = argparse.ArgumentParser(description="convert chain CSV folders to typed parquet files")
+    parser.add_argument("folders", nargs="+", help="chain folders as path:nsteps")
+    parser.add_argument("--flow-dtype", default="float64", choices=["float32", "float64"])
+    parser.add_argument("--aggregate", action="store_true", help="stream and store county path sums")
+    parser.add_argument("--memory-report", action="store_true", help="compare loader peak memory instead")
+    args = parser.parse_args()
+    for folder in args.folders:
+        path, nsteps = folder.rsplit(":", 1)
+        if args.memory_report:
+            print(path, memory_report(path, int(nsteps)))
+        else:
+            print(ingest_chains(path, int(nsteps), args.flow_dtype, args.aggregate))
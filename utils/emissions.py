@@ -0,0 +1,159 @@
+import argparse
+import os
+import numpy as np
+import pandas as pd
+from utils import ref_data
+
+# the emissions view. chain files carry the emissions of every stage (emission_i) and of
+# the whole chain (emission_total) next to the flows; a crop's ChloroCube sums them per
+# source county and final destination commodity when the chains are loaded, alongside the
+# flows, so an emissions choropleth is the same few-row sum as a flow choropleth.
+#
+# intensities are ratios of those sums, not means of per-row ratios:
+#   intensity_i      emissions of stage i per kg moved in stage i
+#   intensity_total  emissions of the whole chain per kg of crop leaving the source county
+
+table_formats = ["csv", "parquet"]
+
+
+def emission_columns(steps):
+    """emission columns of a chain of steps stages"""
+    return [f"emission_{i}" for i in range(steps)] + ["emission_total"]
+
+
+def flow_columns(steps):
+    return [f"flow_kg_{i}" for i in range(steps)]
+
+
+def intensity_ratios(steps):
+    """{intensity column: (emission column, flow column)}, the ratios of a crop's ChloroCube"""
+    ratios = {f"intensity_{i}": (f"emission_{i}", f"flow_kg_{i}") for i in range(steps)}
+    ratios["intensity_total"] = ("emission_total", "flow_kg_0")
+    return ratios
+
+
+def cube_columns(steps):
+    """columns a crop's ChloroCube aggregates: stage flows and emissions"""
+    return flow_columns(steps) + emission_columns(steps)
+
+
+def chloro_choices(steps):
+    """
+    {column: label} of the values a choropleth can show. With one stage, the stage's
+    emissions are the chain's, so only the totals are offered.
+    """
+    choices = {"flow_kg_0": "Crop flow (kg)",
+               "emission_total": "GHG emissions, whole chain",
+               "intensity_total": "GHG emissions per kg of crop"}
+    if steps > 1:
+        for i in range(steps):
+            choices[f"emission_{i}"] = f"GHG emissions, stage {i+1}"
+            choices[f"intensity_{i}"] = f"GHG emissions per kg moved, stage {i+1}"
+    return choices
+
+
+def is_emission(column):
+    """True for the emission and intensity columns, which are drawn in the ghg colors"""
+    return column.startswith(("emission_", "intensity_"))
+
+
+def county_table(cube, steps, com=None, source_mask=None):
+    """
+    Stage flows, emissions and intensities per source county and final destination commodity.
+
+    Parameters
+    ----------
+    cube : ChloroCube
+        a crop's cube, aggregating cube_columns(steps) with intensity_ratios(steps)
+    steps : int
+    com : list of str, optional
+        commodities to include (default: all)
+    source_mask : np.ndarray of bool, optional
+        source counties to keep, aligned with county_poly rows
+
+    Returns
+    -------
+    pd.DataFrame
+        FIPS, dest_final, rows and one column per aggregated column and intensity,
+        for the counties with chain rows
+    """
+    com = list(cube.dest_final) if com is None else [c for c in com if c in cube.dest_final]
+    frames = []
+    for c in com:
+        values = {col: cube.values(col, [c], source_mask)[0] for col in cube.columns}
+        _, rows = cube.values("flow_kg_0", [c], source_mask)
+        idx = np.flatnonzero(rows)
+        frames.append(pd.DataFrame({"FIPS": ref_data.county_fips[idx], "dest_final": c, "rows": rows[idx],
+                                    **{col: v[idx] for col, v in values.items()}}))
+    columns = ["FIPS", "dest_final", "rows", *cube_columns(steps), *intensity_ratios(steps)]
+    return pd.concat(frames, ignore_index=True)[columns] if frames else pd.DataFrame(columns=columns)
+
+
+def summary_table(cube, steps):
+    """
+    Flow, emissions and intensity per final destination commodity and stage, and for the
+    whole chain ("total"), with a row of every commodity together ("all").
+
+    Returns
+    -------
+    pd.DataFrame
+        dest_final, stage, flow_kg, emission, intensity
+    """
+    rows = []
+    for c in [*cube.dest_final, "all"]:
+        idx = list(cube.dest_final.values()) if c == "all" else [cube.dest_final[c]]
+        for stage, (emission, flow) in zip([*range(1, steps + 1), "total"], intensity_ratios(steps).values()):
+            e, f = cube.sums[emission][idx].sum(), cube.sums[flow][idx].sum()
+            rows.append({"dest_final": c, "stage": str(stage), "flow_kg": f, "emission": e,
+                         "intensity": e / f if f > 0 else np.nan})
+    return pd.DataFrame(rows)
+
+
+def write_table(df, path, fmt="csv"):
+    if fmt == "parquet":
+        df.to_parquet(path, index=False)
+    else:
+        df.to_csv(path, index=False)
+    return path
+
+
+def export_tables(cubes, steps, folder, fmt="csv", crops=None):
+    """
+    Write the county and summary tables of every crop to folder as
+    {crop}_emissions_counties.{fmt} and {crop}_emissions_summary.{fmt}.
+
+    Parameters
+    ----------
+    cubes : dict
+        {crop: ChloroCube}
+    steps : dict
+        {crop: number of stages}
+
+    Returns
+    -------
+    list of str
+        paths written
+    """
+    if fmt not in table_formats:
+        raise ValueError(f"unsupported format {fmt!r}, expected one of {table_formats}")
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for crop in crops or cubes:
+        paths.append(write_table(county_table(cubes[crop], steps[crop]),
+                                 os.path.join(folder, f"{crop}_emissions_counties.{fmt}"), fmt))
+        paths.append(write_table(summary_table(cubes[crop], steps[crop]),
+                                 os.path.join(folder, f"{crop}_emissions_summary.{fmt}"), fmt))
+    return paths
+
+
+if __name__ == "__main__":
+    # python -m utils.emissions --output emissions/ [--format parquet] [--crop soy]
+    parser = argparse.ArgumentParser(description="export county and commodity emission tables of every crop")
+    parser.add_argument("--output", default="emissions/", help="output folder")
+    parser.add_argument("--format", choices=table_formats, default="csv")
+    parser.add_argument("--crop", nargs="+", help="crops to export (default: all)")
+    args = parser.parse_args()
+
+    from shared import chloro_cubes, chain_steps
+    for path in export_tables(chloro_cubes, chain_steps, args.output, args.format, args.crop):
+        print(path)
@@ -0,0 +1,148 @@
+import glob
+import hashlib
+import os
+import threading
+from functools import reduce
+import numpy as np
+import pandas as pd
+from utils import ref_data
+from utils.cache_utils import LRUCache
+
+# source-county filters, held as boolean masks over the dense county index (ref_data.county_fips).
+# every data/<name>.csv ending in "_counties.csv" with a FIPS column is a filter called <name>;
+# lists added at run time (e.g. uploads) are named after their content and kept in a bounded LRU,
+# so a long-running server doesn't keep every list ever uploaded. filters combine by name:
+# "a+b" is the union of a and b, "a&b" their intersection. "none" keeps every county.
+
+filter_dir = "data/"
+# uploaded lists kept at once; a session re-adds its lists before using them (see app.py)
+max_uploads = int(os.environ.get("F3_FILTER_UPLOADS", 32))
+filter_labels = {"fs_counties": "Upper Mississippi Foodscape"}
+combine_ops = {"+": "union", "&": "intersection"}
+
+
+def read_fips(path_or_buffer):
+    """FIPS codes from a CSV with a FIPS column, or from the first column of one without"""
+    df = pd.read_csv(path_or_buffer)
+    col = "FIPS" if "FIPS" in df.columns else df.columns[0]
+    return pd.to_numeric(df[col], errors="coerce").dropna().astype(np.int64).to_numpy()
+
+
+class FilterRegistry:
+    """
+    Named source-county filters and the chain rows they select.
+
+    Masks are built once per filter; the rows a filter keeps in a crop's chain table
+    are found on first use from the table's source_pos_0 column and then reused, so
+    applying a filter is a row take. Counties outside ConUS can't be in a mask.
+    Masks of added lists and of combined filters are least-recently-used caches.
+
+    Parameters
+    ----------
+    folder : str
+        folder searched for "*_counties.csv" filter files
+    max_uploads : int
+        added lists kept before the least recently used ones are dropped
+    """
+
+    def __init__(self, folder=filter_dir, max_uploads=max_uploads):
+        self.folder = folder
+        # labels of the filter files
+        self.labels = {}
+        self._masks = {}
+        self._uploads = LRUCache(max_uploads)
+        self._combined = LRUCache(256)
+        self._rows = LRUCache(256)
+        self._lock = threading.Lock()
+        self.discover()
+
+    def discover(self):
+        """(re)register every filter file in folder"""
+        with self._lock:
+            for path in sorted(glob.glob(os.path.join(self.folder, "*_counties.csv"))):
+                name = os.path.basename(path)[:-4]
+                self._masks[name] = self._county_mask(read_fips(path))
+                self.labels[name] = filter_labels.get(name, name.replace("_", " ").capitalize())
+            self._combined.clear()
+            self._rows.clear()
+
+    def names(self):
+        """filters found in folder"""
+        return list(self.labels)
+
+    def add(self, fips):
+        """
+        Register a list of FIPS codes as a filter and return its name. The name comes from the
+        codes, so adding a list again (e.g. one that was dropped from the LRU) gives the same filter.
+        """
+        fips = np.unique(np.asarray(fips, dtype=np.int64))
+        name = "list_" + hashlib.sha256(fips.tobytes()).hexdigest()[:12]
+        with self._lock:
+            # a lookup also marks the list as recently used
+            if self._uploads.get(name) is None:
+                self._uploads.put(name, self._county_mask(fips))
+        return name
+
+    @staticmethod
+    def combine(names, how="+"):
+        """canonical name of the union ("+") or intersection ("&") of filters; "none" for no filter"""
+        names = sorted(set(names) - {"none"})
+        return how.join(names) if names else "none"
+
+    @staticmethod
+    def _county_mask(fips):
+        return np.isin(ref_data.county_fips, fips)
+
+    def mask(self, name):
+        """boolean mask over ref_data.county_fips for a filter name, None for "none" """
+        if name == "none":
+            return None
+        with self._lock:
+            how = next((op for op in combine_ops if op in name), None)
+            if how is None:
+                return self._part(name)
+            mask = self._combined.get(name)
+            if mask is None:
+                parts = [self._part(part) for part in name.split(how)]
+                mask = reduce(np.logical_or if how == "+" else np.logical_and, parts)
+                self._combined.put(name, mask)
+            return mask
+
+    def _part(self, name):
+        if name in self._masks:
+            return self._masks[name]
+        mask = self._uploads.get(name)
+        if mask is None:
+            raise KeyError(f"unknown county filter {name!r}")
+        return mask
+
+    def counties(self, name):
+        """FIPS codes kept by a filter, None for "none" """
+        mask = self.mask(name)
+        return None if mask is None else ref_data.county_fips[mask]
+
+    def rows(self, name, crop, chain_data):
+        """
+        Positions of the chain_data rows whose source county is in the filter.
+        crop identifies chain_data: it must be the same table for the same crop.
+        """
+        key = (name, crop)
+        rows = self._rows.get(key)
+        if rows is None:
+            pos = chain_data["source_pos_0"].to_numpy()
+            rows = np.flatnonzero(self.mask(name)[pos] & (pos >= 0))
+            self._rows.put(key, rows)
+        return rows
+
+    def forget(self, crop):
+        """drop the rows found for crop, e.g. once its chain table was replaced"""
+        self._rows.discard(lambda key: key[1] == crop)
+
+    def apply(self, name, crop, chain_data):
+        """the chain_data rows kept by a filter (all of them for "none")"""
+        if name == "none":
+            return chain_data
+        return chain_data.take(self.rows(name, crop, chain_data))
+
+
+county_filters = FilterRegistry()
@@ -0,0 +1,18 @@
+import glob
+import hashlib
+import os
+
+# fingerprints of data files, for tying caches, stores and snapshots to the files they were built from
+
+
+def data_fingerprint(patterns):
+    """
+    Hash of the path, size and modification time of every file matching patterns,
+    so anything derived from those files can be tied to the data it was built from.
+    """
+    h = hashlib.sha256()
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)):
+            st = os.stat(path)
+            h.update(f"{path}:{st.st_size}:{st.st_mtime_ns};".encode())
+    return h.hexdigest()[:16]
@@ -1,10 +1,12 @@
 import numpy as np
 import math
+import warnings
 import pandas as pd 
 import geopandas as gpd
+import shapely
 from collections import namedtuple
 from shapely.geometry import LineString
-import matplotlib.pyplot as plt
+from utils.bin_utils import bin_edges, classify
 
 
 
@@ -70,7 +72,7 @@ def angle(c, p):
 
 def arc(p1, p2, theta=np.pi/3, n=25):
     if (p1.x < p2.x) and (p1.y > p2.y):
-        return arc(p2, p1)
+        return arc(p2, p1, theta, n)
     
     c1, c2 = circles_from_p1p2theta(p1, p2, theta)
     r = c1.r
@@ -89,60 +91,135 @@ def arc(p1, p2, theta=np.pi/3, n=25):
     
 
 
-def build_arcs(flow_data, source_point_dict, dest_point_dict):
-    tmp_list = []
-    # print(flow_data.head())
-    for row in flow_data.itertuples(index=False):
-        source, dest, flow_size = row[0], row[1], row[2] 
-        if (source == dest) or (source not in source_point_dict) or (dest not in dest_point_dict):
-            continue
-
-        sloc = source_point_dict[source] 
-        dloc = dest_point_dict[dest] 
-
-        try:
-            p1 = Pt(sloc.x, sloc.y)
-            p2 = Pt(dloc.x, dloc.y)
-        except:
-            print("WARNING: missing points!")
-            continue 
-        # flow arc is drawn as a series of short segments 
-        long, lat = arc(p1, p2)
-        tmp_list.append({"source":source,
-                "dest":dest,
-                "flowsize":flow_size,
-                "geometry":LineString(zip(long,lat))})
-
-        # create linestring and append to df of linestrings (below)
-    arcs_df = gpd.GeoDataFrame(tmp_list)
+def angles(c, p):
+    """
+    vectorized angle(): angles of the vectors from centers c to points p, as radians
+    from the horizontal in [0, 2*pi). c and p are (n, 2) arrays.
+    """
+    dx, dy = p[:, 0] - c[:, 0], p[:, 1] - c[:, 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = np.arctan(dy/dx)
+    return np.select(
+        [dx == 0, dx <= 0, dy < 0],
+        [np.where(dy > 0, 0.5 * math.pi, 1.5 * math.pi), math.pi + slope, 2*math.pi + slope],
+        default = slope)
+
+
+def arc_vertices(p1, p2, theta=np.pi/3, n=25):
+    """
+    Batched version of arc(): compute the arcs between many point pairs in one pass.
+
+    Parameters
+    ----------
+    p1, p2 : array-like, shape (n_arcs, 2)
+        (x, y) coordinates of the arc start and end points. Pairs must not be coincident.
+    theta : float
+        angle subtended by the arc at its circle center
+    n : int
+        number of vertices per arc
+
+    Returns
+    -------
+    np.ndarray
+        arc vertices, shape (n_arcs, n, 2)
+    """
+    p1 = np.asarray(p1, dtype=float).reshape(-1, 2)
+    p2 = np.asarray(p2, dtype=float).reshape(-1, 2)
+    # same orientation rule as arc(): pairs running right and down are drawn from p2 to p1
+    swap = ((p1[:, 0] < p2[:, 0]) & (p1[:, 1] > p2[:, 1]))[:, None]
+    p1, p2 = np.where(swap, p2, p1), np.where(swap, p1, p2)
+
+    dx, dy = p2[:, 0] - p1[:, 0], p2[:, 1] - p1[:, 1]
+    q = np.sqrt(dx**2 + dy**2)
+    if np.any(q == 0):
+        raise ValueError('coincident points gives infinite number of Circles')
+    r = q/math.sqrt(2 - 2*math.cos(theta))
+    x3, y3 = (p1[:, 0] + p2[:, 0])/2, (p1[:, 1] + p2[:, 1])/2
+    d = np.sqrt(r**2 - (q/2)**2)
+    # pick the lower of the two circle centers from circles_from_p1p2r
+    c1y, c2y = y3 + d*dx/q, y3 - d*dx/q
+    lower = c1y < c2y
+    c = np.column_stack([np.where(lower, x3 - d*dy/q, x3 + d*dy/q),
+                         np.where(lower, c1y, c2y)])
+    t1 = angles(c, p1)
+    t2 = angles(c, p2)
+
+    wrap = np.abs(t2 - t1) > math.pi
+    start = np.where(wrap, np.maximum(t1, t2) - 2*math.pi, t1)
+    stop = np.where(wrap, np.minimum(t1, t2), t2)
+    T = np.linspace(start, stop, num=n, axis=1)
+    x = c[:, [0]] + r[:, None]*np.cos(T)
+    y = c[:, [1]] + r[:, None]*np.sin(T)
+    return np.stack([x, y], axis=-1)
+
+
+def build_arcs(flow_data, source_point_dict, dest_point_dict, arc_store=None):
+    source, dest, flow_size = flow_data.iloc[:, 0], flow_data.iloc[:, 1], flow_data.iloc[:, 2]
+    keep = ((source != dest) 
+            & source.isin(list(source_point_dict)) 
+            & dest.isin(list(dest_point_dict))).to_numpy()
+    source, dest, flow_size = source[keep], dest[keep], flow_size[keep]
+
+    spts = np.array([source_point_dict[s] for s in source], dtype=object)
+    dpts = np.array([dest_point_dict[d] for d in dest], dtype=object)
+    no_source = shapely.is_missing(spts) | shapely.is_empty(spts)
+    no_dest = shapely.is_missing(dpts) | shapely.is_empty(dpts)
+    found = ~(no_source | no_dest)
+    if not found.all():
+        missing = np.unique(np.concatenate([source.to_numpy()[no_source], dest.to_numpy()[no_dest]]))
+        warnings.warn(f"arcs left out, no point for FIPS {missing.tolist()}")
+
+    p1, p2 = shapely.get_coordinates(spts[found]), shapely.get_coordinates(dpts[found])
+    return arcs_frame(source.to_numpy()[found], dest.to_numpy()[found], flow_size.to_numpy()[found], 
+                      p1, p2, arc_store)
+
+
+def arc_verts(source, dest, p1, p2, arc_store=None):
+    """(n_arcs, n, 2) arc vertices, from arc_store when given, otherwise computed"""
+    # flow arcs are drawn as a series of short segments, all built in one batch
+    if arc_store is not None:
+        return arc_store.lookup(source, dest, p1, p2)
+    return arc_vertices(p1, p2)
+
+def arcs_frame(source, dest, flow_size, p1, p2, arc_store=None):
+    """
+    GeoDataFrame of flow arcs from arrays of source/dest codes, flows and (n, 2) end point
+    coordinates. Arcs come from arc_store when given, otherwise they are computed.
+    """
+    verts = arc_verts(source, dest, p1, p2, arc_store)
+    arcs_df = gpd.GeoDataFrame({"source": source,
+                "dest": dest,
+                "flowsize": flow_size,
+                "geometry": shapely.linestrings(verts)})
     return arcs_df
 
-def build_flow(dataframe, source, dest, flow, source_dict, dest_dict, drop_bottom = 0.1):
+def build_flow(dataframe, source, dest, flow, source_dict, dest_dict, drop_bottom = 0.1, arc_store = None):
     flow_data = dataframe [[source,dest,flow]].groupby([source, dest]).sum().reset_index()
     flow_data = flow_data[flow_data[flow]>flow_data[flow].quantile(drop_bottom)]
-    flow_arcs = build_arcs(flow_data, source_dict, dest_dict)
+    flow_arcs = build_arcs(flow_data, source_dict, dest_dict, arc_store)
     return flow_arcs 
 
+def bubbles(point_frames, max_radius = 0.6, quad_segs = 8):
+    """
+    Circles for layers of flow points (GeoDataFrames with flowsize and point geometry),
+    with areas proportional to flowsize on one scale shared by all layers: the largest
+    flow gets a circle of max_radius map units. Returns the layers with circle geometries.
+    """
+    flows = [p["flowsize"].to_numpy() for p in point_frames]
+    top = max((f.max() for f in flows if len(f)), default = 0)
+    out = []
+    for p, f in zip(point_frames, flows):
+        radius = max_radius * np.sqrt(f / top) if top > 0 else np.zeros(len(f))
+        out.append(p.set_geometry(shapely.buffer(p.geometry.to_numpy(), radius, quad_segs = quad_segs)))
+    return out
+
 def assign_bins(values, max_bins=4, bin_style='equal'):
-    ''' 
-    bin data to make heat maps look better, returning a list of integers from 0 to max_bins.
-    assumes all values are positive or zero. also works for grouping facility points by size.
     '''
-
-    def round_edge(x):
-        ''' round a number to its first digit plus zeros'''
-        order_of_mag = 10 ** np.floor(np.log10(x))
-        first_digit = np.floor(x / order_of_mag)
-        return first_digit * order_of_mag
-              
-    # group values into equally sized groups using pandas "quantile cut"
-    if bin_style == 'equal':
-        binned_data, bin_edges = pd.qcut(values, max_bins, retbins=True, labels=False)
-        # 'labels=False' automatically returns integers as the bin values (starting from 0)
-        new_edges = [round_edge(x) for x in bin_edges]
-        if np.min(values) >= 1.0:
-            new_edges = [int(y) for y in new_edges]
-
-        # bin edges can't have duplicates, so we need to drop if we have any after the rounding
-        binned_data = pd.cut(values, new_edges, duplicates='drop', labels=False)
-    return binned_data, new_edges
\ No newline at end of file
+    bin data to make heat maps look better, returning the class of each value (integers from 0
+    to max_bins - 1) and the class edges. bin_style is 'equal' for equal-count classes or a
+    scheme of bin_utils.bin_schemes other than "fixed".
+    also works for grouping facility points by size.
+    '''
+    scheme = "quantile" if bin_style == 'equal' else bin_style
+    edges = bin_edges(values, max_bins, scheme)
+    return pd.Series(classify(values, edges), index=getattr(values, "index", None)), edges
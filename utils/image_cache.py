@@ -0,0 +1,118 @@
+import glob
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from utils.fingerprint import data_fingerprint
+
+# finished images; put() writes under a ".tmp" name first, which eviction leaves alone
+image_exts = ("png", "svg")
+
+
+class ImageCache:
+    """
+    Content-addressed store of rendered map images on local disk.
+
+    Images are filed under folder/<fingerprint>/<key>.<ext>, where key is a hash of the
+    canonical input state and fingerprint identifies the data files the image was
+    rendered from. Changing the fingerprint makes old images unreachable; with
+    purge_stale they are also deleted right away. Least recently used images are
+    evicted once the store grows past max_bytes.
+
+    Parameters
+    ----------
+    folder : str
+        root folder of the store
+    fingerprint : str
+        data fingerprint (see data_fingerprint)
+    max_bytes : int
+        size limit of the store for the current fingerprint
+    purge_stale : bool
+        delete images rendered from other fingerprints
+    min_age : float
+        seconds since an image was last used before it may be evicted, so an image that is
+        being served isn't removed under the reader
+    """
+
+    def __init__(self, folder, fingerprint, max_bytes=200 * 2**20, purge_stale=True, min_age=10.0):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.purge_stale = purge_stale
+        self.min_age = min_age
+        self._lock = threading.Lock()
+        self.set_fingerprint(fingerprint)
+
+    def set_fingerprint(self, fingerprint):
+        """switch to a new data fingerprint, e.g. after the data files changed"""
+        self.fingerprint = fingerprint
+        self.path = os.path.join(self.folder, fingerprint)
+        os.makedirs(self.path, exist_ok=True)
+        if self.purge_stale:
+            for old in glob.glob(os.path.join(self.folder, "*")):
+                if os.path.isdir(old) and os.path.basename(old) != fingerprint:
+                    shutil.rmtree(old, ignore_errors=True)
+
+    @staticmethod
+    def key(state):
+        """canonical hash of an input state (a JSON-serializable dict)"""
+        return hashlib.sha256(json.dumps(state, sort_keys=True).encode()).hexdigest()
+
+    def file(self, key, ext="png"):
+        return os.path.join(self.path, f"{key}.{ext}")
+
+    def get(self, key, ext="png"):
+        """path of the cached image for key, or None"""
+        path = self.file(key, ext)
+        try:
+            os.utime(path)  # mark as recently used for eviction
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, src, ext="png"):
+        """move the rendered image at src into the store and return its new path"""
+        path = self.file(key, ext)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        shutil.move(src, tmp)
+        os.replace(tmp, path)
+        self.evict(keep=path)
+        return path
+
+    def images(self):
+        """paths of the finished images in the store"""
+        return [f for ext in image_exts for f in glob.glob(os.path.join(self.path, f"*.{ext}"))]
+
+    def size(self):
+        return sum(os.path.getsize(f) for f in self.images())
+
+    def evict(self, keep=None):
+        """
+        remove least recently used images until the store fits in max_bytes, leaving alone
+        the ones used within the last min_age seconds
+        """
+        with self._lock:
+            recent = time.time() - self.min_age
+            files = []
+            for f in self.images():
+                try:
+                    st = os.stat(f)
+                except FileNotFoundError:
+                    continue
+                files.append((st.st_mtime, st.st_size, f))
+            total = sum(size for _, size, _ in files)
+            for mtime, size, f in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                if f == keep or mtime > recent:
+                    continue
+                try:
+                    os.remove(f)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    def clear(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.makedirs(self.path, exist_ok=True)
@@ -1,11 +1,20 @@
+import os
 import numpy as np
 import pandas as pd
 import geopandas as gpd
 import matplotlib.colors as mcolors
 import re
-from utils.ref_data import county_points, county_poly, state_poly, arcdicts, geopoints, colors
-from utils.flow_utils import build_flow, assign_bins
-from plotnine import geom_map, scale_size_continuous, scale_fill_manual, aes
+from utils import ref_data
+from utils.ref_data import colors
+from utils.bin_utils import bin_edges, classify
+from utils.arc_cache import get_arc_store
+from utils.chloro_cube import ChloroCube, county_mask
+from utils.cache_utils import LRUCache
+from utils.od_utils import build_flow_od, stage_arc_selection, selection_arrays, arcs_from_arrays, build_points
+from utils.chain_graph import ChainGraph
+from utils.parallel_utils import get_pool
+from concurrent.futures import Future
+from plotnine import geom_map, scale_size_continuous, scale_fill_manual, aes, ggplot, theme_void, theme, element_rect
 
 def hex_color_gradient(start_hex, end_hex, steps=4):
     start = mcolors.to_rgb(start_hex)
@@ -26,39 +35,91 @@ fill_gradients = {
     }
 
 
-state_outline = geom_map(data = state_poly, color="#000000", fill = None, size = 0.2)
+# state_outline is built on first use, so importing map_utils doesn't load the state polygons
+_state_outlines = {}
 
-def build_chloro (chains_list, crop, chloro_column, com):
+def get_state_outline(level = 0):
+    if level not in _state_outlines:
+        _state_outlines[level] = geom_map(data = ref_data.poly_level("state", level), color="#000000", fill = None, size = 0.2)
+    return _state_outlines[level]
+
+def __getattr__(name):
+    if name == "state_outline":
+        return get_state_outline()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# choropleth classes per (cache_key, column, commodities, scheme), and the fixed-scheme edges per (crop, column)
+bin_cache = LRUCache(maxsize = int(os.environ.get("F3_BIN_CACHE_SIZE", 256)))
+
+def reference_edges(cube, crop, chloro_column, max_bins = 4, data_version = None):
+    """
+    class edges of the "fixed" bin scheme: the quantile edges of every commodity of a crop, unfiltered.
+    data_version identifies the crop's data the cube was built from, so edges of reloaded data
+    never hit the entry of the data they replaced
+    """
+    key = ("fixed", crop, chloro_column, max_bins, data_version)
+    edges = bin_cache.get(key)
+    if edges is None:
+        values, rows = cube.values(chloro_column, list(cube.dest_final))
+        edges = bin_edges(values[rows > 0], max_bins, "quantile")
+        bin_cache.put(key, edges)
+    return edges
+
+def build_chloro (cubes, crop, chloro_column, com, source_counties = None, level = 0, source_mask = None,
+                  scheme = "quantile", cache_key = None, data_version = None):
     """
     Generate a geospatial dataframe for choropleth mapping of a commodity flow chain.
 
     Parameters
     ----------
-    chains_list : dict
-        A dictionary containing the dataframes for all the commodity chains.
+    cubes : dict
+        A dictionary containing a ChloroCube for each commodity chain.
     crop : str
         The commodity name for the chain to be processed.
     chloro_column : str
         The column name for the data to be used for the choropleth mapping.
     com : list of str
         A list of commodity names that are the destination of the flow in the chain.
+    source_counties : list of int, optional
+        FIPS codes of the source counties to keep (see filter_chains). Default keeps all.
+    level : int, optional
+        simplification level of the county polygons (see ref_data.pick_level). Default is full resolution.
+    source_mask : np.ndarray of bool, optional
+        source counties to keep as a mask over county_poly rows (see filter_utils), instead of source_counties.
+    scheme : str, optional
+        color class scheme, one of bin_utils.bin_schemes. Default is quantiles.
+    cache_key : tuple, optional
+        identifies crop and source county filter (e.g. (crop, filter name)); the color classes
+        are memoized in bin_cache under it. Must be the same for the same source_mask.
+    data_version : hashable, optional
+        version of the crop's data (e.g. of shared.crops[crop]["versions"]), for the "fixed"
+        scheme's edges, which are taken from every commodity of the crop.
 
     Returns :
     map_data: gpd.GeoDataFrame
-        a geopandas GeoDataFrame ready for plotting using p9.geom_map()
+        a geopandas GeoDataFrame ready for plotting using p9.geom_map(). colorbin holds the
+        class of each county, with every class of the scheme as a category, and
+        map_data.attrs["bin_edges"] the class edges.
 
 
     """
-    chain_data = chains_list[crop]
-    chain_data = (chain_data[chain_data['dest_final'].isin(com)]
-                    .groupby('source_FIPS_0')
-                    .agg({"flow_kg_0":"sum"}).reset_index())
-    map_data = gpd.GeoDataFrame(pd.merge(chain_data,county_poly,
-                        left_on = "source_FIPS_0",
-                        right_on = "GEOID",
-                        how = "inner"))
-    color_bin_values, bin_edges = assign_bins(map_data[chloro_column], max_bins = 4)
-    map_data["colorbin"]= color_bin_values.fillna(2).astype("category")
+    if source_mask is None and source_counties is not None:
+        source_mask = county_mask(source_counties)
+    map_data = cubes[crop].map_data(chloro_column, com, source_mask, level)
+    # "fixed" classes come from every commodity of the crop, not only the selected ones
+    key = None if cache_key is None else (*cache_key, chloro_column, tuple(sorted(com)), scheme,
+                                          data_version if scheme == "fixed" else None)
+    binned = None if key is None else bin_cache.get(key)
+    if binned is None:
+        reference = reference_edges(cubes[crop], crop, chloro_column, data_version = data_version) \
+            if scheme == "fixed" else None
+        edges = reference if scheme == "fixed" else bin_edges(map_data[chloro_column], 4, scheme)
+        binned = (classify(map_data[chloro_column], edges), edges)
+        if key is not None:
+            bin_cache.put(key, binned)
+    codes, edges = binned
+    map_data["colorbin"] = pd.Categorical.from_codes(codes, categories = range(max(len(edges) - 1, 1)))
+    map_data.attrs["bin_edges"] = [float(e) for e in edges]
     return map_data
 
 # in: chain data, number of steps, [subset of chain?]
@@ -75,74 +136,171 @@ def flow_components(chain_data,
         steps = 2, 
         subset=0, 
         dest_types = ['FIPS','FIPS'],
-        flow_units = ["kg","kg"]): 
+        flow_units = ["kg","kg"],
+        drop_bottom = 0.1,
+        od = None,
+        reduction = None,
+        pool = None): 
     
     """
-    Generate map components for visualizing flow data across multiple stages.
+    Generate the flow arcs for visualizing flow data across multiple stages.
 
-    This function processes chain data to create geospatial map components,
-    including polygons for choropleth mapping, source points, destination points,
-    and flow arcs between them. It supports filtering by subsets and varying
-    destination types and flow units.
+    This function processes chain data to create the flow arcs between the source
+    and destination nodes of every stage. It supports filtering by subsets and varying
+    destination types and flow units. Node points are built separately, and only when
+    asked for (see flow_points).
 
     Args:
         chain_data (pd.DataFrame): Input data containing the flow chains.
         steps (int, optional): Number of stages in the flow chain. Default is 2.
         subset (str or int, optional): Subset of the chain for filtering. Default is 0.
-        dest_types (list of str, optional): Types of destination identifiers. Default is ['FIPS', 'FIPS'].
+        dest_types (list of str, optional): Types of destination identifiers, 'FIPS' or 'facility'.
+            Facilities are drawn at the county they are in. Default is ['FIPS', 'FIPS'].
         flow_units (list of str, optional): Units for flow measurement. Default is ["kg", "kg"].
-        chloro_column (str, optional): Column name for choropleth mapping. Default is "flow_kg_0".
+        drop_bottom (float, optional): Quantile of the smallest flows left out of the arcs. Default is 0.1.
+        od (list of scipy.sparse matrix, optional): precomputed county OD matrices per stage for chain_data
+            (see chain_graph.ChainGraph.od). Computed from chain_data when not given.
+        reduction (tuple, optional): arc reduction (mode, value), replacing drop_bottom
+            (see od_utils.reduction_modes).
+        pool (concurrent.futures.Executor, optional): when given, stages are submitted to it and
+            returned as futures of od_utils.flow_od_selection output (see build_flow_data).
 
     Returns:
-        tuple: A tuple containing:
-            - map_data (gpd.GeoDataFrame): Geospatial dataframe for choropleth mapping.
-            - flow_points (list of gpd.GeoDataFrame): List of geospatial dataframes for source and destination points.
-            - flow_arcs (list of LineString): List of flow arcs connecting the points.
+        list of gpd.GeoDataFrame: flow arcs of each stage.
     """
 
-    flows = [f"flow_{flow_units[i]}_{i}" for i in range(steps)]
-    destinations = [f"destination_{dest_types[i]}_{i}" for i in range(steps)]
-
     if subset:
         print(f"chain ending in {subset}")
-        chain_data = chain_data[chain_data[f'dest_final']==subset]   
+    if od is None:
+        node_types = ['FIPS'] + list(dest_types[:steps])
+        od = ChainGraph(chain_data, steps, node_types, flow_units[:steps]).od(subset or None)
 
-
-    source_point = gpd.GeoDataFrame(pd.merge(chain_data,county_points, 
-                                left_on = "source_FIPS_0",
-                                right_on = "GEOID",
-                                how = "left"))
-    flow_points = [source_point]
+    # every stage is a county OD matrix, with arcs from the precomputed arc store
+    flow_arcs = []
     for i in range(steps):
-        dp = gpd.GeoDataFrame(pd.merge(chain_data,geopoints[dest_types[i]], 
-                            left_on = destinations[i],
-                            right_on = "GEOID",
-                            how = "left"))
-        flow_points.append(dp) 
-
-    flow0_arc = build_flow(chain_data, "source_FIPS_0",destinations[0], flows[0], 
-                            arcdicts['FIPS'], arcdicts[dest_types[0]])
-    flow_arcs = [flow0_arc]
-    for i in range(steps)[1:]:
-        fa = build_flow(chain_data,destinations[i-1], destinations[i], flows[i],
-                        arcdicts[dest_types[i-1]], arcdicts[dest_types[i]])
+        if pool is not None:
+            fa = pool.submit(stage_arc_selection, od[i], drop_bottom, reduction)
+        else:
+            fa = build_flow_od(od[i], drop_bottom, get_arc_store(), reduction)
         flow_arcs.append(fa)                        
 
-    return flow_points, flow_arcs
+    return flow_arcs
+
+
+def flow_points(chain_data,
+        steps = 2,
+        subset = 0,
+        dest_types = ['FIPS','FIPS'],
+        flow_units = ["kg","kg"],
+        od = None):
+    """
+    Points of every node of a chain with the flow through them, one row per county.
+
+    Node 0 is the source county, with the flow it sends into stage 0; node i is the destination
+    of stage i-1, with the flow it receives. Facility nodes are summed into the county they are in.
+
+    Args:
+        chain_data (pd.DataFrame): Input data containing the flow chains.
+        steps (int, optional): Number of stages in the flow chain. Default is 2.
+        subset (str or int, optional): Final destination commodity to keep. Default is 0 (all).
+        dest_types (list of str, optional): Types of destination identifiers. Default is ['FIPS', 'FIPS'].
+        flow_units (list of str, optional): Units for flow measurement. Default is ["kg", "kg"].
+        od (list of scipy.sparse matrix, optional): precomputed county OD matrices per stage for the subset
+            (see chain_graph.ChainGraph.od).
+
+    Returns:
+        list of gpd.GeoDataFrame: GEOID, flowsize and point geometry for each of the steps+1 nodes.
+    """
+    if od is None:
+        node_types = ['FIPS'] + list(dest_types[:steps])
+        od = ChainGraph(chain_data, steps, node_types, flow_units[:steps]).od(subset or None)
+    return [build_points(None, node, od = od) for node in range(steps + 1)]
+
+# flow_components and flow_points results shared by all sessions in the process, one entry per commodity
+flow_cache = LRUCache(maxsize = int(os.environ.get("F3_FLOW_CACHE_SIZE", 64)))
+
+def build_flow_data(input_data, flows_to = ["broiler", "hog", "cows", "cattle"], steps = 2, 
+                    cache_key = None, drop_bottom = 0.1, od = None, reduction = None, workers = None,
+                    versions = None):
+    """
+    Build flow arcs for each destination commodity in flows_to.
+
+    Args:
+        input_data (pd.DataFrame): chain data for one crop.
+        flows_to (list of str): destination commodities.
+        steps (int): number of stages in the chain.
+        cache_key (tuple, optional): identifies input_data, e.g. (crop, filter name). When given,
+            results are memoized in flow_cache under (*cache_key, commodity, version, steps, drop_bottom, reduction).
+            input_data must be the same for the same cache_key and versions.
+        drop_bottom (float): quantile of the smallest flows left out of the arcs.
+        od (dict, optional): precomputed stage OD matrices of input_data per commodity
+            (see chain_graph.ChainGraph.od_matrices).
+        reduction (tuple, optional): arc reduction (mode, value), see od_utils.reduction_modes.
+        workers (int, optional): build the county-to-county arcs of all commodities and stages
+            at once in a pool of this many processes (default: parallel_utils.workers; 0 or 1 is serial).
+        versions (dict, optional): {commodity: data version} (see shared.dest_versions), so arcs built
+            from reloaded chain files never hit the entries of the data they replaced.
 
-def build_flow_data(input_data, flows_to = ["broiler", "hog", "cows", "cattle"], steps = 2):
+    Returns:
+        dict: {"flowarcs": {com: arcs per stage}}
+    """
     farclist = {}
-    fptlist = {}
+    pool = get_pool(workers)
+    # the workers pick the arcs, their vertices come from the arc store in this process
+    arc_store = None if pool is None else get_arc_store()
+    # submit every commodity's stages before waiting on any of them
+    pending = {}
     for com in flows_to:
-        flowpoints, flowarcs = flow_components(input_data, subset = com, steps = steps)
+        key = None if cache_key is None else (*cache_key, com, (versions or {}).get(com), steps, drop_bottom, reduction)
+        flowarcs = None if key is None else flow_cache.get(key)
+        if flowarcs is None:
+            flowarcs = flow_components(input_data, subset = com, steps = steps, drop_bottom = drop_bottom,
+                                         od = None if od is None else od.get(com), reduction = reduction,
+                                         pool = pool)
+        else:
+            key = None  # already cached, nothing to store
+        pending[com] = (key, flowarcs)
+    for com, (key, flowarcs) in pending.items():
+        flowarcs = [arcs_from_arrays(selection_arrays(fa.result(), arc_store)) if isinstance(fa, Future) else fa
+                    for fa in flowarcs]
+        if key is not None:
+            flow_cache.put(key, flowarcs)
         farclist[com] = flowarcs
-        fptlist[com] = flowpoints
     flow_data = {
-        "flowarcs":farclist,
-        "flowpoints":fptlist}
+        "flowarcs":farclist}
 
     return flow_data
 
+
+def build_point_data(input_data, flows_to = ["broiler", "hog", "cows", "cattle"], steps = 2,
+                     cache_key = None, od = None, versions = None):
+    """
+    Build node points with their flow (see flow_points) for each destination commodity in flows_to.
+
+    Args:
+        input_data (pd.DataFrame): chain data for one crop.
+        flows_to (list of str): destination commodities.
+        steps (int): number of stages in the chain.
+        cache_key (tuple, optional): identifies input_data, as for build_flow_data.
+        od (dict, optional): precomputed stage OD matrices of input_data per commodity
+            (see chain_graph.ChainGraph.od_matrices).
+        versions (dict, optional): {commodity: data version}, as for build_flow_data.
+
+    Returns:
+        dict: {com: points per node}
+    """
+    fptlist = {}
+    for com in flows_to:
+        key = None if cache_key is None else (*cache_key, com, (versions or {}).get(com), steps, "points")
+        points = None if key is None else flow_cache.get(key)
+        if points is None:
+            points = flow_points(input_data, steps = steps, subset = com,
+                                 od = None if od is None else od.get(com))
+            if key is not None:
+                flow_cache.put(key, points)
+        fptlist[com] = points
+    return fptlist
+
 # map components includes: 
 #   chloro - set with chloro_column
 #   flow points - all stages
@@ -199,6 +357,21 @@ def make_geom_flow(flowlist, commodity, stage, **kwargs):
     else:
         raise ValueError("size must be 'fixed' or 'scaled'")
 
+def make_geom_points(bubbledata, color):
+    """
+    Create a plotnine geom for a layer of flow point bubbles.
+
+    Args:
+        bubbledata (gpd.GeoDataFrame): circles sized by flow (see flow_utils.bubbles).
+        color (str): either a hex color code or a key in the colors dict.
+    Returns:
+        plotnine.geom: geom_map object of filled circles
+    """
+    color = colors.get(color, color)
+    if not is_hex_color(color):
+        raise ValueError("color must be a hex code or key in colors dict")
+    return geom_map(data = bubbledata, fill = color, color = "white", size = 0.1, alpha = 0.7)
+
 def make_geom_chloro(chlorodata, dest_com):
     """
     Create a plotnine geom for the chloropleth map of a given commodity.
@@ -233,6 +406,39 @@ def make_scale(type, **kwargs):
     else:
         raise ValueError("type must be 'fill' or 'size'")
     
+def chloro_map(mapdata, flowarcs, layers, colorval, arc_size = "fixed", level = 0, point_layers = ()):
+    """
+    Assemble the plotnine map shown in the app.
+
+    Args:
+        mapdata (gpd.GeoDataFrame or None): output of build_chloro, None for no choropleth.
+        flowarcs (dict): flow arcs per commodity and stage (build_flow_data()["flowarcs"]).
+        layers (list of tuple): (commodity, stage, color) arc layers, bottom to top (see render_utils.arc_layers).
+        colorval (str): key in fill_gradients for the choropleth colors.
+        arc_size (str): "fixed" or "scaled".
+        level (int): simplification level of the state outlines (see ref_data.pick_level).
+        point_layers (list of tuple): (bubbles GeoDataFrame, color) point layers drawn over the arcs
+            (see flow_utils.bubbles and render_utils.point_layers).
+
+    Returns:
+        plotnine.ggplot: the assembled plot.
+    """
+    basemap = 0 if mapdata is None else make_geom_chloro(mapdata, None)
+    arcs = [make_geom_flow(flowarcs, com, stage, color = color, size = arc_size) for com, stage, color in layers]
+    if layers and arc_size == "scaled":
+        arcs.insert(0, make_scale("size"))
+    points = [make_geom_points(bubbledata, color) for bubbledata, color in point_layers]
+    return (ggplot()
+            + basemap
+            + get_state_outline(level)
+            + arcs
+            + points
+            + scale_fill_manual(values = fill_gradients[colorval], drop = False)
+            + theme_void()
+            + theme(figure_size=(10,6), 
+                    panel_background=element_rect(fill="white"),
+                    legend_position="none"))
+
 # additional automation that isn't quite working yet
 
 # def make_map(components, scales):
@@ -0,0 +1,232 @@
+import numpy as np
+import scipy.sparse as sp
+from utils import ref_data
+from utils.ref_data import county_positions
+import geopandas as gpd
+import shapely
+from utils.flow_utils import arc_verts
+from utils.chain_graph import ChainGraph
+
+# chain tables carry, next to each FIPS column, the county's dense position in ref_data.county_fips
+# (0..N-1, -1 for codes that aren't ConUS counties): source_FIPS_0 -> source_pos_0,
+# destination_FIPS_i -> destination_pos_i. flows per stage are then sparse N x N
+# origin/destination matrices indexed by those positions.
+
+
+def add_positions(chain_data):
+    """add a dense county position column for every FIPS column of a chain dataframe"""
+    for col in [c for c in chain_data.columns if "_FIPS_" in c]:
+        chain_data[col.replace("_FIPS_", "_pos_")] = county_positions(chain_data[col]).astype(np.int32)
+    return chain_data
+
+
+def stage_nodes(stage):
+    """position columns of the origin and destination of a chain stage"""
+    source = "source_pos_0" if stage == 0 else f"destination_pos_{stage-1}"
+    return source, f"destination_pos_{stage}"
+
+
+def od_matrix(chain_data, stage, flow_unit = "kg"):
+    """
+    Origin/destination matrix of one chain stage: entry (i, j) is the summed flow
+    from county position i to county position j. Rows with unknown counties are left out.
+    """
+    source, dest = stage_nodes(stage)
+    s = chain_data[source].to_numpy()
+    d = chain_data[dest].to_numpy()
+    f = chain_data[f"flow_{flow_unit}_{stage}"].to_numpy()
+    known = (s >= 0) & (d >= 0)
+    n = len(ref_data.county_fips)
+    # converting to CSR sums the duplicate (i, j) entries
+    return sp.coo_matrix((f[known], (s[known], d[known])), shape = (n, n)).tocsr()
+
+
+def od_matrices(chain_data, steps = 2):
+    """
+    Stage OD matrices of a chain for each final destination commodity, from the
+    chain's graph (see chain_graph.ChainGraph), which builds all commodities of a stage at once.
+
+    Returns
+    -------
+    dict
+        {dest_final: [csr_matrix for stage 0, ..., stage steps-1]}
+    """
+    return ChainGraph(chain_data, steps).od_matrices()
+
+
+def node_totals(chain_data, node, flow_unit = "kg", od = None):
+    """
+    Summed flow through each county at one node of a chain: node 0 is the source county
+    of stage 0 (its outflow), node i the destination county of stage i-1 (its inflow).
+    Taken from the stage OD matrices when given, otherwise from chain_data.
+
+    Returns
+    -------
+    tuple
+        (county positions, flows) of the counties with flow
+    """
+    stage = max(node - 1, 0)
+    if od is not None:
+        totals = np.asarray(od[stage].sum(axis = 1 if node == 0 else 0)).ravel()
+    else:
+        pos = chain_data["source_pos_0" if node == 0 else f"destination_pos_{stage}"].to_numpy()
+        known = pos >= 0
+        totals = np.bincount(pos[known], weights = chain_data[f"flow_{flow_unit}_{stage}"].to_numpy()[known],
+                             minlength = len(ref_data.county_fips))
+    pos = np.flatnonzero(totals)
+    return pos, totals[pos]
+
+
+def build_points(chain_data, node, flow_unit = "kg", od = None):
+    """GeoDataFrame of county centroid points with their node_totals, columns GEOID, flowsize, geometry"""
+    pos, flow = node_totals(chain_data, node, flow_unit, od)
+    fips = ref_data.county_fips[pos]
+    xy = ref_data.county_centroids[fips]
+    return gpd.GeoDataFrame({"GEOID": fips,
+                "flowsize": flow,
+                "geometry": shapely.points(xy)})
+
+
+# arc reduction modes, as (mode, value):
+#   ("quantile", q)  drop flows in the bottom q quantile (build_flow's drop_bottom)
+#   ("topk", k)      keep the k largest flows
+#   ("share", s)     keep the largest flows that together carry a share s of the total flow
+#   ("state", None)  merge flows into state-to-state arcs between state centroids
+#   ("grid", size)   merge flows into arcs between grid cells of size degrees
+reduction_modes = ("quantile", "topk", "share", "state", "grid")
+
+
+def parse_reduction(text):
+    """parse a reduction written as "mode" or "mode:value", e.g. "share:0.95" """
+    mode, _, value = text.partition(":")
+    if mode not in reduction_modes:
+        raise ValueError(f"reduction mode must be one of {reduction_modes}")
+    if mode == "state":
+        return (mode, None)
+    return (mode, int(value) if mode == "topk" else float(value))
+
+
+def select_flows(flow, mode, value):
+    """boolean mask of the flows kept by a quantile, topk or share reduction"""
+    if mode == "quantile":
+        return flow > np.quantile(flow, value)
+    order = np.argsort(-flow, kind = "stable")
+    keep = np.zeros(len(flow), dtype = bool)
+    if mode == "topk":
+        keep[order[:value]] = True
+    elif mode == "share":
+        cum = np.cumsum(flow[order])
+        # keep every arc needed to reach the share, including the one that crosses it
+        keep[order[(cum - flow[order]) < value * cum[-1]]] = True
+    else:
+        raise ValueError(f"can't select flows with reduction mode {mode}")
+    return keep
+
+
+def node_groups(mode, value = None):
+    """
+    Coarser nodes for the aggregating reductions.
+
+    Returns
+    -------
+    tuple
+        (group index of each county position, (n_groups, 2) group coordinates, group codes)
+        group codes are state FIPS for "state" and cell numbers for "grid"
+    """
+    fips = ref_data.county_fips
+    xy = ref_data.county_centroids[fips]
+    if mode == "state":
+        codes, group = np.unique(fips // 1000, return_inverse = True)
+        return group, ref_data.state_centroids[codes], codes
+    if mode == "grid":
+        cells = np.floor(xy / value).astype(np.int64)
+        cell_codes = (cells[:, 0] + 1000) * 10000 + (cells[:, 1] + 1000)
+        codes, group = np.unique(cell_codes, return_inverse = True)
+        # cell arcs start and end at the mean centroid of the counties in the cell
+        counts = np.bincount(group)
+        cxy = np.column_stack([np.bincount(group, xy[:, 0]), np.bincount(group, xy[:, 1])]) / counts[:, None]
+        return group, cxy, codes
+    raise ValueError(f"reduction mode {mode} doesn't aggregate nodes")
+
+
+def flow_od_selection(od, drop_bottom = 0.1, reduction = None):
+    """
+    The arcs of build_flow_od without their vertices, as plain arrays that are cheap to pickle:
+    {"source", "dest", "flowsize", "p1", "p2" (end point coordinates), "counties" (True for
+    county to county arcs, which the arc store holds), "flow_share"}
+    """
+    mode, value = reduction if reduction is not None else ("quantile", drop_bottom)
+    od = od.tocoo()
+    source, dest, flow = od.row, od.col, od.data
+    total = flow[source != dest].sum()
+
+    if mode in ("state", "grid"):
+        group, xy, codes = node_groups(mode, value)
+        n = len(codes)
+        agg = sp.coo_matrix((flow, (group[source], group[dest])), shape = (n, n)).tocsr().tocoo()
+        keep = agg.row != agg.col
+        source, dest, flow = agg.row[keep], agg.col[keep], agg.data[keep]
+        source, dest, p1, p2 = codes[source], codes[dest], xy[source], xy[dest]
+    else:
+        if mode != "quantile":
+            inter = source != dest
+            source, dest, flow = source[inter], dest[inter], flow[inter]
+        if len(flow):
+            keep = select_flows(flow, mode, value) & (source != dest)
+            source, dest, flow = source[keep], dest[keep], flow[keep]
+        fips = ref_data.county_fips
+        centroids = ref_data.county_centroids
+        p1, p2 = centroids[fips[source]], centroids[fips[dest]]
+        found = ~(np.isnan(p1).any(axis = 1) | np.isnan(p2).any(axis = 1))
+        source, dest, flow = fips[source[found]], fips[dest[found]], flow[found]
+        p1, p2 = p1[found], p2[found]
+    return {"source": source, "dest": dest, "flowsize": flow, "p1": p1, "p2": p2,
+            "counties": mode not in ("state", "grid"),
+            "flow_share": float(flow.sum() / total) if total else 1.0}
+
+
+def selection_arrays(selection, arc_store = None):
+    """flow_od_selection output with the arc vertices, county arcs from arc_store when given"""
+    verts = arc_verts(selection["source"], selection["dest"], selection["p1"], selection["p2"],
+                      arc_store if selection["counties"] else None)
+    return {"source": selection["source"], "dest": selection["dest"], "flowsize": selection["flowsize"],
+            "verts": verts, "flow_share": selection["flow_share"]}
+
+
+def flow_od_arrays(od, drop_bottom = 0.1, arc_store = None, reduction = None):
+    """
+    The arcs of build_flow_od as plain arrays:
+    {"source", "dest", "flowsize", "verts" (n_arcs, n, 2), "flow_share"}
+    """
+    return selection_arrays(flow_od_selection(od, drop_bottom, reduction), arc_store)
+
+
+def arcs_from_arrays(arrays):
+    """GeoDataFrame of flow arcs from flow_od_arrays output"""
+    arcs = gpd.GeoDataFrame({"source": arrays["source"],
+                "dest": arrays["dest"],
+                "flowsize": arrays["flowsize"],
+                "geometry": shapely.linestrings(arrays["verts"])})
+    arcs.attrs["flow_share"] = arrays["flow_share"]
+    return arcs
+
+
+def build_flow_od(od, drop_bottom = 0.1, arc_store = None, reduction = None):
+    """
+    Flow arcs for an OD matrix, in the same form as flow_utils.build_flow:
+    flows in the bottom drop_bottom quantile are left out, as are flows within a county.
+    A reduction (see reduction_modes) replaces the drop_bottom rule.
+
+    The share of the total flow between different counties that the arcs carry is
+    stored in the result's attrs["flow_share"].
+    """
+    return arcs_from_arrays(flow_od_arrays(od, drop_bottom, arc_store, reduction))
+
+
+def stage_arc_selection(od, drop_bottom = 0.1, reduction = None):
+    """
+    flow_od_selection, for running in worker processes: the workers pick the arcs and send back
+    their end points, and the vertices come from the parent's arc store (see selection_arrays),
+    which is cheaper than pickling them back
+    """
+    return flow_od_selection(od, drop_bottom, reduction)
@@ -0,0 +1,42 @@
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# worker processes for building flow arcs and reading chain files; 0 or 1 runs everything in-process.
+# work is handed to the workers as plain arrays and results come back in submission order,
+# so the parallel and serial paths give the same output. workers are started from a forkserver
+# (spawned where there is none): the app has render and reload threads by the time a pool
+# starts, and forking a process with threads can deadlock the child
+workers = int(os.environ.get("F3_WORKERS", "0"))
+
+_pools = {}
+_lock = threading.Lock()
+
+
+def mp_context():
+    """multiprocessing context of the app's worker processes: forkserver, or spawn without one"""
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return multiprocessing.get_context(method)
+
+
+def get_pool(n = None):
+    """
+    Process pool with n workers (default: workers) shared by the whole process,
+    or None when work should run serially. Worker processes never start pools of their own.
+    """
+    n = workers if n is None else n
+    if n <= 1 or multiprocessing.parent_process() is not None:
+        return None
+    with _lock:
+        if n not in _pools:
+            _pools[n] = ProcessPoolExecutor(max_workers = n, mp_context = mp_context())
+        return _pools[n]
+
+
+def pool_map(fn, items, n = None):
+    """[fn(item) for item in items], spread over the shared pool when there is one"""
+    pool = get_pool(n)
+    if pool is None:
+        return [fn(item) for item in items]
+    return list(pool.map(fn, items))
@@ -0,0 +1,55 @@
+import time
+from shiny import reactive
+
+
+def debounce(delay_secs):
+    """
+    Debounce a reactive calc: the returned calc only takes on the value of f once f has
+    stopped changing for delay_secs, so a burst of input changes triggers one update.
+    Must be used inside a Shiny server function.
+
+    Usage::
+
+        @debounce(0.3)
+        @reactive.calc
+        def settled():
+            return input.x()
+    """
+    def wrapper(f):
+        when = reactive.value(None)
+        trigger = reactive.value(0)
+
+        @reactive.calc
+        def cached():
+            return f()
+
+        # every change of f pushes the deadline back
+        @reactive.effect(priority = 102)
+        def primer():
+            try:
+                cached()
+            except Exception:
+                pass
+            finally:
+                when.set(time.time() + delay_secs)
+
+        @reactive.effect(priority = 101)
+        def timer():
+            deadline = when()
+            if deadline is None:
+                return
+            time_left = deadline - time.time()
+            if time_left <= 0:
+                with reactive.isolate():
+                    when.set(None)
+                    trigger.set(trigger() + 1)
+            else:
+                reactive.invalidate_later(time_left)
+
+        @reactive.calc
+        @reactive.event(trigger, ignore_none = False)
+        def debounced():
+            return cached()
+
+        return debounced
+    return wrapper
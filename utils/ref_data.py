@@ -1,39 +1,278 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import numpy as np
 import pandas as pd
 import geopandas as gpd
+import shapely
 
 
-# read in geodata
-#TODO: convert everything to long,lat
-state_poly = gpd.read_file("data/ConUS_state_5070.gpkg")
-state_poly["centroid"] = state_poly.centroid
-state_points = state_poly[["GEOID","centroid"]].rename({"centroid":"geometry"}, axis=1)
-state_poly = state_poly.to_crs(epsg = "4326")
-state_points = state_points.to_crs(epsg = "4326")
+# reference geometry is read from the ConUS gpkg files once, reprojected to long,lat and
+# saved to ref_dir as flat coordinate arrays plus ring/part offsets (shapely ragged arrays).
+# workers memory-map those files and only build geometries when a layer is first used:
+# `from utils.ref_data import county_poly` or `ref_data.county_poly` loads it on demand.
+# the artifact is built in a temporary folder and its files are moved into ref_dir one by one,
+# so a worker that has a layer memory-mapped keeps reading the file it opened.
+state_file = "data/ConUS_state_5070.gpkg"
+county_file = "data/ConUS_county_5070.gpkg"
+ref_dir = "data/cache/refgeo/"
 
+# centroid arrays are indexed directly by FIPS code (state FIPS < 100, county FIPS < 100000)
+n_state_codes = 100
+n_county_codes = 100000
 
-county_poly = gpd.read_file("data/ConUS_county_5070.gpkg")
-county_poly["GEOID"]=county_poly["GEOID"].astype("int64")
-county_poly["centroid"] = county_poly.centroid
-county_poly = county_poly.to_crs(epsg = "4326")
-county_points = county_poly[["GEOID","centroid"]].rename({"centroid":"geometry"}, axis=1).to_crs(epsg = "4326")
-county_points['lon'] = county_points['geometry'].x
-county_points['lat'] = county_points['geometry'].y
-county_points_dict = {i: pt for i, pt in zip(county_points['GEOID'], county_points['geometry'])}
+# simplification tolerances (degrees) of the precomputed geometry levels; level 0 is full resolution.
+# levels are simplified as a coverage, so neighbouring polygons keep sharing their edges
+simplify_tolerances = (0.0, 0.005, 0.02, 0.05)
+# bump when the files of the artifact or their layout change
+reference_format = 2
+
+
+def reference_manifest():
+    """what an up to date artifact holds: format version, simplification tolerances and files"""
+    layers = [f"{kind}{suffix}" for kind in ["state", "county"]
+              for suffix in ["", *(f"_l{level}" for level in range(1, len(simplify_tolerances)))]]
+    files = [f"{layer}_{part}" for layer in layers for part in ["coords.npy", "layer.npz"]]
+    return {"format": reference_format,
+            "simplify_tolerances": list(simplify_tolerances),
+            "files": sorted(files + ["state_centroids.npy", "county_centroids.npy"])}
+
+
+def source_mtimes():
+    return np.array([os.path.getmtime(state_file), os.path.getmtime(county_file)])
+
+
+def save_layer(gdf, name, folder=ref_dir):
+    """save a GeoDataFrame as a coordinate array and an npz of offsets and attribute columns"""
+    geom_type, coords, offsets = shapely.to_ragged_array(gdf.geometry.values)
+    np.save(os.path.join(folder, f"{name}_coords.npy"), coords)
+    attrs = {f"attr_{c}": gdf[c].to_numpy() if gdf[c].dtype.kind in "iuf" else gdf[c].astype(str).to_numpy(dtype=str)
+             for c in gdf.columns if c != gdf.geometry.name}
+    offs = {f"offsets_{i}": o for i, o in enumerate(offsets)}
+    np.savez(os.path.join(folder, f"{name}_layer.npz"), geom_type=int(geom_type), **offs, **attrs)
+
+
+def load_layer(name, folder=ref_dir, geometry=True):
+    """load a layer saved by save_layer; with geometry=False only the attribute columns"""
+    with np.load(os.path.join(folder, f"{name}_layer.npz")) as layer:
+        attrs = pd.DataFrame({k[5:]: layer[k] for k in layer.files if k.startswith("attr_")})
+        if not geometry:
+            return attrs
+        offsets = tuple(layer[f"offsets_{i}"] for i in range(sum(k.startswith("offsets_") for k in layer.files)))
+        geom_type = shapely.GeometryType(int(layer["geom_type"]))
+    coords = np.load(os.path.join(folder, f"{name}_coords.npy"), mmap_mode="r")
+    geoms = shapely.from_ragged_array(geom_type, coords, offsets)
+    return gpd.GeoDataFrame(attrs, geometry=geoms, crs="EPSG:4326")
+
+
+def centroid_array(codes, points, size):
+    """(size, 2) long,lat array indexed by code, NaN where there is no point"""
+    arr = np.full((size, 2), np.nan)
+    arr[np.asarray(codes, dtype=np.int64)] = shapely.get_coordinates(points.values)
+    return arr
+
+
+def simplify_layer(gdf, tolerance):
+    """topology-preserving simplification of a polygon coverage"""
+    return gdf.set_geometry(shapely.coverage_simplify(gdf.geometry.to_numpy(), tolerance))
+
+
+def build_reference(folder=ref_dir):
+    """read the gpkg files, reproject to long,lat and write the reference geometry artifact"""
+    os.makedirs(folder, exist_ok=True)
+    build = tempfile.mkdtemp(prefix=".build-", dir=folder)
+    try:
+        _build_reference(build)
+        # source_mtimes.npy goes last: it marks the artifact as complete
+        names = sorted(os.listdir(build), key=lambda name: name == "source_mtimes.npy")
+        for name in names:
+            os.replace(os.path.join(build, name), os.path.join(folder, name))
+    finally:
+        shutil.rmtree(build, ignore_errors=True)
+
+
+def _build_reference(folder):
+    mtimes = source_mtimes()
+
+    state_poly = gpd.read_file(state_file)
+    state_centroid = state_poly.centroid.to_crs(epsg = "4326")
+    state_poly = state_poly.to_crs(epsg = "4326")
+    save_layer(state_poly, "state", folder)
+    for level, tol in enumerate(simplify_tolerances[1:], 1):
+        save_layer(simplify_layer(state_poly, tol), f"state_l{level}", folder)
+    np.save(os.path.join(folder, "state_centroids.npy"),
+            centroid_array(state_poly["GEOID"].astype("int64"), state_centroid, n_state_codes))
+
+    county_poly = gpd.read_file(county_file)
+    county_poly["GEOID"] = county_poly["GEOID"].astype("int64")
+    # keep counties sorted by FIPS so a county's row number doubles as its array position
+    county_poly = county_poly.sort_values("GEOID", ignore_index=True)
+    county_centroid = county_poly.centroid.to_crs(epsg = "4326")
+    county_poly = county_poly.to_crs(epsg = "4326")
+    save_layer(county_poly, "county", folder)
+    for level, tol in enumerate(simplify_tolerances[1:], 1):
+        save_layer(simplify_layer(county_poly, tol), f"county_l{level}", folder)
+    np.save(os.path.join(folder, "county_centroids.npy"),
+            centroid_array(county_poly["GEOID"], county_centroid, n_county_codes))
+
+    with open(os.path.join(folder, "manifest.json"), "w") as f:
+        json.dump(reference_manifest(), f)
+    # written last: marks the artifact as complete and records what it was built from
+    np.save(os.path.join(folder, "source_mtimes.npy"), mtimes)
+
+
+def reference_is_fresh(folder=ref_dir):
+    """
+    True if the artifact in folder was built from the current gpkg files, in the current
+    format and with the current simplification levels (see reference_manifest)
+    """
+    path = os.path.join(folder, "source_mtimes.npy")
+    if not os.path.exists(path) or not np.array_equal(np.load(path), source_mtimes()):
+        return False
+    try:
+        with open(os.path.join(folder, "manifest.json")) as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return False
+    return (manifest == reference_manifest()
+            and all(os.path.exists(os.path.join(folder, name)) for name in manifest["files"]))
+
+
+# lazily loaded layers
+
+def _state_poly():
+    return load_layer("state")
+
+def _state_centroids():
+    return np.load(os.path.join(ref_dir, "state_centroids.npy"), mmap_mode="r")
+
+def _state_points():
+    codes = get("state_poly")["GEOID"]
+    xy = get("state_centroids")[codes.astype("int64").to_numpy()]
+    return gpd.GeoDataFrame({"GEOID": codes}, geometry=gpd.points_from_xy(xy[:, 0], xy[:, 1]), crs="EPSG:4326")
+
+def _county_poly():
+    return load_layer("county")
+
+def _county_fips():
+    return load_layer("county", geometry=False)["GEOID"].to_numpy()
+
+def _county_centroids():
+    return np.load(os.path.join(ref_dir, "county_centroids.npy"), mmap_mode="r")
+
+def _county_points():
+    fips = get("county_fips")
+    xy = get("county_centroids")[fips]
+    county_points = gpd.GeoDataFrame({"GEOID": fips}, geometry=gpd.points_from_xy(xy[:, 0], xy[:, 1]), crs="EPSG:4326")
+    county_points['lon'] = xy[:, 0]
+    county_points['lat'] = xy[:, 1]
+    return county_points
+
+def _county_points_dict():
+    county_points = get("county_points")
+    return {i: pt for i, pt in zip(county_points['GEOID'], county_points['geometry'])}
+
+def _geopoints():
+    geopoints = {}
+    geopoints['FIPS'] = get("county_points")
+    #geopoints['facility'] = facilities_points
+    return geopoints
+
+def _arcdicts():
+    arcdicts = {}
+    arcdicts['FIPS'] = get("county_points_dict")
+    #arcdicts['facility'] = fac_points_dict
+    return arcdicts
 
 # fac_data = pd.read_csv("data/company_location_fips_2017_v5.csv")
-# facilities_points = (gpd.GeoDataFrame(fac_data, 
+# facilities_points = (gpd.GeoDataFrame(fac_data,
 #         geometry=gpd.points_from_xy(fac_data.longitude,fac_data.latitude))
 #         .set_crs(epsg="4326"))
 # facilities_points["code"]= facilities_points["code"].astype(int)
 # fac_points_dict = {i: pt for i, pt in zip(facilities_points['code'], facilities_points['geometry'])}
 
-geopoints = {}
-geopoints['FIPS'] = county_points
-#geopoints['facility'] = facilities_points
+_loaders = {
+    "state_poly": _state_poly,
+    "state_centroids": _state_centroids,
+    "state_points": _state_points,
+    "county_poly": _county_poly,
+    "county_fips": _county_fips,
+    "county_centroids": _county_centroids,
+    "county_points": _county_points,
+    "county_points_dict": _county_points_dict,
+    "geopoints": _geopoints,
+    "arcdicts": _arcdicts,
+}
+_loaded = {}
+_lock = threading.RLock()
+
+
+def get(name):
+    """load a reference layer on first use, (re)building the artifact if the gpkg files changed"""
+    with _lock:
+        if name not in _loaded:
+            if not _loaded and not reference_is_fresh():
+                build_reference()
+            _loaded[name] = _loaders[name]()
+        return _loaded[name]
+
+
+def loaded():
+    """the reference layers loaded so far, by name (see get and poly_level)"""
+    with _lock:
+        return dict(_loaded)
+
+
+def preload(layers):
+    """
+    Install already built layers, e.g. from a startup snapshot; once any layer is loaded
+    the gpkg files aren't checked again.
+    """
+    with _lock:
+        _loaded.update(layers)
+
+
+def poly_level(kind, level=0):
+    """
+    county ("county") or state ("state") polygons simplified to one of the simplify_tolerances
+    levels, with the same rows as county_poly / state_poly
+    """
+    if level == 0:
+        return get(f"{kind}_poly")
+    name = f"{kind}_poly_l{level}"
+    with _lock:
+        if name not in _loaded:
+            get(f"{kind}_poly")
+            _loaded[name] = load_layer(f"{kind}_l{level}")
+        return _loaded[name]
+
+
+def pick_level(width_px, zoom=1.0):
+    """
+    coarsest simplification level whose tolerance stays below one output pixel,
+    for a map of the contiguous US drawn width_px pixels wide at the given zoom factor
+    """
+    minx, _, maxx, _ = get("state_poly").total_bounds
+    deg_per_px = (maxx - minx) / zoom / width_px
+    return max(level for level, tol in enumerate(simplify_tolerances) if tol <= deg_per_px)
+
+
+def __getattr__(name):
+    if name in _loaders:
+        return get(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def county_positions(fips):
+    """row positions of FIPS codes in county_poly, -1 for codes that aren't ConUS counties"""
+    county_fips = get("county_fips")
+    fips = np.asarray(fips, dtype=np.int64)
+    pos = np.searchsorted(county_fips, fips)
+    pos[pos == len(county_fips)] = 0
+    return np.where(county_fips[pos] == fips, pos, -1)
 
-arcdicts = {}
-arcdicts['FIPS']=county_points_dict
-#arcdicts['facility'] = fac_points_dict
 
 # brand colors
 colors = {
@@ -47,3 +286,9 @@ colors = {
     "soy":"#4f873b",
     "cows":"#bbb9c8"
 }
+
+
+if __name__ == "__main__":
+    # regenerate the reference geometry artifact: python -m utils.ref_data
+    build_reference()
+    print(f"reference geometry written to {ref_dir}")
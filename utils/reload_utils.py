@@ -0,0 +1,130 @@
+import glob
+import hashlib
+import os
+import threading
+import time
+
+# hot reload of data files: a FileWatcher polls a set of glob patterns and reports the files
+# whose content changed, appeared or went away since the last poll. a file is only reported
+# once its size and mtime have stayed the same for a whole poll interval, so a file that is
+# still being written is picked up on the poll after the writer is done. a changed mtime or
+# size is confirmed by a content hash, so touching or copying a file over with the same bytes
+# doesn't trigger a reload.
+#
+#   watcher = FileWatcher(["Chains/*/*_full.csv"])
+#   watch(watcher, on_change, interval=5)      # on_change(changed, removed) on a daemon thread
+
+
+def content_hash(path, blocksize=2**20):
+    """sha256 of a file's content"""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(blocksize):
+            h.update(block)
+    return h.hexdigest()
+
+
+def stat_signature(path):
+    """(size, mtime_ns) of a file, None if it doesn't exist"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+class FileWatcher:
+    """
+    Changes to the files matching a list of glob patterns, found by polling.
+
+    Parameters
+    ----------
+    patterns : list of str
+        glob patterns of the watched files
+    hash_baseline : bool
+        hash the files present at the first poll, so a later touch that leaves the content
+        as it was isn't reported; without it, any change of size or mtime of those files is
+        reported on its first occurrence
+    """
+
+    def __init__(self, patterns, hash_baseline=True):
+        self.patterns = list(patterns)
+        self.hash_baseline = hash_baseline
+        # path: (signature, content hash) of the last reported (or baseline) version
+        self._known = None
+        # path: signature seen at the last poll, for files that changed but may still be written
+        self._pending = {}
+
+    def files(self):
+        return sorted({path for pattern in self.patterns for path in glob.glob(pattern)})
+
+    def poll(self):
+        """
+        Files that changed since the last poll and have since stopped changing.
+        The first poll records the current files and reports nothing.
+
+        Returns
+        -------
+        tuple of list of str
+            (changed or new files, removed files)
+        """
+        current = {path: stat_signature(path) for path in self.files()}
+        current = {path: sig for path, sig in current.items() if sig is not None}
+        if self._known is None:
+            self._known = {path: (sig, content_hash(path) if self.hash_baseline else None)
+                           for path, sig in current.items()}
+            return [], []
+        changed = []
+        for path, sig in current.items():
+            known = self._known.get(path)
+            if known is not None and known[0] == sig:
+                self._pending.pop(path, None)
+                continue
+            if self._pending.get(path) != sig:
+                # seen changing: wait a poll to be sure the writer is done with it
+                self._pending[path] = sig
+                continue
+            del self._pending[path]
+            digest = content_hash(path)
+            if known is None or known[1] != digest:
+                changed.append(path)
+            self._known[path] = (sig, digest)
+        removed = sorted(set(self._known) - set(current))
+        for path in removed:
+            del self._known[path]
+            self._pending.pop(path, None)
+        return changed, removed
+
+
+def watch(watcher, on_change, interval=5.0, stop=None):
+    """
+    Poll watcher every interval seconds on a daemon thread and call on_change(changed, removed)
+    whenever files changed. Errors in on_change are printed and the thread keeps watching.
+
+    Returns
+    -------
+    tuple
+        (thread, threading.Event that stops it when set)
+    """
+    stop = threading.Event() if stop is None else stop
+
+    def run():
+        while True:
+            try:
+                changed, removed = watcher.poll()
+                if changed or removed:
+                    on_change(changed, removed)
+            except Exception as e:
+                print(f"WARNING: data reload failed: {e!r}")
+            if stop.wait(interval):
+                return
+
+    thread = threading.Thread(target=run, name="reload", daemon=True)
+    thread.start()
+    return thread, stop
+
+
+def newest_mtime(paths):
+    """latest modification time (seconds since the epoch) of the existing files in paths, or now"""
+    mtimes = [sig[1] / 1e9 for sig in map(stat_signature, paths) if sig is not None]
+    return max(mtimes) if mtimes else time.time()
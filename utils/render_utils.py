@@ -0,0 +1,301 @@
+import threading
+import numpy as np
+import shapely
+import matplotlib.colors as mcolors
+import matplotlib.image as mimage
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import PolyCollection, LineCollection, PathCollection
+from matplotlib.path import Path
+from utils import ref_data
+from utils.ref_data import county_positions, colors
+
+# fast matplotlib rendering of the same map the plotnine path draws:
+# county fills, state outlines and flow arcs, without building a ggplot
+
+# plotnine draws a line of size s with linewidth s * sqrt(pi)
+SIZE_FACTOR = np.sqrt(np.pi)
+
+
+def ring_vertices(geoms):
+    """
+    Exterior ring vertices of every polygon part in geoms.
+
+    Returns
+    -------
+    tuple
+        (list of (n, 2) vertex arrays, one per polygon part,
+        np.ndarray with the row in geoms each part belongs to)
+    """
+    parts, owner = shapely.get_parts(np.asarray(geoms), return_index=True)
+    rings = shapely.get_exterior_ring(parts)
+    return line_vertices(rings), owner
+
+
+def polygon_paths(geoms):
+    """
+    One compound path per polygon part in geoms: the exterior ring and its holes, the holes
+    running the other way round, so the holes are left unfilled.
+
+    Returns
+    -------
+    tuple
+        (list of matplotlib Paths, one per polygon part,
+        np.ndarray with the row in geoms each part belongs to)
+    """
+    parts, owner = shapely.get_parts(np.asarray(geoms), return_index=True)
+    if not len(parts):
+        return [], owner
+    parts = shapely.orient_polygons(parts)
+    _, coords, (ring_offsets, part_offsets) = shapely.to_ragged_array(parts)
+    codes = np.full(len(coords), Path.LINETO, dtype=Path.code_type)
+    codes[ring_offsets[:-1]] = Path.MOVETO
+    codes[ring_offsets[1:] - 1] = Path.CLOSEPOLY
+    bounds = ring_offsets[part_offsets]
+    return [Path(coords[a:b], codes[a:b]) for a, b in zip(bounds[:-1], bounds[1:])], owner
+
+
+def boundary_vertices(geoms):
+    """vertex arrays of every ring, exterior and interior, of the polygons in geoms"""
+    return line_vertices(shapely.get_parts(shapely.boundary(np.asarray(geoms))))
+
+
+def line_vertices(lines):
+    """vertex arrays of each linestring/ring in lines"""
+    coords = shapely.get_coordinates(lines)
+    counts = shapely.get_num_coordinates(lines)
+    return np.split(coords, np.cumsum(counts)[:-1])
+
+
+class FastRenderer:
+    """
+    Draws choropleth and flow arc maps straight onto a matplotlib Agg canvas.
+
+    The figure, axes limits and the blank panel are set up once and saved as a blitted
+    background. County polygons and state outlines are built once as collections from
+    their vertex arrays; a render only restores the background, recolors the county
+    fills and draws the arc layers on top.
+
+    Parameters
+    ----------
+    figsize : tuple
+        figure size in inches, same as the plotnine theme figure_size
+    dpi : int
+        output resolution
+    level : int, optional
+        simplification level of the county and state polygons, by default the coarsest
+        one that is still finer than a pixel (see ref_data.pick_level)
+    """
+
+    def __init__(self, figsize=(10, 6), dpi=100, level=None):
+        self.dpi = dpi
+        self.level = ref_data.pick_level(figsize[0] * dpi) if level is None else level
+        self.fig = Figure(figsize=figsize, dpi=dpi, facecolor="white")
+        self.canvas = FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_axes([0, 0, 1, 1])
+        self.ax.set_axis_off()
+        self.map_bounds = tuple(ref_data.state_poly.total_bounds)
+        self.bounds = None
+
+        county_paths, self.county_owner = polygon_paths(ref_data.poly_level("county", self.level).geometry)
+        self.counties = PathCollection(county_paths, linewidths=0.1 * SIZE_FACTOR, animated=True)
+        self.ax.add_collection(self.counties)
+        state_rings = boundary_vertices(ref_data.poly_level("state", self.level).geometry)
+        self.states = LineCollection(state_rings, colors="#000000",
+                                     linewidths=0.2 * SIZE_FACTOR, animated=True)
+        self.ax.add_collection(self.states)
+
+        self.set_bounds(self.map_bounds)
+        self._lock = threading.Lock()
+
+    def set_bounds(self, bounds):
+        """
+        Axes limits for data bounds (minx, miny, maxx, maxy), with the same 5% padding plotnine
+        adds around continuous scales; the blank background is saved again when they change
+        """
+        if bounds == self.bounds:
+            return
+        minx, miny, maxx, maxy = bounds
+        padx, pady = 0.05 * (maxx - minx), 0.05 * (maxy - miny)
+        self.ax.set_xlim(minx - padx, maxx + padx)
+        self.ax.set_ylim(miny - pady, maxy + pady)
+        self.canvas.draw()
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+        self.bounds = bounds
+
+    def layer_bounds(self, arc_layers, point_layers):
+        """bounds of the map and every layer drawn on it, as plotnine's scales would train on them"""
+        bounds = [self.map_bounds]
+        for layer in [*arc_layers, *point_layers]:
+            if len(layer[0]):
+                bounds.append(tuple(layer[0].total_bounds))
+        bounds = np.array(bounds)
+        return (*bounds[:, :2].min(axis=0).tolist(), *bounds[:, 2:].max(axis=0).tolist())
+
+    def county_colors(self, mapdata, fill_values):
+        """
+        Face and edge colors for every county: the colorbin fill for counties in mapdata,
+        transparent for the rest. Fill values are assigned to the colorbin categories in
+        order, as scale_fill_manual does.
+        """
+        face = np.zeros((len(ref_data.county_fips), 4))
+        edge = np.zeros((len(ref_data.county_fips), 4))
+        if mapdata is not None and len(mapdata):
+            pos = county_positions(mapdata["source_FIPS_0"])
+            palette = mcolors.to_rgba_array(fill_values)
+            face[pos] = palette[mapdata["colorbin"].cat.codes.to_numpy()]
+            edge[pos] = mcolors.to_rgba("white")
+        return face[self.county_owner], edge[self.county_owner]
+
+    def arc_collections(self, arc_layers):
+        """LineCollections for (arcs GeoDataFrame, color, size) layers, in drawing order"""
+        scaled = [arcs["flowsize"].to_numpy() for arcs, _, size in arc_layers if size == "scaled"]
+        if scaled and len(np.concatenate(scaled)):
+            lo, hi = np.min(np.concatenate(scaled)), np.max(np.concatenate(scaled))
+        collections = []
+        for arcs, color, size in arc_layers:
+            if len(arcs) == 0:
+                continue
+            if size == "scaled":
+                # scale_size_continuous(range = [0,1]) maps flows to sizes by area
+                rel = (arcs["flowsize"].to_numpy() - lo) / (hi - lo) if hi > lo else np.ones(len(arcs))
+                widths = np.sqrt(rel) * SIZE_FACTOR
+            else:
+                widths = 0.2 * SIZE_FACTOR
+            collections.append(LineCollection(line_vertices(arcs.geometry.to_numpy()),
+                                              colors=color, linewidths=widths))
+        return collections
+
+    def point_collections(self, point_layers):
+        """PolyCollections for (bubbles GeoDataFrame, color) layers, in drawing order"""
+        collections = []
+        for bubbles, color in point_layers:
+            if len(bubbles) == 0:
+                continue
+            rings, _ = ring_vertices(bubbles.geometry.to_numpy())
+            collections.append(PolyCollection(rings, facecolors=mcolors.to_rgba(color, 0.7),
+                                              edgecolors="white", linewidths=0.1 * SIZE_FACTOR))
+        return collections
+
+    def render(self, path, mapdata, fill_values, arc_layers=(), point_layers=()):
+        """
+        Render a map to a PNG file.
+
+        Parameters
+        ----------
+        path : str
+            output file
+        mapdata : gpd.GeoDataFrame or None
+            output of build_chloro, or None for no choropleth
+        fill_values : list of str
+            colors for the colorbin categories (e.g. fill_gradients["corn"])
+        arc_layers : list of tuple
+            (arcs GeoDataFrame, color, "fixed" or "scaled") per arc layer, bottom to top
+        point_layers : list of tuple
+            (bubbles GeoDataFrame, color) per point layer, drawn over the arcs
+        """
+        face, edge = self.county_colors(mapdata, fill_values)
+        arcs = self.arc_collections(arc_layers) + self.point_collections(point_layers)
+        with self._lock:
+            # arcs can bulge past the map, and plotnine widens the panel to fit them
+            self.set_bounds(self.layer_bounds(arc_layers, point_layers))
+            self.canvas.restore_region(self.background)
+            self.counties.set_facecolor(face)
+            self.counties.set_edgecolor(edge)
+            self.ax.draw_artist(self.counties)
+            self.ax.draw_artist(self.states)
+            for coll in arcs:
+                self.ax.add_collection(coll, autolim=False)
+                self.ax.draw_artist(coll)
+                coll.remove()
+            image = np.asarray(self.canvas.buffer_rgba()).copy()
+        mimage.imsave(path, image, dpi=self.dpi)
+        return path
+
+
+_renderers = {}
+_renderer_lock = threading.Lock()
+
+def get_renderer(level=None):
+    """the process-wide FastRenderer for a simplification level, created on first use"""
+    with _renderer_lock:
+        if level not in _renderers:
+            _renderers[level] = FastRenderer(level=level)
+        return _renderers[level]
+
+
+def arc_layers(com, stages):
+    """
+    Arc layers for the selected commodities and stages, bottom to top:
+    with one stage the arcs are drawn in the commodity color, with both stages the
+    second stage is drawn in the commodity color under the first stage in dark grey.
+
+    Returns
+    -------
+    list of tuple
+        (commodity, stage, color) per layer
+    """
+    layers = []
+    for c in com:
+        if len(stages) == 1:
+            layers.append((c, stages[0], colors[c]))
+        elif len(stages) == 2:
+            layers.append((c, 1, colors[c]))
+            layers.append((c, 0, "#2c2c2c"))
+    return layers
+
+
+def point_layers(com, nodes, steps, colorval):
+    """
+    Point layers for the selected commodities and chain nodes (0 is the source county,
+    i the destination of stage i-1): source counties in the crop color, final destinations
+    in the commodity color and intermediate nodes in dark grey.
+
+    Returns
+    -------
+    list of tuple
+        (commodity, node, color) per layer
+    """
+    layers = []
+    for c in com:
+        for node in nodes:
+            color = colors[colorval] if node == 0 else colors[c] if node == steps else "#2c2c2c"
+            layers.append((c, node, color))
+    return layers
+
+
+def level_report(path="/tmp/f3_level_report.png"):
+    """
+    Vertex counts of the county and state polygons at each simplification level, with
+    the time to draw every county filled plus state outlines with the fast renderer and
+    with plotnine.
+    """
+    import time
+    import pandas as pd
+    from plotnine import ggplot, geom_map, theme_void, theme
+    rows = []
+    for level, tol in enumerate(ref_data.simplify_tolerances):
+        counties = ref_data.poly_level("county", level)
+        states = ref_data.poly_level("state", level)
+        mapdata = counties.assign(source_FIPS_0=counties["GEOID"],
+                                  colorbin=pd.Categorical(np.arange(len(counties)) % 4))
+        renderer = FastRenderer(level=level)
+        t = time.perf_counter()
+        renderer.render(path, mapdata, ["#f7e8bf", "#efd48c", "#e9c362", "#e3b338"])
+        fast = time.perf_counter() - t
+        t = time.perf_counter()
+        (ggplot() + geom_map(mapdata, fill="#e3b338", color="white", size=0.1)
+            + geom_map(states, color="#000000", fill=None, size=0.2)
+            + theme_void() + theme(figure_size=(10, 6))).save(path, dpi=100, verbose=False)
+        slow = time.perf_counter() - t
+        rows.append({"level": level, "tolerance": tol,
+                     "county_vertices": int(shapely.get_num_coordinates(counties.geometry.to_numpy()).sum()),
+                     "state_vertices": int(shapely.get_num_coordinates(states.geometry.to_numpy()).sum()),
+                     "fast_render_s": round(fast, 3), "plotnine_render_s": round(slow, 3)})
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    # geometry level benchmark: python -m utils.render_utils
+    print(level_report().to_string(index=False))
+    print("level picked for 1000 px maps:", ref_data.pick_level(1000))
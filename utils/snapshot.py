@@ -0,0 +1,312 @@
+import argparse
+import contextlib
+import datetime
+import glob
+import hashlib
+import json
+import mmap
+import os
+import pickle
+import platform
+import struct
+import subprocess
+import sys
+import time
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import scipy
+import shapely
+from utils import ref_data
+from utils.fingerprint import data_fingerprint
+
+# startup snapshot: the prepared in-memory state of shared.py (chains with county positions,
+# chain graphs, OD matrices, choropleth cubes) and the reference layers loaded so far, in one
+# file a worker memory-maps and unpickles instead of reading and preparing everything again.
+#
+#   F3_SNAPSHOT=1 shiny run app.py          use a fresh snapshot, writing one first if needed
+#   python -m utils.snapshot build          write it ahead of time, with the map geometry prewarmed
+#   python -m utils.snapshot report         per-component startup times, with and without it
+#   python -m utils.snapshot report --budget 5 --compare startup.json
+#                                           fail if startup is over budget or slower than a saved report
+#
+# the file is pickle protocol 5 with every array buffer stored out of band: a magic number,
+# a little-endian uint64 header length, a JSON header, then the pickle stream and the buffers,
+# each starting on a 64-byte boundary. loading hands pickle read-only views of the mapped
+# file, so arrays aren't copied and every worker on a machine shares the same pages.
+# polygon layers are stored as shapely ragged arrays and rebuilt in one call each.
+#
+# snapshots are named by a fingerprint of the chain and geometry files, the code that prepares
+# the state, the load settings and the library versions; any change gives a new name, so a
+# stale snapshot is never read.
+
+snapshot_dir = "data/cache/snapshot/"
+snapshot_mode = os.environ.get("F3_SNAPSHOT", "0") == "1"
+# bump when the layout of the file or of the pickled state changes
+snapshot_version = 1
+magic = b"F3SNAP\x00\x01"
+_align = 64
+# modules whose code decides what the prepared state looks like
+source_files = ["shared.py", "utils/data_utils.py", "utils/od_utils.py", "utils/chain_graph.py",
+                "utils/chloro_cube.py", "utils/emissions.py", "utils/ref_data.py", "utils/snapshot.py"]
+
+# seconds spent on each component of startup in this process, in the order they ran
+startup_times = {}
+
+
+@contextlib.contextmanager
+def timed(component):
+    """add the time spent in the block to startup_times[component]"""
+    t = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_times[component] = startup_times.get(component, 0.0) + time.perf_counter() - t
+
+
+def fingerprint(data_patterns, settings):
+    """snapshot name for the data files matching data_patterns and the load settings (a dict)"""
+    versions = {"python": platform.python_version(), "numpy": np.__version__, "pandas": pd.__version__,
+                "scipy": scipy.__version__, "shapely": shapely.__version__, "snapshot": snapshot_version}
+    h = hashlib.sha256()
+    h.update(data_fingerprint([*data_patterns, ref_data.state_file, ref_data.county_file]).encode())
+    h.update(data_fingerprint(source_files).encode())
+    h.update(json.dumps({**settings, **versions}, sort_keys=True).encode())
+    return h.hexdigest()[:16]
+
+
+def snapshot_path(key, folder=snapshot_dir):
+    return os.path.join(folder, f"state_{key}.snap")
+
+
+def _encode_layers(layers):
+    """reference layers worth keeping: arrays as they are, GeoDataFrames as ragged arrays"""
+    encoded = {}
+    for name, layer in layers.items():
+        if isinstance(layer, gpd.GeoDataFrame):
+            geom_type, coords, offsets = shapely.to_ragged_array(layer.geometry.values)
+            attrs = pd.DataFrame(layer.drop(columns=layer.geometry.name))
+            encoded[name] = ("geo", attrs, int(geom_type), coords, offsets, layer.crs.to_string())
+        elif isinstance(layer, np.ndarray):
+            encoded[name] = ("array", np.asarray(layer))
+    return encoded
+
+
+def _decode_layers(encoded):
+    layers = {}
+    for name, (kind, *parts) in encoded.items():
+        if kind == "geo":
+            attrs, geom_type, coords, offsets, crs = parts
+            geoms = shapely.from_ragged_array(shapely.GeometryType(geom_type), coords, offsets)
+            layers[name] = gpd.GeoDataFrame(attrs, geometry=geoms, crs=crs)
+        else:
+            layers[name] = parts[0]
+    return layers
+
+
+def write_snapshot(state, key, folder=snapshot_dir, layers=None):
+    """
+    Write state (any picklable object) and the reference layers loaded so far (or layers)
+    to the snapshot named key, replacing older snapshots in folder.
+
+    Returns
+    -------
+    str
+        path of the snapshot
+    """
+    os.makedirs(folder, exist_ok=True)
+    layers = ref_data.loaded() if layers is None else layers
+    buffers = []
+    stream = pickle.dumps({"state": state, "layers": _encode_layers(layers)}, protocol=5,
+                          buffer_callback=buffers.append)
+    chunks = [stream, *(b.raw() for b in buffers)]
+    spans, offset = [], 0
+    for chunk in chunks:
+        spans.append([offset, chunk.nbytes if isinstance(chunk, memoryview) else len(chunk)])
+        offset += -(-spans[-1][1] // _align) * _align
+    header = json.dumps({"version": snapshot_version, "key": key,
+                         "created": datetime.datetime.now().isoformat(timespec="seconds"),
+                         "layers": sorted(layers), "pickle": spans[0], "buffers": spans[1:]}).encode()
+    start = -(-(len(magic) + 8 + len(header)) // _align) * _align
+    path = snapshot_path(key, folder)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(magic + struct.pack("<Q", len(header)) + header)
+        for chunk, (off, _) in zip(chunks, spans):
+            f.seek(start + off)
+            f.write(chunk)
+    # readers only ever see a complete file
+    os.replace(tmp, path)
+    for old in glob.glob(os.path.join(folder, "state_*.snap")):
+        if old != path:
+            os.remove(old)
+    return path
+
+
+def read_snapshot(path):
+    """
+    Map a snapshot file and unpickle it; arrays are read-only views of the mapping.
+
+    Returns
+    -------
+    tuple
+        (header dict, state, reference layers)
+    """
+    with open(path, "rb") as f:
+        view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    if bytes(view[:len(magic)]) != magic:
+        raise ValueError(f"{path} is not a startup snapshot")
+    (length,) = struct.unpack("<Q", view[len(magic):len(magic) + 8])
+    header = json.loads(bytes(view[len(magic) + 8:len(magic) + 8 + length]))
+    if header["version"] != snapshot_version:
+        raise ValueError(f"{path} is snapshot version {header['version']}, expected {snapshot_version}")
+    start = -(-(len(magic) + 8 + length) // _align) * _align
+    off, n = header["pickle"]
+    buffers = [view[start + o:start + o + m] for o, m in header["buffers"]]
+    data = pickle.loads(view[start + off:start + off + n], buffers=buffers)
+    return header, data["state"], _decode_layers(data["layers"])
+
+
+def load_snapshot(key, folder=snapshot_dir):
+    """
+    The state of the snapshot named key, with its reference layers installed in ref_data,
+    or None if there is no such snapshot.
+    """
+    path = snapshot_path(key, folder)
+    if not os.path.exists(path):
+        return None
+    with timed("snapshot_load"):
+        _, state, layers = read_snapshot(path)
+        ref_data.preload(layers)
+    return state
+
+
+def prewarm():
+    """load the reference layers the first maps and the interactive map need"""
+    from map_render import map_level
+    from utils.web_map import geometry_level
+    level = map_level()
+    for kind in ["county", "state"]:
+        ref_data.poly_level(kind, level)
+        ref_data.poly_level(kind, geometry_level)
+    ref_data.get("county_centroids")
+    ref_data.get("state_centroids")
+
+
+def probe():
+    """import the app the way a worker does, timing each component; prints JSON"""
+    with timed("libraries"):
+        import geopandas, scipy.sparse, shapely, pyarrow  # noqa: F401
+    with timed("plotnine"):
+        import plotnine  # noqa: F401
+    with timed("shiny"):
+        import shiny  # noqa: F401
+    # shared times its own components into startup_times
+    import shared  # noqa: F401
+    with timed("map_render"):
+        import map_render  # noqa: F401
+    with timed("app"):
+        import app  # noqa: F401
+    with timed("first_map_geometry"):
+        prewarm()
+    print(json.dumps(startup_times))
+
+
+def startup_report(modes=("cold", "snapshot"), repeat=3):
+    """
+    Startup time of each component in fresh interpreters, without ("cold") and with a
+    startup snapshot; best of repeat runs. The snapshot is written first if needed.
+
+    Returns
+    -------
+    list of dict
+        {"mode", "stage", "seconds", "peak_mb"}; stage "total" is the wall time of the process
+    """
+    rows = []
+    for mode in modes:
+        env = {**os.environ, "F3_SNAPSHOT": "1" if mode == "snapshot" else "0"}
+        if mode == "snapshot":
+            subprocess.run([sys.executable, "-m", "utils.snapshot", "build", "--quiet"], env=env, check=True)
+        best = {}
+        for _ in range(repeat):
+            t = time.perf_counter()
+            out = subprocess.run([sys.executable, "-c",
+                                  "import resource, sys; from utils.snapshot import probe; probe(); "
+                                  "print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, file=sys.stderr)"],
+                                 env=env, capture_output=True, text=True, check=True)
+            times = json.loads(out.stdout.strip().splitlines()[-1])
+            times["total"] = time.perf_counter() - t
+            rss = int(out.stderr.strip().splitlines()[-1]) / 1024
+            for stage, seconds in times.items():
+                if stage not in best or seconds < best[stage][0]:
+                    best[stage] = (seconds, rss)
+        rows += [{"mode": mode, "stage": stage, "seconds": round(seconds, 4), "peak_mb": round(rss, 1)}
+                 for stage, (seconds, rss) in best.items()]
+    return rows
+
+
+def check_startup(rows, budget=None, baseline=None, threshold=0.25, min_seconds=0.05):
+    """
+    Startup regressions: snapshot-mode startups whose total time is over budget (seconds), and
+    components slower than in baseline (rows of an earlier report) by more than threshold (a
+    fraction). Components faster than min_seconds in the baseline are too noisy to check.
+
+    Returns
+    -------
+    list of str
+        one line per regression
+    """
+    regressions = []
+    if budget is not None:
+        for r in rows:
+            if r["mode"] == "snapshot" and r["stage"] == "total" and r["seconds"] > budget:
+                regressions.append(f"snapshot startup: {r['seconds']:.3f}s over the {budget:.3f}s budget")
+    old = {(r["mode"], r["stage"]): r for r in baseline or []}
+    for r in rows:
+        b = old.get((r["mode"], r["stage"]))
+        if b is not None and b["seconds"] >= min_seconds and r["seconds"] > b["seconds"] * (1 + threshold):
+            regressions.append(f"{r['mode']} {r['stage']}: {b['seconds']:.3f}s -> {r['seconds']:.3f}s")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="build or time the startup snapshot")
+    parser.add_argument("command", choices=["build", "report"])
+    parser.add_argument("--repeat", type=int, default=3, help="report: runs per mode")
+    parser.add_argument("--quiet", action="store_true")
+    parser.add_argument("--output", help="report: write the rows to this JSON file")
+    parser.add_argument("--budget", type=float, help="report: fail if a snapshot startup takes longer (seconds)")
+    parser.add_argument("--compare", metavar="BASELINE", help="report: JSON rows of an earlier report")
+    parser.add_argument("--threshold", type=float, default=0.25, help="report: allowed slowdown, as a fraction")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        # always prepare the state from the data, then snapshot it
+        os.environ["F3_SNAPSHOT"] = "0"
+        # shared times its components into the importable module, not this __main__ one
+        from utils import snapshot
+        t = time.perf_counter()
+        import shared
+        snapshot.prewarm()
+        path = snapshot.write_snapshot(shared.state, shared.snapshot_key)
+        if not args.quiet:
+            print(f"{path}: {os.path.getsize(path) / 2**20:.1f} MB, built in {time.perf_counter() - t:.1f}s")
+            for name, seconds in snapshot.startup_times.items():
+                print(f"  {name:<20} {seconds:8.3f}s")
+    else:
+        rows = startup_report(repeat=args.repeat)
+        for row in rows:
+            print(f"{row['mode']:<9} {row['stage']:<20} {row['seconds']:8.3f}s {row['peak_mb']:8.1f} MB")
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(rows, f, indent=1)
+        if args.budget is not None or args.compare:
+            baseline = None
+            if args.compare:
+                with open(args.compare) as f:
+                    baseline = json.load(f)
+            regressions = check_startup(rows, args.budget, baseline, args.threshold)
+            for line in regressions:
+                print("REGRESSION", line)
+            print(f"{len(regressions)} startup regressions")
+            sys.exit(1 if regressions else 0)
@@ -0,0 +1,50 @@
+import glob
+import os
+import numpy as np
+import pandas as pd
+
+# synthetic chain files for benchmarks: same file names and columns as a Chains/ folder,
+# with scale times as many rows
+
+
+def synth_chains(template_folder, out_folder, scale=1, seed=0, reroute=0.2):
+    """
+    Write chain CSVs shaped like the "_full.csv" files in template_folder, with scale
+    times as many rows.
+
+    The first rows of every file are the template rows unchanged, so a scale of 1 is a
+    copy of the template. The extra rows are resampled from the template with flows and
+    emissions scaled by lognormal noise, and a share reroute of them get a random ConUS
+    county as destination of each stage (and as source of the next one), so that larger
+    scales also have more distinct origin/destination pairs.
+
+    Returns
+    -------
+    int
+        number of rows written
+    """
+    from utils import ref_data
+    rng = np.random.default_rng(seed)
+    fips = ref_data.county_fips
+    os.makedirs(out_folder, exist_ok=True)
+    total = 0
+    for name in sorted(glob.glob(os.path.join(template_folder, "*_full.csv"))):
+        df = pd.read_csv(name)
+        n = len(df) * (scale - 1)
+        extra = df.iloc[rng.integers(0, len(df), n)].reset_index(drop=True)
+        noise = rng.lognormal(0, 0.3, n)
+        for col in extra.columns:
+            if col.startswith(("flow_", "emission_")):
+                extra[col] = extra[col] * noise
+        stage = 0
+        while f"destination_FIPS_{stage}" in extra.columns:
+            move = rng.random(n) < reroute
+            dest = rng.choice(fips, move.sum())
+            extra.loc[move, f"destination_FIPS_{stage}"] = dest
+            if f"source_FIPS_{stage+1}" in extra.columns:
+                extra.loc[move, f"source_FIPS_{stage+1}"] = dest
+            stage += 1
+        out = pd.concat([df, extra], ignore_index=True)
+        out.to_csv(os.path.join(out_folder, os.path.basename(name)), index=False)
+        total += len(out)
+    return total
@@ -0,0 +1,170 @@
+import collections
+import contextvars
+import cProfile
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+import numpy as np
+
+try:
+    from pyinstrument import Profiler as _Pyinstrument
+    has_pyinstrument = True
+except ImportError:
+    has_pyinstrument = False
+
+# per-request timing: a trace covers one map request, spans time the stages inside it.
+#
+#   with trace("map", key=key):
+#       with span("build_flow_data") as attrs:
+#           ...
+#           attrs["arcs"] = n
+#
+# finished traces are kept in memory (recent, stage_times) and, with F3_TRACE_LOG set,
+# appended to that file as JSON lines. spans outside a trace cost nothing and record nothing.
+
+trace_log = os.environ.get("F3_TRACE_LOG")
+# number of recent durations kept per stage for the latency histograms
+trace_window = int(os.environ.get("F3_TRACE_WINDOW", 500))
+# "cprofile" or "pyinstrument": profile the first traced request (see profile_next)
+profile_mode = os.environ.get("F3_PROFILE", "")
+profile_dir = os.environ.get("F3_PROFILE_DIR", "data/cache/profiles/")
+
+recent = collections.deque(maxlen=50)
+stage_times = collections.defaultdict(lambda: collections.deque(maxlen=trace_window))
+_current = contextvars.ContextVar("trace", default=None)
+_lock = threading.Lock()
+_profile_next = profile_mode
+
+
+class Trace:
+    """the spans of one request, with the request's own attributes"""
+
+    def __init__(self, name, attrs):
+        self.id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.attrs = attrs
+        self.time = time.time()
+        self.t0 = time.perf_counter()
+        self.seconds = None
+        self.spans = []
+        self.profile = None
+
+    def record(self):
+        return {"id": self.id,
+                "name": self.name,
+                "time": round(self.time, 3),
+                "seconds": round(self.seconds, 4),
+                **({"profile": self.profile} if self.profile else {}),
+                "attrs": self.attrs,
+                "spans": sorted(self.spans, key=lambda s: s["start"])}
+
+
+@contextmanager
+def trace(name, **attrs):
+    """time a request; yields the Trace"""
+    t = Trace(name, attrs)
+    token = _current.set(t)
+    profiler = _start_profile()
+    try:
+        yield t
+    finally:
+        t.seconds = time.perf_counter() - t.t0
+        if profiler is not None:
+            t.profile = _save_profile(profiler, t.id)
+        _current.reset(token)
+        _finish(t)
+
+
+@contextmanager
+def span(name, **attrs):
+    """time a stage of the current trace; yields the span's attribute dict to add to"""
+    t = _current.get()
+    if t is None:
+        yield attrs
+        return
+    start = time.perf_counter()
+    try:
+        yield attrs
+    finally:
+        t.spans.append({"name": name,
+                        "start": round(start - t.t0, 4),
+                        "seconds": round(time.perf_counter() - start, 4),
+                        "attrs": attrs})
+
+
+def _finish(t):
+    record = t.record()
+    with _lock:
+        recent.append(record)
+        stage_times[t.name].append(t.seconds)
+        for s in t.spans:
+            stage_times[s["name"]].append(s["seconds"])
+        if trace_log:
+            with open(trace_log, "a") as f:
+                f.write(json.dumps(record, default=str) + "\n")
+
+
+def last(**attrs):
+    """the most recent finished trace whose attributes include attrs, or None"""
+    with _lock:
+        for record in reversed(recent):
+            if all(record["attrs"].get(k) == v for k, v in attrs.items()):
+                return record
+    return None
+
+
+def summary():
+    """count, p50, p95 and max seconds of every stage over the last trace_window requests"""
+    with _lock:
+        times = {name: np.array(d) for name, d in stage_times.items()}
+    return [{"stage": name, "count": len(d),
+             "p50_s": round(float(np.percentile(d, 50)), 4),
+             "p95_s": round(float(np.percentile(d, 95)), 4),
+             "max_s": round(float(d.max()), 4)} for name, d in times.items() if len(d)]
+
+
+def histograms(edges=np.logspace(-4, 2, 25)):
+    """{stage: counts} of recent stage durations over edges (seconds); returns (histograms, edges)"""
+    with _lock:
+        times = {name: np.array(d) for name, d in stage_times.items()}
+    return {name: np.histogram(d, edges)[0] for name, d in times.items()}, edges
+
+
+def profile_next(mode="cprofile"):
+    """profile the next traced request in this process ("cprofile" or "pyinstrument")"""
+    global _profile_next
+    with _lock:
+        _profile_next = mode
+
+
+def _start_profile():
+    global _profile_next
+    with _lock:
+        mode, _profile_next = _profile_next, ""
+    if not mode:
+        return None
+    if mode == "pyinstrument" and has_pyinstrument:
+        profiler = _Pyinstrument()
+        profiler.start()
+    else:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    return profiler
+
+
+def _save_profile(profiler, trace_id):
+    """stop the profiler and write its output to profile_dir; returns the file path"""
+    os.makedirs(profile_dir, exist_ok=True)
+    if isinstance(profiler, cProfile.Profile):
+        profiler.disable()
+        path = os.path.join(profile_dir, f"{trace_id}.prof")
+        profiler.dump_stats(path)
+    else:
+        profiler.stop()
+        path = os.path.join(profile_dir, f"{trace_id}.html")
+        with open(path, "w") as f:
+            f.write(profiler.output_html())
+    return path
@@ -0,0 +1,188 @@
+import asyncio
+import gzip
+import json
+import os
+import threading
+import numpy as np
+import shapely
+import matplotlib.colors as mcolors
+from starlette.responses import Response
+from utils import ref_data
+from utils.fingerprint import data_fingerprint
+from utils.render_utils import SIZE_FACTOR
+
+# payloads for the interactive map (www/webmap.js). the county and state geometry of a
+# simplification level is packed once and served under a versioned URL, so browsers cache
+# it; a map is then only a color class per county, the end points and widths of the flow
+# arcs and the centers and radii of the flow bubbles. the client redraws each arc from its
+# end points and the side it bulges to, as the arc of flow_utils.arc_vertices' circle.
+#
+# a pack is gzipped: a little-endian uint32 header length, a JSON header, then the arrays
+# the header lists ({"name", "dtype", "length"}), each starting on a 4-byte boundary.
+# coordinates are long,lat in units of quantum degrees, as int32; geometry coordinates are
+# delta-encoded along the array so they gzip well. polygons are packed as rings, exteriors and
+# holes alike, with the row each ring belongs to; the client fills them with the even-odd rule.
+
+quantum = 1e-4
+# bumped when the geometry pack's layout changes, so browsers don't keep a cached older one
+geometry_format = 2
+# simplification level of the interactive geometry: the map can be zoomed in, so it is
+# finer than the level the static maps pick for their width
+geometry_level = int(os.environ.get("F3_WEBMAP_LEVEL", 1))
+geometry_version = f"{geometry_format}-" + data_fingerprint([ref_data.state_file, ref_data.county_file])
+
+_geometry = {}
+_geometry_lock = threading.Lock()
+
+
+def pack(header, arrays):
+    """gzipped pack of a JSON header and named numpy arrays"""
+    entries, chunks = [], []
+    for name, arr in arrays.items():
+        arr = np.ascontiguousarray(arr)
+        entries.append({"name": name, "dtype": arr.dtype.name, "length": int(arr.size)})
+        data = arr.astype(arr.dtype.newbyteorder("<"), copy=False).tobytes()
+        chunks.append(data + b"\0" * (-len(data) % 4))
+    head = json.dumps({**header, "arrays": entries}).encode()
+    head += b" " * (-len(head) % 4)
+    return gzip.compress(np.uint32(len(head)).tobytes() + head + b"".join(chunks), compresslevel=6, mtime=0)
+
+
+def quantize(xy):
+    """(n, 2) long,lat array as int32 multiples of quantum"""
+    return np.round(np.asarray(xy, dtype=float) / quantum).astype(np.int32)
+
+
+def _delta(q):
+    """delta-encode interleaved x,y coordinates (the client undoes this with a running sum)"""
+    d = q.reshape(-1, 2).copy()
+    d[1:] -= q.reshape(-1, 2)[:-1]
+    return d.ravel()
+
+
+def _rings(geoms):
+    """
+    Every ring of every polygon part, exterior and interior: quantized coordinates, ring
+    offsets into them and the row of geoms each ring belongs to
+    """
+    parts, part_owner = shapely.get_parts(np.asarray(geoms), return_index=True)
+    rings, ring_part = shapely.get_rings(parts, return_index=True)
+    counts = shapely.get_num_coordinates(rings)
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.uint32)
+    return quantize(shapely.get_coordinates(rings)), offsets, part_owner[ring_part]
+
+
+def geometry_pack(level=None):
+    """
+    County polygons and state outlines of a simplification level, packed once per process.
+    Counties are in county_fips order, so the per-county arrays of map_pack line up with them.
+    """
+    level = geometry_level if level is None else level
+    with _geometry_lock:
+        if level not in _geometry:
+            counties = ref_data.poly_level("county", level)
+            states = ref_data.poly_level("state", level)
+            county_xy, county_offsets, county_owner = _rings(counties.geometry)
+            state_xy, state_offsets, _ = _rings(states.geometry)
+            _geometry[level] = pack(
+                {"version": geometry_version, "level": level, "quantum": quantum,
+                 "bounds": states.total_bounds.round(4).tolist()},
+                {"county_fips": ref_data.county_fips.astype(np.int32),
+                 "county_xy": _delta(county_xy),
+                 "county_offsets": county_offsets,
+                 "county_owner": county_owner.astype(np.uint16),
+                 "state_xy": _delta(state_xy),
+                 "state_offsets": state_offsets})
+        return _geometry[level]
+
+
+def geometry_url(level=None):
+    """versioned URL of a geometry pack (see geometry_route)"""
+    level = geometry_level if level is None else level
+    return f"webmap/geometry/{geometry_version}/{level}"
+
+
+def bin_label(edges, colorbin):
+    """legend text of a colorbin: its range of values when the bin edges are known"""
+    b = int(colorbin)
+    if edges is None or b + 1 >= len(edges):
+        return str(colorbin)
+    lo, hi = edges[b], edges[b + 1]
+    return f"{lo:,.0f} – {hi:,.0f}" if lo >= 1 else f"{lo:.2g} – {hi:.2g}"
+
+
+def map_pack(mapdata, flowarcs, layers, fill_values, arc_size="fixed", points=()):
+    """
+    One map as a pack: the color class of every county, and the arcs and bubbles of each
+    layer. Takes what draw_map takes (see map_render.map_inputs), with points already
+    turned into (bubbles GeoDataFrame, color) layers; widths match the fast renderer.
+    """
+    classes = np.full(len(ref_data.county_fips), 255, dtype=np.uint8)
+    labels = []
+    if mapdata is not None and len(mapdata):
+        pos = ref_data.county_positions(mapdata["source_FIPS_0"])
+        codes = mapdata["colorbin"].cat.codes.to_numpy()
+        keep = (pos >= 0) & (codes >= 0)
+        classes[pos[keep]] = codes[keep]
+        labels = [bin_label(mapdata.attrs.get("bin_edges"), c) for c in mapdata["colorbin"].cat.categories]
+    header = {"palette": [mcolors.to_hex(c) for c in fill_values[:max(len(labels), 1)]],
+              "labels": labels,
+              "arc_layers": [],
+              "point_layers": []}
+    arrays = {"classes": classes}
+
+    frames = [flowarcs[com][stage] for com, stage, _ in layers]
+    sizes = [f["flowsize"].to_numpy() for f in frames]
+    scaled = np.concatenate(sizes) if sizes else np.array([])
+    lo, hi = (scaled.min(), scaled.max()) if len(scaled) else (0, 0)
+    for i, ((com, stage, color), arcs, flow) in enumerate(zip(layers, frames, sizes)):
+        geoms = arcs.geometry.to_numpy()
+        start = shapely.get_coordinates(shapely.get_point(geoms, 0))
+        end = shapely.get_coordinates(shapely.get_point(geoms, -1))
+        mid = shapely.get_coordinates(shapely.line_interpolate_point(geoms, 0.5, normalized=True))
+        # which side of the chord the arc bulges to: 1 for the left, going from start to end
+        chord, bulge = end - start, mid - start
+        left = chord[:, 0] * bulge[:, 1] - chord[:, 1] * bulge[:, 0] > 0
+        if arc_size == "scaled":
+            rel = (flow - lo) / (hi - lo) if hi > lo else np.ones(len(flow))
+            widths = np.sqrt(rel) * SIZE_FACTOR
+        else:
+            widths = np.full(len(flow), 0.2 * SIZE_FACTOR)
+        header["arc_layers"].append({"com": com, "stage": int(stage), "color": mcolors.to_hex(color),
+                                     "count": len(arcs)})
+        arrays[f"arc_ends_{i}"] = quantize(np.column_stack([start, end]).reshape(-1, 2)).ravel()
+        arrays[f"arc_left_{i}"] = left.astype(np.uint8)
+        # line widths in thousandths of a point
+        arrays[f"arc_widths_{i}"] = np.round(widths * 1000).astype(np.uint16)
+
+    for i, (bubbles, color) in enumerate(points):
+        # bubbles are buffered points: their bounding box gives center and radius exactly
+        bounds = np.nan_to_num(shapely.bounds(bubbles.geometry.to_numpy()))
+        centers = np.column_stack([bounds[:, 0] + bounds[:, 2], bounds[:, 1] + bounds[:, 3]]) / 2
+        radius = (bounds[:, 2] - bounds[:, 0]) / 2
+        header["point_layers"].append({"color": mcolors.to_hex(color), "count": len(bubbles)})
+        arrays[f"point_xy_{i}"] = quantize(centers).ravel()
+        arrays[f"point_r_{i}"] = np.round(radius / quantum).astype(np.uint16)
+    return pack(header, arrays)
+
+
+def gzip_response(body, cache_control):
+    return Response(body, media_type="application/octet-stream",
+                    headers={"Content-Encoding": "gzip", "Cache-Control": cache_control})
+
+
+def geometry_route(executor=None):
+    """
+    Starlette endpoint for geometry_url: immutable, the URL changes with the gpkg files.
+    Packing a level the first time takes a while, so it runs on executor (e.g. the render
+    threads of map_render), off the event loop.
+    """
+    async def endpoint(request):
+        if request.path_params["version"] != geometry_version:
+            return Response(status_code=404)
+        level = request.path_params["level"]
+        if not 0 <= level < len(ref_data.simplify_tolerances):
+            return Response(status_code=404)
+        body = await asyncio.get_running_loop().run_in_executor(executor, geometry_pack, level)
+        return gzip_response(body, "public, max-age=31536000, immutable")
+    return endpoint
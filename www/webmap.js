@@ -0,0 +1,311 @@
+// interactive map drawn from the packs written by utils/web_map.py: the county and state
+// geometry is fetched once per level (and kept by the browser's cache), each map after
+// that is a color class per county plus arc end points and bubbles.
+// scroll to zoom, drag to pan, double-click to reset the view.
+(function () {
+  "use strict";
+
+  // pixels per point, at the 100 dpi the static maps are drawn at
+  const PX_PER_PT = 100 / 72;
+  const TYPES = {int32: Int32Array, uint32: Uint32Array, uint16: Uint16Array,
+                 uint8: Uint8Array, float32: Float32Array};
+  const maps = {};
+
+  function unpack(buffer) {
+    const headerLength = new DataView(buffer).getUint32(0, true);
+    const header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 4, headerLength)));
+    const arrays = {};
+    let offset = 4 + headerLength;
+    for (const a of header.arrays) {
+      const Type = TYPES[a.dtype];
+      arrays[a.name] = new Type(buffer, offset, a.length);
+      offset += Math.ceil(a.length * Type.BYTES_PER_ELEMENT / 4) * 4;
+    }
+    return {header: header, arrays: arrays};
+  }
+
+  async function fetchPack(url) {
+    const response = await fetch(url);
+    if (!response.ok) throw new Error(url + ": " + response.status);
+    return unpack(await response.arrayBuffer());
+  }
+
+  function undelta(xy) {
+    const out = new Float64Array(xy.length);
+    let x = 0, y = 0;
+    for (let i = 0; i < xy.length; i += 2) {
+      x += xy[i];
+      y += xy[i + 1];
+      out[i] = x;
+      out[i + 1] = y;
+    }
+    return out;
+  }
+
+  class WebMap {
+    constructor(el) {
+      this.el = el;
+      el.style.position = "relative";
+      this.canvas = document.createElement("canvas");
+      this.canvas.style.width = "100%";
+      this.canvas.style.height = "100%";
+      this.canvas.style.cursor = "grab";
+      el.appendChild(this.canvas);
+      this.tooltip = document.createElement("div");
+      this.tooltip.style.cssText = "position:absolute;pointer-events:none;background:rgba(255,255,255,0.9);" +
+        "border:1px solid #999;padding:2px 6px;font-size:12px;display:none";
+      el.appendChild(this.tooltip);
+      this.legend = document.createElement("div");
+      this.legend.style.cssText = "position:absolute;left:8px;bottom:8px;background:rgba(255,255,255,0.85);" +
+        "padding:4px 6px;font-size:12px";
+      el.appendChild(this.legend);
+      this.geometry = null;
+      this.geometryUrl = null;
+      this.data = null;
+      this.seq = 0;
+      this.view = null;
+      this.listen();
+      new ResizeObserver(() => this.resize()).observe(el);
+    }
+
+    // projected coordinates: quantized long,lat with x shrunk by cos(latitude) and y pointing down
+    project(qx, qy) {
+      return [(qx - this.x0) * this.k, this.y1 - qy];
+    }
+
+    setGeometry(pack) {
+      const a = pack.arrays, q = pack.header.quantum;
+      const [minx, miny, maxx, maxy] = pack.header.bounds;
+      this.x0 = minx / q;
+      this.y1 = maxy / q;
+      this.k = Math.cos((miny + maxy) / 2 * Math.PI / 180);
+      this.extent = [(maxx - minx) / q * this.k, (maxy - miny) / q];
+      this.fips = a.county_fips;
+
+      // a county's path holds all of its rings, holes included: fill it with the even-odd rule
+      const n = a.county_fips.length;
+      const xy = undelta(a.county_xy), offsets = a.county_offsets, owner = a.county_owner;
+      this.countyPaths = Array.from({length: n}, () => new Path2D());
+      this.countyBoxes = new Float64Array(n * 4).fill(NaN);
+      for (let r = 0; r + 1 < offsets.length; r++) {
+        const c = owner[r], path = this.countyPaths[c], box = this.countyBoxes;
+        for (let v = offsets[r]; v < offsets[r + 1]; v++) {
+          const [x, y] = this.project(xy[2 * v], xy[2 * v + 1]);
+          if (v === offsets[r]) path.moveTo(x, y); else path.lineTo(x, y);
+          if (!(box[4 * c] <= x)) box[4 * c] = x;
+          if (!(box[4 * c + 1] <= y)) box[4 * c + 1] = y;
+          if (!(box[4 * c + 2] >= x)) box[4 * c + 2] = x;
+          if (!(box[4 * c + 3] >= y)) box[4 * c + 3] = y;
+        }
+        path.closePath();
+      }
+      const sxy = undelta(a.state_xy);
+      this.statePath = new Path2D();
+      for (let r = 0; r + 1 < a.state_offsets.length; r++) {
+        for (let v = a.state_offsets[r]; v < a.state_offsets[r + 1]; v++) {
+          const [x, y] = this.project(sxy[2 * v], sxy[2 * v + 1]);
+          if (v === a.state_offsets[r]) this.statePath.moveTo(x, y); else this.statePath.lineTo(x, y);
+        }
+      }
+      this.geometry = pack;
+    }
+
+    setData(pack) {
+      const h = pack.header, a = pack.arrays;
+      // one path per color class, and one for the outlines of every colored county
+      this.classPaths = h.palette.map(() => new Path2D());
+      this.coloredPath = new Path2D();
+      for (let c = 0; c < a.classes.length; c++) {
+        if (a.classes[c] === 255) continue;
+        this.classPaths[a.classes[c]].addPath(this.countyPaths[c]);
+        this.coloredPath.addPath(this.countyPaths[c]);
+      }
+      this.arcLayers = h.arc_layers.map((layer, i) => ({
+        color: layer.color, ends: a["arc_ends_" + i], left: a["arc_left_" + i], widths: a["arc_widths_" + i]}));
+      this.pointLayers = h.point_layers.map((layer, i) => ({
+        color: layer.color, xy: a["point_xy_" + i], r: a["point_r_" + i]}));
+      this.data = pack;
+      this.legend.innerHTML = "";
+      h.labels.forEach((label, i) => {
+        const row = document.createElement("div");
+        row.innerHTML = '<span style="display:inline-block;width:12px;height:12px;margin-right:4px;' +
+          'vertical-align:middle;background:' + h.palette[i] + '"></span>';
+        row.appendChild(document.createTextNode(label));
+        this.legend.appendChild(row);
+      });
+      this.legend.style.display = h.labels.length ? "block" : "none";
+    }
+
+    async update(msg) {
+      const seq = ++this.seq;
+      const geometry = msg.geometry === this.geometryUrl ? null : fetchPack(msg.geometry);
+      const data = await fetchPack(msg.data);
+      if (geometry) {
+        this.setGeometry(await geometry);
+        this.geometryUrl = msg.geometry;
+        this.view = null;
+      }
+      if (seq !== this.seq) return;  // a newer map arrived while this one was loading
+      this.setData(data);
+      this.draw();
+    }
+
+    fit() {
+      const w = this.canvas.clientWidth, h = this.canvas.clientHeight;
+      const s = Math.min(w / this.extent[0], h / this.extent[1]) / 1.05;
+      this.view = {s: s, tx: (w - this.extent[0] * s) / 2, ty: (h - this.extent[1] * s) / 2};
+    }
+
+    resize() {
+      const dpr = window.devicePixelRatio || 1;
+      this.canvas.width = Math.round(this.canvas.clientWidth * dpr);
+      this.canvas.height = Math.round(this.canvas.clientHeight * dpr);
+      if (this.geometry) {
+        this.fit();
+        this.draw();
+      }
+    }
+
+    transform(ctx) {
+      const dpr = window.devicePixelRatio || 1, v = this.view;
+      ctx.setTransform(dpr * v.s, 0, 0, dpr * v.s, dpr * v.tx, dpr * v.ty);
+    }
+
+    draw() {
+      if (!this.geometry || !this.data) return;
+      if (!this.view) this.fit();
+      const ctx = this.canvas.getContext("2d"), s = this.view.s, px = 1 / s;
+      ctx.setTransform(1, 0, 0, 1, 0, 0);
+      ctx.fillStyle = "white";
+      ctx.fillRect(0, 0, this.canvas.width, this.canvas.height);
+      this.transform(ctx);
+      const palette = this.data.header.palette;
+      this.classPaths.forEach((path, i) => {
+        ctx.fillStyle = palette[i];
+        ctx.fill(path, "evenodd");
+      });
+      ctx.strokeStyle = "white";
+      ctx.lineWidth = 0.1 * Math.sqrt(Math.PI) * PX_PER_PT * px;
+      ctx.stroke(this.coloredPath);
+      ctx.strokeStyle = "#000000";
+      ctx.lineWidth = 0.2 * Math.sqrt(Math.PI) * PX_PER_PT * px;
+      ctx.stroke(this.statePath);
+
+      ctx.lineCap = "butt";
+      for (const layer of this.arcLayers) {
+        ctx.strokeStyle = layer.color;
+        for (let i = 0; i < layer.widths.length; i++) {
+          const e = layer.ends.subarray(4 * i, 4 * i + 4);
+          ctx.lineWidth = layer.widths[i] / 1000 * PX_PER_PT * px;
+          ctx.beginPath();
+          this.arc(ctx, e[0], e[1], e[2], e[3], layer.left[i]);
+          ctx.stroke();
+        }
+      }
+      for (const layer of this.pointLayers) {
+        ctx.fillStyle = layer.color;
+        ctx.globalAlpha = 0.7;
+        ctx.beginPath();
+        for (let i = 0; i < layer.r.length; i++) {
+          const [x, y] = this.project(layer.xy[2 * i], layer.xy[2 * i + 1]);
+          ctx.moveTo(x + layer.r[i] * this.k, y);
+          ctx.ellipse(x, y, layer.r[i] * this.k, layer.r[i], 0, 0, 2 * Math.PI);
+        }
+        ctx.fill();
+        ctx.globalAlpha = 1;
+        ctx.strokeStyle = "white";
+        ctx.lineWidth = 0.1 * Math.sqrt(Math.PI) * PX_PER_PT * px;
+        ctx.stroke();
+      }
+    }
+
+    // the flow arc from (x1, y1) to (x2, y2), bulging to the left of that direction when left is
+    // set: a sixth of a circle, the arc flow_utils.arc_vertices draws between its end points
+    arc(ctx, x1, y1, x2, y2, left) {
+      const dx = x2 - x1, dy = y2 - y1, q = Math.hypot(dx, dy);
+      if (q === 0) return;
+      // for theta = pi/3 the radius equals the chord; the center is on the other side of it
+      const d = (left ? -1 : 1) * Math.sqrt(3) / 2;
+      const cx = (x1 + x2) / 2 - d * dy, cy = (y1 + y2) / 2 + d * dx;
+      const t1 = Math.atan2(y1 - cy, x1 - cx), t2 = Math.atan2(y2 - cy, x2 - cx);
+      let dt = t2 - t1;
+      if (dt > Math.PI) dt -= 2 * Math.PI;
+      if (dt < -Math.PI) dt += 2 * Math.PI;
+      const [px, py] = this.project(cx, cy);
+      // y points down on screen, so angles flip sign
+      ctx.ellipse(px, py, q * this.k, q, 0, -t1, -(t1 + dt), dt > 0);
+    }
+
+    countyAt(mx, my) {
+      const ctx = this.canvas.getContext("2d"), dpr = window.devicePixelRatio || 1;
+      const x = (mx - this.view.tx) / this.view.s, y = (my - this.view.ty) / this.view.s;
+      const box = this.countyBoxes;
+      this.transform(ctx);
+      for (let c = 0; c < this.countyPaths.length; c++) {
+        if (x < box[4 * c] || x > box[4 * c + 2] || y < box[4 * c + 1] || y > box[4 * c + 3]) continue;
+        if (ctx.isPointInPath(this.countyPaths[c], mx * dpr, my * dpr, "evenodd")) return c;
+      }
+      return -1;
+    }
+
+    hover(e) {
+      if (!this.data || this.dragging) return;
+      const c = this.countyAt(e.offsetX, e.offsetY);
+      if (c < 0) {
+        this.tooltip.style.display = "none";
+        return;
+      }
+      const cls = this.data.arrays.classes[c];
+      const label = cls === 255 ? "no flow" : this.data.header.labels[cls];
+      this.tooltip.textContent = "FIPS " + String(this.fips[c]).padStart(5, "0") + ": " + label;
+      this.tooltip.style.left = (e.offsetX + 12) + "px";
+      this.tooltip.style.top = (e.offsetY + 12) + "px";
+      this.tooltip.style.display = "block";
+    }
+
+    listen() {
+      const c = this.canvas;
+      c.addEventListener("wheel", (e) => {
+        if (!this.view) return;
+        e.preventDefault();
+        const f = Math.exp(-e.deltaY * 0.002), v = this.view;
+        v.tx = e.offsetX - (e.offsetX - v.tx) * f;
+        v.ty = e.offsetY - (e.offsetY - v.ty) * f;
+        v.s *= f;
+        this.draw();
+      }, {passive: false});
+      c.addEventListener("mousedown", (e) => {
+        this.dragging = {x: e.clientX, y: e.clientY};
+        c.style.cursor = "grabbing";
+        this.tooltip.style.display = "none";
+      });
+      window.addEventListener("mousemove", (e) => {
+        if (!this.dragging || !this.view) return;
+        this.view.tx += e.clientX - this.dragging.x;
+        this.view.ty += e.clientY - this.dragging.y;
+        this.dragging = {x: e.clientX, y: e.clientY};
+        this.draw();
+      });
+      window.addEventListener("mouseup", () => {
+        this.dragging = null;
+        c.style.cursor = "grab";
+      });
+      c.addEventListener("mousemove", (e) => this.hover(e));
+      c.addEventListener("mouseleave", () => { this.tooltip.style.display = "none"; });
+      c.addEventListener("dblclick", () => {
+        if (!this.geometry) return;
+        this.fit();
+        this.draw();
+      });
+    }
+  }
+
+  document.addEventListener("DOMContentLoaded", function () {
+    Shiny.addCustomMessageHandler("webmap", function (msg) {
+      const el = document.getElementById(msg.id);
+      if (!el) return;
+      maps[msg.id] = maps[msg.id] || new WebMap(el);
+      maps[msg.id].update(msg).catch((err) => console.error("webmap:", err));
+    });
+  });
+})();